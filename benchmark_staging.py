@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+
+import os, errno, shutil
+import sys, subprocess
+import argparse
+import json
+import tempfile
+import time
+
+class colours:
+    ylw = '\033[93m'
+    blu = '\033[94m'
+    rst = '\033[0m'
+
+def print_blu(message):
+    print colours.blu + message + colours.rst
+
+def print_ylw(message):
+    print colours.ylw + message + colours.rst
+
+# The driver script being benchmarked.
+SETUP_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'setup_specfem_lasif.py')
+
+# Stand-in for mk_daint.sh. Prints something that looks like a build and
+# writes binaries of the requested size ($BENCHMARK_BINARY_KB).
+STUB_BUILD_SCRIPT = """#!/bin/bash
+compiler_suite=$1
+mode=$2
+echo "checking for ftn... ftn"
+echo "configure: creating ./config.status"
+rm -rf bin bin.forward bin.kernel
+mkdir -p bin
+for name in a b c d; do echo "ftn -O3 -c src/$name.f90 -o obj/$name.o"; done
+for binary in xmeshfem3D xspecfem3D xcombine_vol_data; do
+  echo "ftn -o bin/$binary obj/a.o"
+  dd if=/dev/zero of=bin/$binary bs=1024 count=$BENCHMARK_BINARY_KB 2> /dev/null
+done
+if [ "$mode" == "forward" ]; then cp -rp bin bin.forward; fi
+if [ "$mode" == "adjoint" ]; then cp -rp bin bin.kernel; fi
+"""
+
+PAR_FILE = """# Synthetic Par_file for benchmarking.
+SIMULATION_TYPE                 = 1
+SAVE_FORWARD                    = .false.
+NCHUNKS                         = 1
+ANGULAR_WIDTH_XI_IN_DEGREES     = 90.d0
+ANGULAR_WIDTH_ETA_IN_DEGREES    = 90.d0
+NEX_XI                          = 128
+NEX_ETA                         = 128
+NPROC_XI                        = %d
+NPROC_ETA                       = %d
+MODEL                           = CEM_ACCEPT
+RECORD_LENGTH_IN_MINUTES        = 30.0d0
+"""
+
+def mkdir_p(path):
+    """
+    Makes a directory and doesn't fail if the directory already exists.
+
+    :path: New directory path.
+    """
+
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST:
+            pass
+        else:
+            raise
+
+def write_file(path, contents='', size=None):
+    """
+    Writes a file with the given contents, or of the given size in bytes.
+
+    :path: File to write.
+    :contents: File contents.
+    :size: If set, write this many zero bytes instead.
+    """
+
+    with open(path, 'wb') as file:
+        if size is None:
+            file.write(contents)
+        else:
+            file.write('\0' * size)
+
+def event_name(index):
+    """
+    Name of the index-th synthetic event, in the style of LASIF's GCMT events.
+
+    :index: Event number.
+    """
+
+    return 'GCMT_event_SYNTHETIC_REGION_Mag_5.5_2000-1-1-%d' % (index)
+
+def generate_project(root, n_events, n_stations, nproc, files_per_proc,
+    binary_kb, topo_files, topo_kb, iteration_name='benchmark'):
+    """
+    Generates a synthetic LASIF project, specfem installation and parameter
+    file under root. The specfem installation has a stub build script, so
+    compiling takes no time.
+
+    :root: Directory to generate everything in.
+    :n_events: Number of events in the iteration.
+    :n_stations: Number of stations per event.
+    :nproc: NPROC_XI (= NPROC_ETA) of the synthetic mesh.
+    :files_per_proc: Mesh files per process in DATABASES_MPI.
+    :binary_kb: Size of each stub binary in kB.
+    :topo_files: Number of files in DATA/topo_bathy.
+    :topo_kb: Size of each topography file in kB.
+    :iteration_name: Iteration name.
+
+    Returns the path of the parameter file.
+    """
+
+    lasif_path   = os.path.join(root, 'lasif')
+    specfem_root = os.path.join(root, 'specfem')
+    for path in ['ITERATIONS', 'OUTPUT', 'SUBMISSION']:
+        mkdir_p(os.path.join(lasif_path, path))
+    for path in ['DATA/topo_bathy', 'src']:
+        mkdir_p(os.path.join(specfem_root, path))
+    par_file = PAR_FILE % (nproc, nproc)
+
+    # Iteration xml, with per station weights like LASIF writes them.
+    xml_path = os.path.join(lasif_path, 'ITERATIONS',
+        'ITERATION_%s.xml' % (iteration_name))
+    with open(xml_path, 'w') as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n<iteration>\n')
+        file.write('  <iteration_name>%s</iteration_name>\n' %
+            (iteration_name))
+        for i in range(n_events):
+            file.write('  <event>\n    <event_name>%s</event_name>\n'
+                '    <event_weight>1.0</event_weight>\n' % (event_name(i)))
+            for j in range(n_stations):
+                file.write('    <station>\n      <station_id>XX.S%04d'
+                    '</station_id>\n      <station_weight>1.0'
+                    '</station_weight>\n    </station>\n' % (j))
+            file.write('  </event>\n')
+        file.write('</iteration>\n')
+
+    # Input file folders.
+    stations = ''.join('S%04d XX 0.0 0.0 0.0 0.0\n' % (j)
+        for j in range(n_stations))
+    for i in range(n_events):
+        path = os.path.join(lasif_path, 'OUTPUT',
+            '2014-01-01T00-00-00__input_files___ITERATION_%s__adjoint__'
+            'EVENT_%s' % (iteration_name, event_name(i)))
+        mkdir_p(path)
+        write_file(os.path.join(path, 'CMTSOLUTION'), 'PDE %d\n' % (i))
+        write_file(os.path.join(path, 'STATIONS'), stations)
+        write_file(os.path.join(path, 'Par_file'), par_file)
+
+    # Submission directory.
+    write_file(os.path.join(lasif_path, 'SUBMISSION', 'Par_file'), par_file)
+    for name in ['jobArray_solver_daint.sbatch', 'job_mesher_daint.sbatch']:
+        write_file(os.path.join(lasif_path, 'SUBMISSION', name),
+            '#!/bin/bash\n#SBATCH --nodes=1\n#SBATCH --time=00:30:00\n')
+
+    # Specfem installation.
+    build_script = os.path.join(specfem_root, 'mk_daint.sh')
+    write_file(build_script, STUB_BUILD_SCRIPT)
+    os.chmod(build_script, 0755)
+    write_file(os.path.join(specfem_root, 'DATA', 'Par_file'), par_file)
+    write_file(os.path.join(specfem_root, 'src', 'a.f90'), 'end\n')
+    for i in range(topo_files):
+        write_file(os.path.join(specfem_root, 'DATA', 'topo_bathy',
+            'topo_bathy_%d.dat' % (i)), size=topo_kb * 1024)
+
+    parameter_file = os.path.join(root, 'params.txt')
+    with open(parameter_file, 'w') as file:
+        file.write('# Synthetic benchmark project\n')
+        file.write('project_name benchmark\n')
+        file.write('iteration_name %s\n' % (iteration_name))
+        file.write('scratch_path %s\n' % (os.path.join(root, 'scratch')))
+        file.write('lasif_path %s\n' % (lasif_path))
+        file.write('compiler_suite cuda.adios\n')
+        file.write('specfem_root %s\n' % (specfem_root))
+
+    return parameter_file
+
+def fake_mesher_run(mesh_path, nproc, files_per_proc):
+    """
+    Fills the mesh directory as if the mesher had run.
+
+    :mesh_path: Mesh directory of the iteration.
+    :nproc: NPROC_XI (= NPROC_ETA) of the synthetic mesh.
+    :files_per_proc: Mesh files per process in DATABASES_MPI.
+    """
+
+    databases_mpi = os.path.join(mesh_path, 'DATABASES_MPI')
+    for rank in range(nproc * nproc):
+        for i in range(files_per_proc):
+            write_file(os.path.join(databases_mpi,
+                'proc%06d_reg1_file%d.bin' % (rank, i)), size=64)
+    for name in ['output_mesher.txt', 'values_from_mesher.h']:
+        write_file(os.path.join(mesh_path, 'OUTPUT_FILES', name), name + '\n')
+
+def run_stage(parameter_file, stage, extra_args):
+    """
+    Runs one stage of the driver with profiling on. Returns the wall time and
+    the profile report.
+
+    :parameter_file: Driver parameter file.
+    :stage: Stage flag, e.g. '--setup_run'.
+    :extra_args: Further arguments for the driver.
+    """
+
+    start = time.time()
+    with open(os.devnull, 'w') as output:
+        retcode = subprocess.call([sys.executable, SETUP_SCRIPT, '-f',
+            parameter_file, stage, '--profile'] + extra_args, stdout=output)
+    wall_time = time.time() - start
+    if retcode != 0:
+        raise RuntimeError('%s failed with exit code %d.' % (stage, retcode))
+
+    # The newest report for this stage is ours.
+    profiles = os.path.join(os.path.dirname(parameter_file), 'scratch',
+        'benchmark', 'profiles')
+    command  = stage.lstrip('-')
+    reports  = sorted(name for name in os.listdir(profiles)
+        if command in name and not name.startswith('done_'))
+    with open(os.path.join(profiles, reports[-1]), 'r') as file:
+        report = json.load(file)
+    os.rename(os.path.join(profiles, reports[-1]),
+        os.path.join(profiles, 'done_' + reports[-1]))
+    return wall_time, report
+
+def check_staged(iteration_path, n_events, directories):
+    """
+    Checks that a stage left every event with files in some directories, so
+    a stage that silently skips events doesn't pass for a fast one.
+
+    :iteration_path: Iteration directory on scratch.
+    :n_events: Number of events.
+    :directories: Event subdirectories that must not be empty.
+    """
+
+    missing = [os.path.join(event_name(i), directory) for i in range(n_events)
+        for directory in directories if not os.listdir(os.path.join(
+        iteration_path, event_name(i), directory))]
+    if missing:
+        raise RuntimeError('%d of %d event directories are empty, e.g. %s.' % (
+            len(missing), n_events * len(directories), missing[0]))
+
+def summarise(name, n_events, wall_time, report):
+    """
+    Returns the throughput of one run as a dictionary, and prints it.
+
+    :name: Run name.
+    :n_events: Number of events.
+    :wall_time: Wall time of the whole command, including start up.
+    :report: Profile report of the run.
+    """
+
+    files = sum(stage['files'] for stage in report['stages'].values())
+    n_bytes = sum(stage['bytes'] for stage in report['stages'].values())
+    result = {'run': name, 'events': n_events, 'wall_time': wall_time,
+        'events_per_s': n_events / wall_time, 'files_per_s': files / wall_time,
+        'mb_per_s': n_bytes / 1024.0 ** 2 / wall_time, 'files': files,
+        'bytes': n_bytes, 'stages': dict((stage, stats['wall_time'])
+            for stage, stats in report['stages'].items())}
+    print '%-22s %7d %9.2f %10.1f %10.1f %8.1f' % (name, n_events, wall_time,
+        result['events_per_s'], result['files_per_s'], result['mb_per_s'])
+    print '    ' + ', '.join('%s %.2fs' % (stage, seconds) for stage, seconds
+        in result['stages'].items())
+    return result
+
+def benchmark(args, n_events):
+    """
+    Generates a project with n_events events and times the staging stages
+    against it.
+
+    :args: Parsed command line arguments.
+    :n_events: Number of events.
+    """
+
+    root = os.path.join(args.work_dir, 'events_%d' % (n_events))
+    shutil.rmtree(root, ignore_errors=True)
+    os.environ['BENCHMARK_BINARY_KB'] = str(args.binary_kb)
+
+    start = time.time()
+    parameter_file = generate_project(root, n_events, args.stations,
+        args.nproc, args.files_per_proc, args.binary_kb, args.topo_files,
+        args.topo_kb)
+    print_ylw('Generated %d events in %.1fs.' % (n_events,
+        time.time() - start))
+
+    extra_args = ['--jobs', str(args.jobs)] + args.extra.split()
+    iteration_path = os.path.join(root, 'scratch', 'benchmark', 'benchmark')
+    results = []
+    wall_time, report = run_stage(parameter_file, '--setup_run', extra_args)
+    results.append(summarise('setup_run (cold)', n_events, wall_time, report))
+    if '--bundle' not in extra_args:
+        check_staged(iteration_path, n_events, ['bin', 'DATA'])
+    wall_time, report = run_stage(parameter_file, '--setup_run', extra_args)
+    results.append(summarise('setup_run (rerun)', n_events, wall_time,
+        report))
+
+    fake_mesher_run(os.path.join(iteration_path, 'mesh'), args.nproc,
+        args.files_per_proc)
+    wall_time, report = run_stage(parameter_file, '--prepare_solve',
+        extra_args)
+    results.append(summarise('prepare_solve', n_events, wall_time, report))
+    check_staged(iteration_path, n_events, ['OUTPUT_FILES', 'DATABASES_MPI'])
+
+    if not args.keep:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+parser = argparse.ArgumentParser(description='Benchmarks the staging stages '
+    'of setup_specfem_lasif.py against synthetic LASIF projects on a local '
+    'directory.')
+parser.add_argument('--events', type=str, default='10,100,1000',
+    help='Comma separated project sizes, in events (default: 10,100,1000).')
+parser.add_argument('--stations', type=int, default=50,
+    help='Stations per event (default: 50).')
+parser.add_argument('--nproc', type=int, default=4,
+    help='NPROC_XI and NPROC_ETA of the synthetic mesh (default: 4).')
+parser.add_argument('--files_per_proc', type=int, default=8,
+    help='Mesh files per process in DATABASES_MPI (default: 8).')
+parser.add_argument('--binary_kb', type=int, default=1024,
+    help='Size of each stub binary in kB (default: 1024).')
+parser.add_argument('--topo_files', type=int, default=4,
+    help='Number of topography files (default: 4).')
+parser.add_argument('--topo_kb', type=int, default=1024,
+    help='Size of each topography file in kB (default: 1024).')
+parser.add_argument('-j', '--jobs', type=int, default=8,
+    help='--jobs passed to the driver (default: 8).')
+parser.add_argument('--extra', type=str, default='',
+    help='Further arguments for the driver, e.g. "--bin_mode hardlink".')
+parser.add_argument('--work_dir', type=str, default=None,
+    help='Where to generate the projects (default: a new temporary '
+        'directory).')
+parser.add_argument('--keep', action='store_true',
+    help='Keep the generated projects.')
+parser.add_argument('-o', type=str, default=None, dest='output',
+    help='Also write the results to this json file.')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(
+        prefix='specfem_benchmark_'))
+
+    print_ylw('Benchmarking in ' + args.work_dir)
+    print '%-22s %7s %9s %10s %10s %8s' % ('run', 'events', 'wall [s]',
+        'events/s', 'files/s', 'MB/s')
+    results = []
+    for n_events in [int(n) for n in args.events.split(',')]:
+        results.extend(benchmark(args, n_events))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if not args.keep:
+        shutil.rmtree(args.work_dir, ignore_errors=True)
+    print_blu('Done.')
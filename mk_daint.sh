@@ -4,6 +4,7 @@ if [ "$2" == "" ]; then echo "Did not specify compiler suite."; exit 1; fi
 
 compiler_suite=$1
 mode=$2
+make_jobs=${3:-4}
 
 module purge
 
@@ -36,7 +37,7 @@ if [ "$compiler_suite" == "cray" ]; then
     
     mkdir -p bin;
     
-    CRAY_CPU_TARGET=x86_64 make -j 4;
+    CRAY_CPU_TARGET=x86_64 make -j $make_jobs;
     
 fi
 
@@ -63,7 +64,7 @@ if [ "$compiler_suite" == "cuda.adios" ]; then
 
     mkdir -p bin;
 
-    CRAY_CPU_TARGET=x86_64 make -j 4
+    CRAY_CPU_TARGET=x86_64 make -j $make_jobs
 
 fi
 
@@ -80,7 +81,7 @@ if [ "$compiler_suite" == "cuda" ]; then
     
     mkdir -p bin;
     
-    CRAY_CPU_TARGET=x86_64 make -j 4;
+    CRAY_CPU_TARGET=x86_64 make -j $make_jobs;
     
 fi
 
@@ -96,17 +97,17 @@ if [ "$compiler_suite" == "cudaNoCem" ]; then
     
     mkdir -p bin;
     
-    CRAY_CPU_TARGET=x86_64 make -j 4;
+    CRAY_CPU_TARGET=x86_64 make -j $make_jobs;
     
 fi
 
 # Copy from bin to bin.forward directory
 if [ "$mode" == "forward" ]; then
   cp -rp bin bin.forward;
-  if [ ! -e bin.forward/xspecfem3D ]; then exit; fi
+  if [ ! -e bin.forward/xspecfem3D ]; then exit 1; fi
 fi
 
 if [ "$mode" == "adjoint" ]; then
   cp -rp bin bin.kernel;
-  if [ ! -e bin.kernel/xspecfem3D ]; then exit; fi
+  if [ ! -e bin.kernel/xspecfem3D ]; then exit 1; fi
 fi
@@ -0,0 +1,23 @@
+"""
+Helpers to set up and run specfem3d_globe for a LASIF project on Piz Daint.
+
+    from specfem_lasif import Project
+
+    project = Project('params.txt', jobs=16, bundle='events')
+    project.setup_run()
+    iteration = project.iteration()
+    iteration.submit_mesher()
+
+The modules behind the stages import what they need (sqlite3, tarfile, the
+xml parser, thread pools) only when a stage uses it, so importing the package
+is cheap. setup_specfem_lasif.py is the command line to it.
+"""
+
+from specfem_lasif.errors import ParameterError, PathError, \
+    MesherNotRunError, StagingError, BuildError, SubmissionError
+from specfem_lasif.project import Project, Iteration, DEFAULT_OPTIONS
+from specfem_lasif.util import read_parameter_file
+
+__all__ = ['Project', 'Iteration', 'DEFAULT_OPTIONS', 'read_parameter_file',
+    'ParameterError', 'PathError', 'MesherNotRunError', 'StagingError',
+    'BuildError', 'SubmissionError']
@@ -0,0 +1,5 @@
+import sys
+
+from specfem_lasif.cli import main
+
+sys.exit(main())
@@ -0,0 +1,419 @@
+"""
+Compiling specfem build variants, and the build cache.
+"""
+
+import os, errno, shutil
+import subprocess
+import collections
+import hashlib
+import json
+import re
+import signal
+import threading
+import time
+
+from specfem_lasif.errors import ParameterError, BuildError
+from specfem_lasif.staging import file_md5
+from specfem_lasif.util import mkdir_p, read_par_file, format_elapsed, \
+    print_blu, print_ylw, thread_pool
+
+# Where mk_daint.sh leaves the binaries for each build mode.
+BUILD_MODES = {'forward': 'bin.forward', 'adjoint': 'bin.kernel'}
+
+# Par_file parameters that only affect output at run time, and the ones
+# change_simulation_type.pl sets from the build mode. None of them change the
+# compiled binaries.
+RUNTIME_PAR_FILE_PARAMETERS = ['SIMULATION_TYPE', 'SAVE_FORWARD', 
+    'NTSTEP_BETWEEN_OUTPUT_INFO', 'NTSTEP_BETWEEN_OUTPUT_SEISMOS', 
+    'NTSTEP_BETWEEN_READ_ADJSRC', 'OUTPUT_SEISMOS_ASCII_TEXT', 
+    'OUTPUT_SEISMOS_SAC_ALPHANUM', 'OUTPUT_SEISMOS_SAC_BINARY', 
+    'ROTATE_SEISMOGRAMS_RT', 'WRITE_SEISMOGRAMS_BY_MASTER', 
+    'SAVE_ALL_SEISMOS_IN_ONE_FILE', 'USE_BINARY_FOR_LARGE_FILE', 
+    'PRINT_SOURCE_TIME_FUNCTION']
+
+# What change_simulation_type.pl, as mk_daint.sh calls it, sets in the
+# Par_file for each build mode.
+BUILD_MODE_PARAMETERS = {
+    'forward': [('SIMULATION_TYPE', '1'), ('SAVE_FORWARD', '.false.')],
+    'adjoint': [('SIMULATION_TYPE', '1'), ('SAVE_FORWARD', '.true.')]}
+
+def write_run_par_file(source, dest, mode):
+    """
+    Writes the Par_file the events of a build mode run with: source, with the
+    parameters the build mode sets rewritten. A cached build is shared by
+    every Par_file that only differs in run time parameters, so the Par_file
+    it was compiled with can't be staged. dest is left alone if it already
+    has the same contents, so it isn't restaged for nothing.
+    
+    :source: Par_file, e.g. the SUBMISSION one.
+    :dest: Par_file to write.
+    :mode: 'forward' or 'adjoint'.
+    """
+    
+    with open(source, 'r') as file:
+        content = file.read()
+    for name, value in BUILD_MODE_PARAMETERS[mode]:
+        content = re.sub(r'(?m)^(\s*%s\s*=\s*)\S+' % (name), 
+            lambda match: match.group(1) + value, content)
+    if os.path.exists(dest):
+        with open(dest, 'r') as file:
+            if file.read() == content:
+                return
+    mkdir_p(os.path.dirname(dest))
+    with open(dest + '.tmp', 'w') as file:
+        file.write(content)
+    os.rename(dest + '.tmp', dest)
+
+def source_tree_state(specfem_root):
+    """
+    Summarises the state of the specfem source tree. In a git checkout that's
+    the HEAD commit plus a hash of the uncommitted changes to tracked files,
+    which ignores everything configure and make generate. Otherwise it's the
+    size and mtime of every file under src.
+    
+    :specfem_root: Path to the specfem installation.
+    """
+    
+    if os.path.isdir(os.path.join(specfem_root, '.git')):
+        head = subprocess.check_output(['git', 'rev-parse', 'HEAD'], 
+            cwd=specfem_root).strip()
+        diff = subprocess.check_output(['git', 'diff', 'HEAD'], 
+            cwd=specfem_root)
+        return {'head': head, 'diff': hashlib.sha1(diff).hexdigest()}
+    
+    files = []
+    for root, dirs, names in os.walk(os.path.join(specfem_root, 'src')):
+        dirs.sort()
+        for name in sorted(names):
+            info = os.stat(os.path.join(root, name))
+            files.append([os.path.relpath(os.path.join(root, name), 
+                specfem_root), info.st_size, info.st_mtime])
+    return {'files': hashlib.sha1(json.dumps(files)).hexdigest()}
+
+def build_fingerprint(specfem_root, compiler_suite, mode, par_file=None):
+    """
+    Fingerprints everything that goes into a build: the compiler suite, the
+    build mode, the compile-time Par_file parameters in DATA/Par_file, the
+    build script and the state of the source tree.
+    
+    :specfem_root: Path to the specfem installation.
+    :compiler_suite: Compiler suite passed to mk_daint.sh.
+    :mode: 'forward' or 'adjoint'.
+    :par_file: Par_file to use instead of DATA/Par_file, e.g. the one about
+        to be copied there.
+    
+    Returns the fingerprint and the dictionary it was computed from.
+    """
+    
+    par_file = read_par_file(par_file or os.path.join(specfem_root, 'DATA', 
+        'Par_file'))
+    for param in RUNTIME_PAR_FILE_PARAMETERS:
+        par_file.pop(param, None)
+    inputs = {'compiler_suite': compiler_suite, 'mode': mode, 
+        'par_file': sorted(par_file.items()), 
+        'build_script': file_md5(os.path.join(specfem_root, 'mk_daint.sh')),
+        'source': source_tree_state(specfem_root)}
+    fingerprint = hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+    return fingerprint, inputs
+
+# Entries of the specfem tree that each build directory gets its own version
+# of. Everything else is symbolically linked from the source tree, apart from
+# earlier build products.
+BUILD_DIR_FRESH   = ['bin', 'obj', 'OUTPUT_FILES', 'DATA']
+
+BUILD_DIR_COPIED  = ['setup']
+
+BUILD_DIR_SKIPPED = ['.git', 'builds', 'build_cache', 'artifacts', 'Makefile',
+    'config.log', 'config.status', 'compilation_log.txt', 'bin.forward', 
+    'bin.kernel']
+
+def parse_build_variant(variant):
+    """
+    Splits a build variant name, <compiler_suite>.<mode>, into its compiler
+    suite and mode.
+    
+    :variant: Variant name, e.g. cuda.adios.adjoint.
+    """
+    
+    compiler_suite, _, mode = variant.rpartition('.')
+    if not compiler_suite or mode not in BUILD_MODES:
+        raise ParameterError('Build variant %s is not of the form '
+            '<compiler_suite>.<%s>.' % (variant, '|'.join(sorted(BUILD_MODES))))
+    return compiler_suite, mode
+
+def prepare_build_dir(specfem_root, build_dir):
+    """
+    Sets up a separate directory to build specfem in. configure and
+    change_simulation_type.pl write into the tree they run in, so the build
+    directory gets its own setup, DATA/Par_file, bin and obj, and links to
+    the rest of the source tree. mk_daint.sh runs there unchanged.
+    
+    :specfem_root: Path to the specfem installation.
+    :build_dir: Build directory. Anything already there is removed.
+    """
+    
+    shutil.rmtree(build_dir, ignore_errors=True)
+    mkdir_p(build_dir)
+    for name in os.listdir(specfem_root):
+        source = os.path.join(specfem_root, name)
+        dest   = os.path.join(build_dir, name)
+        if name in BUILD_DIR_SKIPPED or name in BUILD_DIR_FRESH:
+            continue
+        if name in BUILD_DIR_COPIED:
+            shutil.copytree(source, dest, symlinks=True)
+        else:
+            os.symlink(source, dest)
+    for name in BUILD_DIR_FRESH:
+        mkdir_p(os.path.join(build_dir, name))
+        
+    data_path = os.path.join(specfem_root, 'DATA')
+    for name in os.listdir(data_path):
+        source = os.path.join(data_path, name)
+        dest   = os.path.join(build_dir, 'DATA', name)
+        if name == 'Par_file':
+            shutil.copy2(source, dest)
+        else:
+            os.symlink(source, dest)
+
+class BuildMonitor(object):
+    """
+    Follows the output of one build as it runs. Works out which phase
+    (configure, compile, link) each line belongs to, times the phases, counts
+    compiled files and spots fatal errors, so a broken build can be stopped
+    straight away.
+    """
+    
+    # Checked in order, the first match decides the phase of a line.
+    PHASE_PATTERNS = [
+        ('configure', re.compile(r'^checking |^configure:|config\.status')),
+        ('link', re.compile(r'\s-o\s+\S*bin/x')),
+        ('compile', re.compile(r'\s-c\s'))]
+    
+    # Only failed make targets count: mk_daint.sh starts with a make clean,
+    # which says "*** No rule to make target" in a fresh build directory.
+    FATAL_PATTERN = re.compile(r'configure: error|: error:|\bError:|: ERROR'
+        r'|Fatal Error|make(\[\d+\])?: \*\*\* \[.*\] Error \d+')
+    
+    # Print progress every this many compiled files.
+    PROGRESS_INTERVAL = 50
+    
+    def __init__(self, variant):
+        self.variant    = variant
+        self.start      = time.time()
+        self.phases     = collections.OrderedDict()
+        self.n_compiled = 0
+        self.error      = None
+        
+    def feed(self, line):
+        """
+        Reads one line of build output. Returns True if it is a fatal error.
+        
+        :line: Line of build output.
+        """
+        
+        now = time.time()
+        for phase, pattern in self.PHASE_PATTERNS:
+            if pattern.search(line):
+                if phase not in self.phases:
+                    print_ylw('[%s] %s (%s)' % (self.variant, phase, 
+                        format_elapsed(now - self.start)))
+                    self.phases[phase] = [now, now]
+                self.phases[phase][1] = now
+                if phase == 'compile':
+                    self.n_compiled += 1
+                    if self.n_compiled % self.PROGRESS_INTERVAL == 0:
+                        print_ylw('[%s] compiled %d files (%s)' % (
+                            self.variant, self.n_compiled, 
+                            format_elapsed(now - self.start)))
+                break
+            
+        if self.error is None and self.FATAL_PATTERN.search(line):
+            self.error = line.strip()
+            return True
+        return False
+    
+    def report(self):
+        """
+        Prints the time spent in each phase.
+        """
+        
+        timings = ', '.join('%s %s' % (phase, format_elapsed(last - first)) 
+            for phase, (first, last) in self.phases.items())
+        print_blu('[%s] finished in %s (%s, %d files compiled).' % (
+            self.variant, format_elapsed(time.time() - self.start), 
+            timings or 'no phases seen', self.n_compiled))
+
+def _compile_variant(specfem_root, variant, make_jobs, abort):
+    """
+    Compiles one build variant in its build directory, streaming the output
+    to its log. The build is killed as soon as a fatal error shows up in the
+    output, or when another build sets abort. Returns the variant and the
+    exception raised, if any.
+    
+    :specfem_root: Path to the specfem installation.
+    :variant: Variant name.
+    :make_jobs: Parallel make jobs for this build.
+    :abort: threading.Event shared by the concurrent builds.
+    """
+    
+    compiler_suite, mode = parse_build_variant(variant)
+    build_dir = os.path.join(specfem_root, 'builds', variant)
+    log_file  = os.path.join(specfem_root, 'builds', variant + '.log')
+    monitor   = BuildMonitor(variant)
+    try:
+        prepare_build_dir(specfem_root, build_dir)
+        with open(log_file, 'w') as output:
+            
+            # Own process group, so make and the compilers go down with it.
+            proc = subprocess.Popen(['./mk_daint.sh', compiler_suite, mode, 
+                str(make_jobs)], stdout=subprocess.PIPE, 
+                stderr=subprocess.STDOUT, cwd=build_dir, preexec_fn=os.setsid)
+            for line in iter(proc.stdout.readline, b''):
+                output.write(line)
+                if monitor.feed(line) or abort.is_set():
+                    # The build may have exited already.
+                    try:
+                        os.killpg(proc.pid, signal.SIGTERM)
+                    except OSError as exception:
+                        if exception.errno != errno.ESRCH:
+                            raise
+                    break
+            proc.stdout.close()
+            retcode = proc.wait()
+            
+        if monitor.error is not None:
+            raise BuildError('Compilation of %s failed: %s\nSee %s' % (
+                variant, monitor.error, log_file))
+        if abort.is_set():
+            raise BuildError('Compilation of %s stopped, another build '
+                'failed.' % (variant))
+        if retcode != 0 or not os.path.exists(os.path.join(build_dir, 
+            BUILD_MODES[mode], 'xspecfem3D')):
+            raise BuildError('Compilation of %s failed (exit code %d), see %s'
+                % (variant, retcode, log_file))
+    except (BuildError, IOError, OSError) as exception:
+        abort.set()
+        return variant, exception
+    monitor.report()
+    return variant, None
+
+def store_build(specfem_root, variant, fingerprint, inputs):
+    """
+    Moves a finished build into the build cache, along with the Par_file it
+    was compiled with, and points the variant's named artifact directory
+    (specfem_root/artifacts/<variant>) at it.
+    
+    :specfem_root: Path to the specfem installation.
+    :variant: Variant name.
+    :fingerprint: Build fingerprint.
+    :inputs: Dictionary the fingerprint was computed from.
+    
+    Returns the path of the cached build.
+    """
+    
+    compiler_suite, mode = parse_build_variant(variant)
+    build_dir     = os.path.join(specfem_root, 'builds', variant)
+    artifact_path = os.path.join(specfem_root, 'build_cache', fingerprint)
+    
+    # Assemble the cache entry on the side and move it in place in one go.
+    temp_path = artifact_path + '.tmp'
+    shutil.rmtree(temp_path, ignore_errors=True)
+    shutil.rmtree(artifact_path, ignore_errors=True)
+    shutil.copytree(os.path.join(build_dir, BUILD_MODES[mode]), 
+        os.path.join(temp_path, 'bin'))
+    shutil.copy2(os.path.join(build_dir, 'DATA', 'Par_file'), temp_path)
+    with open(os.path.join(temp_path, 'fingerprint.json'), 'w') as file:
+        json.dump(dict(inputs, variant=variant), file, indent=2, 
+            sort_keys=True)
+    os.rename(temp_path, artifact_path)
+    link_artifact(specfem_root, variant, artifact_path)
+    
+    return artifact_path
+
+def link_artifact(specfem_root, variant, artifact_path):
+    """
+    Points specfem_root/artifacts/<variant> at a cached build.
+    
+    :specfem_root: Path to the specfem installation.
+    :variant: Variant name.
+    :artifact_path: Cached build.
+    """
+    
+    link_path = os.path.join(specfem_root, 'artifacts', variant)
+    temp_path = link_path + '.tmp'
+    mkdir_p(os.path.dirname(link_path))
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    os.symlink(artifact_path, temp_path)
+    os.rename(temp_path, link_path)
+
+def build_variants(specfem_root, variants, rebuild=False, make_jobs=4):
+    """
+    Compiles several build variants at once, each in its own build directory
+    under specfem_root/builds with its own log. Variants whose fingerprint is
+    already in the build cache aren't compiled again. Successful builds are
+    stored in specfem_root/build_cache/<fingerprint>, with
+    specfem_root/artifacts/<variant> pointing at them.
+    
+    :specfem_root: Path to the specfem installation.
+    :variants: List of variant names, <compiler_suite>.<mode>.
+    :rebuild: Build even if the cache has a matching build.
+    :make_jobs: Parallel make jobs for each build.
+    
+    Returns an OrderedDict mapping each variant to its cached build.
+    """
+    
+    artifacts = collections.OrderedDict()
+    to_build  = collections.OrderedDict()
+    for variant in variants:
+        compiler_suite, mode = parse_build_variant(variant)
+        fingerprint, inputs = build_fingerprint(specfem_root, compiler_suite,
+            mode)
+        artifact_path = os.path.join(specfem_root, 'build_cache', fingerprint)
+        if os.path.isdir(artifact_path) and not rebuild:
+            print_ylw('Reusing cached build of %s (%s)...' % (variant, 
+                fingerprint))
+            link_artifact(specfem_root, variant, artifact_path)
+            artifacts[variant] = artifact_path
+        else:
+            to_build[variant] = (fingerprint, inputs)
+            
+    if not to_build:
+        return artifacts
+    
+    print_ylw('Compiling %s...' % (', '.join(to_build.keys())))
+    mkdir_p(os.path.join(specfem_root, 'builds'))
+    abort = threading.Event()
+    pool  = thread_pool(len(to_build))
+    try:
+        results = pool.map(lambda variant: _compile_variant(specfem_root, 
+            variant, make_jobs, abort), to_build.keys())
+    finally:
+        pool.close()
+        pool.join()
+    
+    # Never cache a broken build.
+    failures = [exception for variant, exception in results if exception]
+    if failures:
+        raise BuildError('\n'.join(str(exception) for exception in failures))
+    for variant, (fingerprint, inputs) in to_build.items():
+        artifacts[variant] = store_build(specfem_root, variant, fingerprint,
+            inputs)
+        
+    return artifacts
+
+def build_specfem(specfem_root, compiler_suite, mode, rebuild=False, 
+    make_jobs=4):
+    """
+    Compiles one build variant, see build_variants. Returns the path of the
+    cached build.
+    
+    :specfem_root: Path to the specfem installation.
+    :compiler_suite: Compiler suite passed to mk_daint.sh.
+    :mode: 'forward' or 'adjoint'.
+    :rebuild: Build even if the cache has a matching build.
+    :make_jobs: Parallel make jobs.
+    """
+    
+    variant = '%s.%s' % (compiler_suite, mode)
+    return build_variants(specfem_root, [variant], rebuild, make_jobs)[variant]
@@ -0,0 +1,68 @@
+"""
+Deleting run output, with retention policies.
+"""
+
+import os, stat
+import collections
+import fnmatch
+
+# Seismograms as specfem writes them (ascii, sac or adios).
+SEISMOGRAM_PATTERNS = ['*.sem?', '*.ascii', '*.sac', '*.sacan', 
+    'seismograms*']
+
+# What --clean keeps in each event's OUTPUT_FILES and DATABASES_MPI, by
+# name. Everything else goes: wavefield dumps, absorbing boundary files,
+# mesh links and the copies of the mesher output.
+RETENTION_POLICIES = collections.OrderedDict([
+    ('products',    ['*kernel*', 'output_solver.txt'] + SEISMOGRAM_PATTERNS),
+    ('seismograms', ['output_solver.txt'] + SEISMOGRAM_PATTERNS),
+    ('nothing',     []),
+])
+
+# The per-event directories --clean works on.
+CLEAN_DIRECTORIES = ['OUTPUT_FILES', 'DATABASES_MPI']
+
+def remove_tree(path, cache, keep=(), dry_run=False):
+    """
+    Deletes the contents of a directory, except the top level entries whose
+    names match one of the keep patterns, and the directory itself if
+    nothing was kept. Bytes count as reclaimed only for files with no other
+    hard links. Directories are listed, and entries lstat'ed, through the
+    stage's DirCache, which is kept up to date.
+    
+    :path: Directory.
+    :cache: DirCache.
+    :keep: fnmatch patterns of entries to keep.
+    :dry_run: Only count what would be deleted.
+    
+    Returns a dictionary with the number of files, links and directories
+    deleted, the bytes reclaimed and whether anything was kept.
+    """
+    
+    counts = {'files': 0, 'links': 0, 'dirs': 0, 'bytes': 0, 'kept': False}
+    for name in cache.listdir(path):
+        if any(fnmatch.fnmatch(name, pattern) for pattern in keep):
+            counts['kept'] = True
+            continue
+        entry_path = os.path.join(path, name)
+        info = cache.lstat(entry_path)
+        if stat.S_ISDIR(info.st_mode):
+            sub_counts = remove_tree(entry_path, cache, dry_run=dry_run)
+            for key in ['files', 'links', 'dirs', 'bytes']:
+                counts[key] += sub_counts[key]
+            continue
+        if stat.S_ISLNK(info.st_mode):
+            counts['links'] += 1
+        else:
+            counts['files'] += 1
+            if info.st_nlink == 1:
+                counts['bytes'] += info.st_size
+        if not dry_run:
+            os.remove(entry_path)
+            cache.remove(entry_path)
+    if not counts['kept']:
+        counts['dirs'] += 1
+        if not dry_run:
+            os.rmdir(path)
+            cache.remove(path)
+    return counts
@@ -0,0 +1,249 @@
+"""
+The setup_specfem_lasif.py command line: parses the flags into a Project and
+runs one stage of it.
+"""
+
+import argparse
+
+from specfem_lasif.clean import RETENTION_POLICIES
+from specfem_lasif.plan import BUNDLE_MODES
+from specfem_lasif.project import Project, DEFAULT_OPTIONS
+from specfem_lasif.staging import STAGING_METHODS, LINK_MODES
+from specfem_lasif.util import mkdir_p, print_blu
+
+# Stages, in the order a flag is looked for when several are given.
+COMMANDS = ['pipeline', 'setup_run', 'stage_worker', 'merge_staging',
+    'status', 'schedule', 'sizing', 'clean', 'build', 'prepare_solve',
+    'submit_mesher', 'submit_solver']
+
+def build_parser():
+    """
+    The command line parser.
+    """
+
+    parser = argparse.ArgumentParser(description='Assists in the setup of' 
+        'specfem3d_globe on Piz Daint')
+    parser.add_argument('-f', type=str, help='Simulation driver parameter file.', 
+        required=True, metavar='parameter_file_name', dest='filename')
+    parser.add_argument('--setup_run', action='store_true', 
+        help='Setup the directory tree on scratch for one iteration (or several, \
+            see --iterations). Requires a param file.')
+    parser.add_argument('--iterations', type=str, default=None,
+        help='Comma separated iterations, overriding iteration_name in the \
+            parameter file (which can also be a comma separated list). \
+            setup_run stages them all at once, with one build; the other stages \
+            work on the first.', metavar='iterations')
+    parser.add_argument('--prepare_solve', action='store_true', 
+        help='Symbolically links the mesh files to all forward directories.')
+    parser.add_argument('--submit_mesher', action='store_true', 
+        help='Runs the mesher in the "mesh" directory.')
+    parser.add_argument('--submit_solver', action='store_true',
+        help='Submit the job array script for the current iteration.')
+    parser.add_argument('--schedule', action='store_true',
+        help='Estimate the relative cost of each event from its staged DATA \
+            (record length, stations, adjoint sources) and write the job array \
+            indices ordered most expensive first.')
+    parser.add_argument('--cost_order', action='store_true',
+        help='Submit solver indices most expensive first, in chunks of similar \
+            cost (of at most --max_array_size indices).')
+    parser.add_argument('--seconds_per_cost', type=float, default=None,
+        help='Solver wall time per unit of estimated cost (a minute of record \
+            length of a forward run). With --cost_order, each chunk asks for \
+            the time of its most expensive event, plus a margin.', 
+        metavar='seconds')
+    parser.add_argument('--bundle', type=str, default='none', 
+        choices=BUNDLE_MODES,
+        help='Write the inputs shared by all events (shared), or those and each \
+            event\'s own (events), as tar bundles in <iteration>/bundles rather \
+            than as files in every event directory. Jobs unpack them with \
+            unpack_bundle.sh (default: none).')
+    parser.add_argument('--sizing', action='store_true',
+        help='Print the ranks, nodes, memory and time limits the mesher and \
+            solver need according to the Par_file.')
+    parser.add_argument('--auto_size', action='store_true',
+        help='Submit the mesher and solver with #SBATCH headers sized from the \
+            Par_file (see --sizing) instead of the ones in their scripts.')
+    parser.add_argument('--cores_per_node', type=int, default=12,
+        help='CPU cores per node, for sizing (default: 12).', metavar='N')
+    parser.add_argument('--gpus_per_node', type=int, default=1,
+        help='GPUs per node, for sizing (default: 1).', metavar='N')
+    parser.add_argument('--node_memory', type=float, default=64,
+        help='Memory per node in GB, for sizing (default: 64).', metavar='GB')
+    parser.add_argument('--status', action='store_true',
+        help='Show which solver job array indices are done, active, failed or \
+            not submitted, from one sacct query and the solver output of each \
+            event. Index i is the i-th event in sorted order.')
+    parser.add_argument('--resubmit_failed', action='store_true',
+        help='With --status, submit the failed indices again as one compact \
+            job array.')
+    parser.add_argument('--sacct', type=str, default='sacct',
+        help='Command used to query job states (default: sacct).')
+    parser.add_argument('--status_ttl', type=int, default=60,
+        help='Seconds a --status query of the job states is reused for \
+            (default: 60).', metavar='seconds')
+    parser.add_argument('--clean', action='store_true',
+        help='Delete the OUTPUT_FILES and DATABASES_MPI of every event of the \
+            current iteration, except what --retention keeps. Use --dry_run to \
+            see how much would be reclaimed first.')
+    parser.add_argument('--retention', choices=RETENTION_POLICIES.keys(), 
+        default='products',
+        help='What --clean keeps: kernels, seismograms and solver logs \
+            (products), seismograms and solver logs, or nothing (default: \
+            products).')
+    parser.add_argument('--remove_iteration', action='store_true',
+        help='With --clean, delete the whole iteration directory, mesh included.')
+    parser.add_argument('--pipeline', action='store_true',
+        help='Set up the run, then submit the mesher, prepare_solve and the \
+            solver as jobs that each start when the previous one succeeds. \
+            Submits every event unless -fj and -lj are given.')
+    parser.add_argument('--distribute', type=int, default=0,
+        help='With --setup_run (or --pipeline), stage the events with N \
+        workers, submitted as a job array, instead of here. The build, what \
+        the events share and the mesh directory are still done here; the \
+        events are queued in \
+        <project>/queues, and a job that starts when the workers end merges \
+        and checks what they staged (default: 0, stage here).', metavar='N')
+    parser.add_argument('--local_workers', action='store_true',
+        help='With --distribute, run the workers as processes here rather \
+        than as jobs, and merge once they are done.')
+    parser.add_argument('--queue_chunk', type=int, default=50,
+        help='Events per unit of work in a staging queue (default: 50).',
+        metavar='N')
+    parser.add_argument('--queue_lease', type=int, default=3600,
+        help='Seconds after which a unit a staging worker claimed but did \
+        not finish is given to another worker (default: 3600).',
+        metavar='seconds')
+    parser.add_argument('--worker_time', type=str, default='01:00:00',
+        help='Time limit of staging worker jobs (default: 01:00:00).',
+        metavar='HH:MM:SS')
+    parser.add_argument('--stage_worker', action='store_true',
+        help='Claim and stage units of the staging queue of the iterations \
+        until none are left. This is what --distribute submits.')
+    parser.add_argument('--merge_staging', action='store_true',
+        help='Merge what the staging workers did into the manifests and \
+        state, and check that everything in the queue was staged. Units \
+        that failed go back in the queue for more workers.')
+    parser.add_argument('--prepare_time', type=str, default='00:30:00',
+        help='Time limit of the prepare_solve job submitted by --pipeline \
+            (default: 00:30:00).', metavar='HH:MM:SS')
+    parser.add_argument('-fj', type=str, help='First index in job array to submit',
+        metavar='first_job', dest='first_job')
+    parser.add_argument('-lj', type=str, help='Last index in job array to submit',
+        metavar='last_job', dest='last_job')
+    parser.add_argument('-j', '--jobs', type=int, default=8, 
+        help='Number of concurrent file copies when staging (default: 8).', 
+        metavar='N', dest='jobs')
+    parser.add_argument('--bin_mode', choices=STAGING_METHODS, default='copy',
+        help='How to place the compiled binaries in each event directory. The \
+            link modes keep one copy per iteration under the project scratch \
+            directory and fall back to copying if linking fails.')
+    parser.add_argument('--topo_mode', choices=STAGING_METHODS, default='copy',
+        help='How to place the topography in the mesh directory. The link modes \
+            link to the files in the specfem DATA/topo_bathy directory instead of \
+            copying them, falling back to copying if linking fails.')
+    parser.add_argument('--build', action='store_true',
+        help='Compile the build variants given by --variants, each in its own \
+            build directory, without setting up a run.')
+    parser.add_argument('--variants', type=str, default=None,
+        help='Comma separated build variants for --build, each \
+            <compiler_suite>.<forward|adjoint> (default: the compiler suite in \
+            the parameter file, adjoint).', metavar='variants')
+    parser.add_argument('--variant', type=str, default=None,
+        help='Build variant setup_run stages binaries from (default: the \
+            compiler suite in the parameter file, adjoint).', metavar='variant')
+    parser.add_argument('--make_jobs', type=int, default=4,
+        help='Parallel make jobs per build (default: 4).', metavar='N')
+    parser.add_argument('--link_mode', choices=LINK_MODES, default='files',
+        help='How prepare_solve links the mesh into the events: one link per \
+            mesh file, or one link to the whole DATABASES_MPI directory (only \
+            for forward runs that don\'t save the forward wavefield).')
+    parser.add_argument('--rebuild', action='store_true',
+        help='Compile specfem even if the build cache has a build with the same \
+            compiler suite, Par_file and source tree.')
+    parser.add_argument('--force', action='store_true',
+        help='Restage every file, even those the staging manifest says are \
+            unchanged.')
+    parser.add_argument('--checksum', action='store_true',
+        help='Compare md5 sums as well as size and mtime when deciding whether a \
+            staged file is unchanged.')
+    parser.add_argument('--sbatch', type=str, default='sbatch',
+        help='Command used to submit jobs (default: sbatch). May include options, \
+            e.g. "sbatch --parsable", or be a local stand-in script.')
+    parser.add_argument('--max_array_size', type=int, default=1000,
+        help='slurm\'s MaxArraySize: solver indices are submitted as array \
+            jobs of at most N indices, and those at or above N from 0, with \
+            the offset exported to the job as ARRAY_INDEX_OFFSET, which the \
+            job script has to add back (default: 1000).', metavar='N')
+    parser.add_argument('--submit_workers', type=int, default=4,
+        help='Number of concurrent sbatch calls (default: 4).', metavar='N')
+    parser.add_argument('--sbatch_retries', type=int, default=3,
+        help='Retries with backoff when sbatch fails transiently, e.g. on a busy \
+            controller or a submit limit (default: 3).', metavar='N')
+    parser.add_argument('--dry_run', action='store_true',
+        help='Only print what setup_run or prepare_solve would do: directories, \
+            builds, copies, links, bytes and a projected time from earlier \
+            --profile reports.')
+    parser.add_argument('--profile', action='store_true',
+        help='Record time, files, bytes and filesystem operations per stage and \
+            per event, and write them as json to the profiles directory next to \
+            the logs.')
+
+    return parser
+
+def main(argv=None):
+    """
+    Runs the stage given on the command line.
+
+    :argv: Command line arguments (default: sys.argv[1:]).
+    """
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.submit_solver and args.first_job is None and args.last_job is None:
+        parser.error('Submitting the solver required -fj and -lj arguments.')
+    if args.pipeline and (args.first_job is None) != (args.last_job is None):
+        parser.error('--pipeline takes both -fj and -lj, or neither.')
+
+    options = dict((name, getattr(args, name)) for name in DEFAULT_OPTIONS)
+    options['variants'] = args.variants.split(',') if args.variants else None
+    project = Project(args.filename, args.iterations.split(',') if
+        args.iterations else None, **options)
+    if len(project.iterations) > 1 and not (args.setup_run or
+        args.stage_worker or args.merge_staging):
+        parser.error('Only --setup_run (and its --stage_worker and '
+            '--merge_staging) works on several iterations at once.')
+    iteration = project.iteration()
+    if not args.dry_run:
+        mkdir_p(iteration.path)
+
+    command = next((name for name in COMMANDS if getattr(args, name)), None)
+    try:
+        if command == 'pipeline':
+            iteration.pipeline(args.first_job, args.last_job)
+        elif command == 'setup_run':
+            project.setup_run()
+        elif command == 'stage_worker':
+            project.stage_worker()
+        elif command == 'merge_staging':
+            project.merge_staging()
+        elif command == 'status':
+            iteration.status(args.resubmit_failed)
+        elif command == 'schedule':
+            iteration.schedule()
+        elif command == 'sizing':
+            iteration.sizing()
+        elif command == 'clean':
+            iteration.clean(args.retention, args.remove_iteration)
+        elif command == 'build':
+            project.build()
+        elif command == 'prepare_solve':
+            iteration.prepare_solve()
+        elif command == 'submit_mesher':
+            iteration.submit_mesher()
+        elif command == 'submit_solver':
+            iteration.submit_solver(args.first_job, args.last_job)
+    finally:
+        if command is not None:
+            profile_path = project.write_profile(command)
+            if profile_path:
+                print_blu('Profile written to ' + profile_path)
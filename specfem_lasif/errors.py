@@ -0,0 +1,21 @@
+"""
+Exceptions raised by the stages.
+"""
+
+class ParameterError(Exception):
+    pass
+
+class PathError(Exception):
+    pass
+
+class MesherNotRunError(Exception):
+    pass
+
+class StagingError(Exception):
+    pass
+
+class BuildError(Exception):
+    pass
+
+class SubmissionError(Exception):
+    pass
@@ -0,0 +1,144 @@
+"""
+Reading a LASIF project: the events of an iteration and their input files.
+"""
+
+import os
+import collections
+import json
+import re
+
+from specfem_lasif.errors import PathError
+from specfem_lasif.util import mkdir_p, list_subdirectories
+
+def read_iteration_events(iteration_xml_path, cache_path=None, 
+    update_cache=True):
+    """
+    Streams through the iteration xml file and returns, for every event, a
+    dictionary with its name, weight and number of stations. Elements are
+    cleared as soon as an event has been read, so memory use doesn't grow with
+    the number of stations and windows in the file.
+    
+    :iteration_xml_path: Path the xml file driving the requested iteration.
+    :cache_path: Optional json file to cache the result in. The cache is
+        reused for as long as the xml file's mtime and size don't change.
+    :update_cache: Whether to write the cache when it can't be reused.
+    """
+    
+    info = os.stat(iteration_xml_path)
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, 'r') as file:
+            cache = json.load(file)
+        if cache['xml_path'] == iteration_xml_path and \
+            cache['xml_mtime'] == info.st_mtime and \
+            cache['xml_size'] == info.st_size:
+            return cache['events']
+    
+    # Only parse the xml when the cache can't be used.
+    try:
+        import xml.etree.cElementTree as ET
+    except ImportError:
+        import xml.etree.ElementTree as ET
+    
+    events     = []
+    n_stations = 0
+    context    = ET.iterparse(iteration_xml_path, events=('start', 'end'))
+    _, root    = next(context)
+    for action, element in context:
+        if action != 'end':
+            continue
+        if element.tag == 'station':
+            n_stations += 1
+            element.clear()
+        elif element.tag == 'event':
+            weight = element.findtext('event_weight')
+            events.append({'name': element.findtext('event_name'),
+                'weight': float(weight) if weight else None,
+                'n_stations': n_stations})
+            n_stations = 0
+            root.clear()
+            
+    if cache_path is not None and update_cache:
+        mkdir_p(os.path.dirname(cache_path))
+        temp_path = cache_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({'xml_path': iteration_xml_path, 
+                'xml_mtime': info.st_mtime, 'xml_size': info.st_size, 
+                'events': events}, file)
+        os.rename(temp_path, cache_path)
+            
+    return events
+
+def find_event_names(iteration_xml_path, cache_path=None, 
+    update_cache=True):
+    """
+    Quickly parses the iteration xml file and extracts all the event names.
+    
+    :iteration_xml_path: Path the xml file driving the requested iteration.
+    :cache_path: Optional json cache, see read_iteration_events.
+    :update_cache: Whether to write the cache, see read_iteration_events.
+    """
+    
+    return [event['name'] for event in 
+        read_iteration_events(iteration_xml_path, cache_path, update_cache)]
+
+# LASIF names its input file folders
+# <date>__input_files___ITERATION_<iteration>__<type>__EVENT_<event>.
+LASIF_OUTPUT_PATTERN = re.compile(
+    r'ITERATION_(?P<iteration>.+?)__(?P<type>[^_].*?)__EVENT_(?P<event>.+)$')
+
+# Cached OUTPUT indices, keyed by path. Each holds the directory mtime it was
+# built at, so a new LASIF output folder invalidates it.
+_lasif_output_index = {}
+
+def index_lasif_output(lasif_output):
+    """
+    Parses the LASIF OUTPUT folder names in one pass and returns a dictionary
+    mapping (iteration, event) to the folder path. If an event's input files
+    were generated more than once, the newest folder (by its date prefix)
+    wins. The index is cached until the OUTPUT directory changes.
+    
+    :lasif_output: Path to the LASIF OUTPUT directory.
+    """
+    
+    mtime  = os.stat(lasif_output).st_mtime
+    cached = _lasif_output_index.get(lasif_output)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    
+    index = {}
+    for name in sorted(list_subdirectories(lasif_output)):
+        match = LASIF_OUTPUT_PATTERN.search(name)
+        if match is None:
+            continue
+        key = (match.group('iteration'), match.group('event'))
+        index[key] = os.path.join(lasif_output, name)
+        
+    _lasif_output_index[lasif_output] = (mtime, index)
+    return index
+
+def find_event_input_dirs(lasif_path, iteration_name, event_list):
+    """
+    Resolves the LASIF input file folder of every event in an iteration.
+    Raises a PathError naming the events that don't have one.
+    
+    :lasif_path: Path to the LASIF project.
+    :iteration_name: Iteration name.
+    :event_list: Events in the iteration.
+    
+    Returns an OrderedDict mapping event to folder.
+    """
+    
+    index   = index_lasif_output(os.path.join(lasif_path, 'OUTPUT'))
+    folders = collections.OrderedDict()
+    missing = []
+    for event in event_list:
+        folder = index.get((iteration_name, event))
+        if folder is None:
+            missing.append(event)
+        else:
+            folders[event] = folder
+            
+    if missing:
+        raise PathError('No LASIF input files for iteration %s and events: %s'
+            % (iteration_name, ', '.join(missing)))
+    return folders
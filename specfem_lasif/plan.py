@@ -0,0 +1,516 @@
+"""
+Staging plans: everything a stage does, worked out up front, so that it can be
+estimated, resumed or executed.
+"""
+
+import os
+import collections
+import json
+
+from specfem_lasif.build import build_specfem, parse_build_variant
+from specfem_lasif.errors import PathError
+from specfem_lasif.profiler import Profiler
+from specfem_lasif.staging import DirCache, CopySummary, add_copy_task, \
+    copy_files, link_mesh_directory, safe_sym_link, setup_dir_tree, \
+    stage_canonical_binaries, bundle_members, write_bundle
+from specfem_lasif.util import mkdir_p, format_elapsed, print_ylw, \
+    thread_pool
+
+# A single operation of a staging plan. What source, dest and method mean
+# depends on the kind of operation, see Plan.
+PlanOperation = collections.namedtuple('PlanOperation', ['kind', 'event', 
+    'source', 'dest', 'method'])
+
+# The order plans are executed in. The build comes first so that a broken
+# build stops everything before scratch is touched, then all directories are
+# made, and then files are copied and linked. Bundles are written before the
+# copies, because events are journaled as done with their copies.
+PLAN_PHASES = ['build', 'mkdir', 'canonical', 'link_dir', 'link_files', 
+    'bundle', 'copy']
+
+# What goes into bundles instead of the event directories: nothing, the
+# inputs every event shares (binaries and the compiled Par_file, once per
+# iteration), or those and each event's own inputs (one bundle per event).
+BUNDLE_MODES = ['none', 'shared', 'events']
+
+class Plan(object):
+    """
+    Everything a stage is going to do, worked out before any of it is done:
+    
+    build:      compile the variant method of the specfem installation source
+                unless dest (its cached build) already exists.
+    mkdir:      make dest, or the event directory tree at dest if method is
+                'tree'.
+    canonical:  copy the binaries in source to the canonical directory dest.
+    link_dir:   replace the event's dest directory by a link to source.
+    link_files: link every file in source into dest.
+    bundle:     write the archive dest from source, a list of (file or
+                directory, name in the archive).
+    copy:       place the file source in the directory dest (method is one of
+                STAGING_METHODS), or every file in the directory source when
+                kind is 'copy_dir'.
+                
+    A plan can be estimated (execute nothing, count operations and bytes) or
+    executed with execute_plan. Planning and execution share one DirCache.
+    """
+    
+    def __init__(self, name, iterations, step):
+        """
+        :name: Stage the plan is for, e.g. 'setup_run'.
+        :iterations: Names of the iterations it covers.
+        :step: State store step an event has done once its operations are
+            done, e.g. 'staged'.
+        """
+        
+        self.name       = name
+        self.iterations = list(iterations)
+        self.step       = step
+        self.units      = {}
+        self.details    = {}
+        self.operations = collections.OrderedDict((phase, []) for phase in 
+            PLAN_PHASES)
+        self.cache      = DirCache()
+        self.hints      = {}
+        
+    def add(self, kind, event=None, source=None, dest=None, method=None):
+        """
+        Adds an operation to the plan.
+        """
+        
+        phase = 'copy' if kind == 'copy_dir' else kind
+        self.operations[phase].append(PlanOperation(kind, event, source, dest,
+            method))
+            
+    def add_copy_dir(self, event, source, dest, method='copy', hint=None):
+        """
+        Adds a copy of every file in a directory. The directory is listed when
+        the plan is executed, so it may be the product of an earlier phase.
+        
+        :event: Event the copies belong to.
+        :source: Source directory.
+        :dest: Destination directory.
+        :method: One of STAGING_METHODS.
+        :hint: Directory that looks like source will, to estimate the plan
+            before source exists.
+        """
+        
+        self.add('copy_dir', event, source, dest, method)
+        if hint is not None:
+            self.hints[source] = hint
+            
+    def add_bundle(self, event, dest, members):
+        """
+        Adds an archive of some files and directories. Directories are listed
+        when the plan is executed, like for add_copy_dir.
+        
+        :event: Event the bundle belongs to.
+        :dest: Bundle file.
+        :members: List of (file or directory, name in the bundle).
+        """
+        
+        self.add('bundle', event, members, dest)
+        
+    def label(self, iteration, event):
+        """
+        Label of an event of an iteration in the plan: the event name in a
+        plan for one iteration, <iteration>/<event> otherwise. Labels of
+        things shared between iterations, like 'shared', aren't made here.
+        
+        :iteration: Iteration name.
+        :event: Event name (or 'mesh', ...).
+        """
+        
+        label = event if len(self.iterations) == 1 else '%s/%s' % (
+            iteration, event)
+        self.units[label] = (iteration, event)
+        return label
+    
+    def unit(self, label):
+        """
+        The (iteration, event) a label stands for; the iteration is None for
+        things shared between iterations.
+        
+        :label: Label.
+        """
+        
+        return self.units.get(label, (None, label))
+        
+    def drop_events(self, events):
+        """
+        Removes the operations of some events from the plan, e.g. the ones
+        that a previous run already finished.
+        
+        :events: Event names.
+        """
+        
+        events = set(events)
+        for phase, operations in self.operations.items():
+            self.operations[phase] = [operation for operation in operations 
+                if operation.event not in events]
+        
+    def events(self):
+        """
+        Names of the events the plan has operations for, in plan order.
+        """
+        
+        events = collections.OrderedDict()
+        for operations in self.operations.values():
+            for operation in operations:
+                events[operation.event] = True
+        return list(events)
+        
+    def listing(self, path):
+        """
+        Lists a directory, once per plan.
+        
+        :path: Directory to list.
+        """
+        
+        return self.cache.listdir(path)
+    
+    def copy_tasks(self):
+        """
+        Expands the copy phase into an OrderedDict of CopyTask, keyed by
+        destination file, in plan order (so later copies to the same
+        destination win).
+        """
+        
+        tasks = collections.OrderedDict()
+        for operation in self.operations['copy']:
+            if operation.kind == 'copy':
+                add_copy_task(tasks, operation.event, operation.source, 
+                    operation.dest, operation.method)
+                continue
+            for file in self.listing(operation.source):
+                add_copy_task(tasks, operation.event, os.path.join(
+                    operation.source, file), operation.dest, operation.method)
+        return tasks
+    
+    def estimate(self):
+        """
+        Counts what the plan would do, without doing it. Returns a dictionary
+        with the number of directories, builds, copies, links and the bytes
+        copied. File sizes are looked up once per source file; sources that
+        don't exist yet are estimated from their hint directory.
+        """
+        
+        counts = collections.OrderedDict([('mkdir', 0), ('build', 0), 
+            ('cached_build', 0), ('copy', 0), ('link', 0), ('bundle', 0), 
+            ('bytes', 0)])
+        for operation in self.operations['build']:
+            key = 'cached_build' if os.path.isdir(operation.dest) else 'build'
+            counts[key] += 1
+        for operation in self.operations['mkdir']:
+            counts['mkdir'] += 6 if operation.method == 'tree' else 1
+        counts['link'] += len(self.operations['link_dir'])
+        for operation in self.operations['link_files']:
+            counts['link'] += len(self.listing(operation.source))
+            
+        def size(path):
+            if not self.cache.lexists(path) or self.cache.isdir(path):
+                return 0
+            return self.cache.stat(path).st_size
+        
+        for operation in self.operations['canonical']:
+            for file in self._estimate_listing(operation.source):
+                counts['copy']  += 1
+                counts['bytes'] += size(os.path.join(self.hints.get(
+                    operation.source, operation.source), file))
+        # Keyed by destination file like copy_tasks, so overwritten copies
+        # are only counted once.
+        copies = collections.OrderedDict()
+        for operation in self.operations['copy']:
+            if operation.kind == 'copy':
+                files = [(operation.source, operation.source)]
+            else:
+                source = self.hints.get(operation.source, operation.source)
+                files  = [(os.path.join(operation.source, file), 
+                    os.path.join(source, file)) for file in 
+                    self._estimate_listing(operation.source)]
+            for file, path in files:
+                dest = os.path.join(operation.dest, os.path.basename(file))
+                copies[dest] = (path, operation.method)
+        for path, method in copies.values():
+            if method == 'copy':
+                counts['copy']  += 1
+                counts['bytes'] += size(path)
+            else:
+                counts['link'] += 1
+        for operation in self.operations['bundle']:
+            counts['bundle'] += 1
+            for source, _ in operation.source:
+                if self.cache.isdir(source) or source in self.hints:
+                    directory = source if self.cache.isdir(source) else \
+                        self.hints[source]
+                    counts['bytes'] += sum(size(os.path.join(directory, 
+                        file)) for file in self._estimate_listing(source))
+                else:
+                    counts['bytes'] += size(source)
+        return counts
+    
+    def _estimate_listing(self, path):
+        """
+        Lists a directory, or its hint if it doesn't exist yet.
+        
+        :path: Directory to list.
+        """
+        
+        if self.cache.isdir(path):
+            return self.listing(path)
+        hint = self.hints.get(path)
+        if hint is not None and self.cache.isdir(hint):
+            return self.listing(hint)
+        return []
+
+def estimate_plan_time(counts, profiles_path, command, n_reports=5):
+    """
+    Projects how long a plan will take from the most recent profile reports
+    of the same command: the average time per mkdir, per copy or link and per
+    compile seen there. Returns the projected time in seconds and the number
+    of reports used, or None if there are no reports.
+    
+    :counts: Plan.estimate() of the plan.
+    :profiles_path: Directory with --profile reports.
+    :command: Command the plan is for, e.g. 'setup_run'.
+    :n_reports: Number of recent reports to use.
+    """
+    
+    if not os.path.isdir(profiles_path):
+        return None, 0
+    names = sorted(name for name in os.listdir(profiles_path) 
+        if '_%s_' % (command) in name and name.endswith('.json'))
+    reports = []
+    for name in names[-n_reports:]:
+        with open(os.path.join(profiles_path, name), 'r') as file:
+            reports.append(json.load(file))
+    if not reports:
+        return None, 0
+    
+    def rate(stage, operations):
+        times, counts = 0.0, 0
+        for report in reports:
+            stats = report['stages'].get(stage)
+            if stats is None:
+                continue
+            n = sum(stats['operations'].get(op, 0) for op in operations)
+            if n:
+                times  += stats['wall_time']
+                counts += n
+        return times / counts if counts else 0.0
+    
+    projected = counts['mkdir'] * rate('mkdir', ['mkdir']) + \
+        (counts['copy'] + counts['link']) * rate('stage_files', 
+            ['copy', 'link', 'skip', 'symlink']) + \
+        counts['build'] * rate('build', ['compile'])
+    return projected, len(reports)
+
+def print_plan(plan, profiles_path):
+    """
+    Prints a dry run estimate of a plan.
+    
+    :plan: Plan.
+    :profiles_path: Directory with --profile reports, for the projected time.
+    """
+    
+    counts = plan.estimate()
+    print_ylw('Plan for %s:' % (plan.name))
+    for operation in plan.operations['build']:
+        state = 'cached' if os.path.isdir(operation.dest) else 'compile'
+        print '  build      : %s (%s)' % (operation.method, state)
+    print '  mkdir      : %d directories' % (counts['mkdir'])
+    print '  copy       : %d files, %.1f MB (before skipping unchanged files)' \
+        % (counts['copy'], counts['bytes'] / 1024.0 ** 2)
+    print '  link       : %d links' % (counts['link'])
+    if counts['bundle']:
+        print '  bundle     : %d bundles' % (counts['bundle'])
+    projected, n_reports = estimate_plan_time(counts, profiles_path, 
+        plan.name)
+    if projected is None:
+        print '  projected  : unknown, no earlier --profile reports'
+    else:
+        print '  projected  : %s (from %d earlier --profile reports)' % (
+            format_elapsed(projected), n_reports)
+
+def _run_link_operation(operation, plan):
+    """
+    Plan executor worker for the link phases. Returns the operation, the
+    number of links made and the exception raised, if any.
+    
+    :operation: PlanOperation of kind link_dir or link_files.
+    :plan: The plan, for its directory listings.
+    """
+    
+    try:
+        if operation.kind == 'link_dir':
+            return operation, link_mesh_directory(operation.source, 
+                operation.dest), None
+        files = plan.listing(operation.source)
+        for file in files:
+            safe_sym_link(os.path.join(operation.source, file), 
+                os.path.join(operation.dest, file), plan.cache)
+    except (PathError, IOError, OSError) as exception:
+        return operation, 0, exception
+    return operation, len(files), None
+
+def _run_bundle_operation(operation, plan, manifest=None):
+    """
+    Plan executor worker for the bundle phase. Returns the operation, the
+    member signature, the bytes written (None if the bundle was current) and
+    the exception raised, if any.
+    
+    :operation: PlanOperation of kind bundle.
+    :plan: The plan, for its directory listings.
+    :manifest: Optional StagingManifest, to skip unchanged bundles.
+    """
+    
+    import tarfile
+    try:
+        members = bundle_members(operation.source, plan.cache)
+        if manifest is not None and manifest.bundle_is_current(
+            operation.dest, members):
+            return operation, members, None, None
+        return operation, members, write_bundle(operation.dest, members), None
+    except (tarfile.TarError, IOError, OSError) as exception:
+        return operation, None, None, exception
+
+# Number of events whose copies go through the copy engine together. Events
+# are journaled as done, and the manifest saved, after each batch.
+STAGING_BATCH_EVENTS = 64
+
+def execute_plan(plan, jobs=1, manifest=None, profiler=None, 
+    make_jobs=4, rebuild=False, store=None):
+    """
+    Executes a plan phase by phase (see PLAN_PHASES). Links are made per
+    event on a thread pool, and copies go through the copy engine in batches
+    of STAGING_BATCH_EVENTS events, sorted by source within a batch so copies
+    of the same file run back to back.
+    
+    :plan: Plan.
+    :jobs: Maximum number of concurrent operations.
+    :manifest: Optional StagingManifest for the copy phase.
+    :profiler: Optional Profiler.
+    :make_jobs: Parallel make jobs for builds.
+    :rebuild: Build even if the cache has a matching build.
+    :store: Optional StateStore. Builds are recorded in it as they finish,
+        and the events that are completely done (no failures) as having done
+        the plan's step (with the plan's detail for their iteration), after
+        each batch.
+    
+    Returns a CopySummary covering the link and copy phases.
+    """
+    
+    profiler = profiler or Profiler(False)
+    summary  = CopySummary()
+    
+    if plan.operations['build']:
+        with profiler.stage('build'):
+            for operation in plan.operations['build']:
+                if rebuild or not os.path.isdir(operation.dest):
+                    profiler.count('compile')
+                compiler_suite, mode = parse_build_variant(operation.method)
+                build_specfem(operation.source, compiler_suite, mode, rebuild, 
+                    make_jobs)
+                plan.cache.forget(os.path.dirname(operation.dest))
+                for iteration in plan.iterations if store else []:
+                    store.mark(iteration, ['*'], 'built', 
+                        os.path.basename(operation.dest))
+                
+    if plan.operations['mkdir']:
+        with profiler.stage('mkdir'):
+            for operation in plan.operations['mkdir']:
+                if operation.method == 'tree':
+                    setup_dir_tree(operation.dest)
+                    profiler.count('mkdir', 6)
+                else:
+                    mkdir_p(operation.dest)
+                    profiler.count('mkdir')
+                
+    if plan.operations['canonical']:
+        with profiler.stage('stage_files'):
+            for operation in plan.operations['canonical']:
+                stage_canonical_binaries(operation.source, operation.dest)
+                plan.cache.forget(operation.dest)
+    
+    links = plan.operations['link_dir'] + plan.operations['link_files']
+    if links:
+        with profiler.stage('link_mesh'):
+            pool = thread_pool(jobs)
+            try:
+                for operation, n, exception in pool.imap_unordered(
+                    lambda operation: _run_link_operation(operation, plan), 
+                    links):
+                    if exception is not None:
+                        summary.failures.setdefault(operation.event, 
+                            []).append((operation.source, exception))
+                        profiler.add_event(operation.event, failures=1)
+                        continue
+                    summary.files += n
+                    summary.links += n
+                    profiler.add_event(operation.event, links=n)
+                    profiler.count('symlink', n)
+            finally:
+                pool.close()
+                pool.join()
+                
+    if plan.operations['bundle']:
+        with profiler.stage('bundle'):
+            pool = thread_pool(jobs)
+            try:
+                for operation, members, n_bytes, exception in \
+                    pool.imap_unordered(lambda operation: 
+                    _run_bundle_operation(operation, plan, manifest), 
+                    plan.operations['bundle']):
+                    if exception is not None:
+                        summary.failures.setdefault(operation.event, 
+                            []).append((operation.dest, exception))
+                        profiler.add_event(operation.event, failures=1)
+                        continue
+                    if n_bytes is None:
+                        summary.skipped += len(members)
+                        profiler.count('skip')
+                        continue
+                    if manifest is not None:
+                        manifest.record_bundle(operation.dest, members)
+                    summary.files   += len(members)
+                    summary.bytes   += n_bytes
+                    summary.bundles += 1
+                    profiler.add_event(operation.event, bytes=n_bytes)
+                    profiler.count('bundle')
+            finally:
+                pool.close()
+                pool.join()
+            if manifest is not None:
+                manifest.save()
+                
+    events = collections.OrderedDict((event, []) for event in plan.events())
+    for task in plan.copy_tasks().values():
+        events[task.event].append(task)
+    events = events.items()
+    
+    with profiler.stage('stage_files'):
+        for i in range(0, len(events), STAGING_BATCH_EVENTS):
+            batch  = events[i:i+STAGING_BATCH_EVENTS]
+            tasks  = sorted((task for _, tasks in batch for task in tasks), 
+                key=lambda task: task.source)
+            copies = copy_files(tasks, jobs, manifest, plan.cache)
+            profiler.add_summary(copies)
+            
+            summary.files   += copies.files
+            summary.links   += copies.links
+            summary.bytes   += copies.bytes
+            summary.skipped += copies.skipped
+            summary.events.update(copies.events)
+            for event, errors in copies.failures.items():
+                summary.failures.setdefault(event, []).extend(errors)
+            if store is not None:
+                done = collections.defaultdict(list)
+                for label, _ in batch:
+                    iteration, event = plan.unit(label)
+                    if iteration is not None and label not in summary.failures:
+                        done[iteration].append(event)
+                for iteration, names in done.items():
+                    store.mark(iteration, names, plan.step, 
+                        plan.details.get(iteration))
+        profiler.count('metadata_calls', plan.cache.calls)
+        profiler.count('metadata_saved', plan.cache.saved)
+    return summary
@@ -0,0 +1,122 @@
+"""
+Per stage and per event timings and counts, written as json.
+"""
+
+import os
+import collections
+import contextlib
+import datetime
+import json
+import threading
+import time
+
+from specfem_lasif.util import mkdir_p
+
+class Profiler(object):
+    """
+    Records wall time, files and bytes moved and the number of metadata heavy
+    operations (mkdir, listdir, copy, link, ...) for each stage and each
+    event, and writes them out as json. A disabled profiler does nothing, so
+    the stages can call it unconditionally.
+    """
+    
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.started = datetime.datetime.now()
+        self.stages  = collections.OrderedDict()
+        self.events  = collections.OrderedDict()
+        self.current = None
+        self.lock    = threading.Lock()
+        
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Times a stage. Everything counted inside the block is attributed to
+        it.
+        
+        :name: Stage name.
+        """
+        
+        if not self.enabled:
+            yield
+            return
+        
+        stats = self.stages.setdefault(name, {'wall_time': 0.0, 'files': 0,
+            'bytes': 0, 'operations': collections.OrderedDict()})
+        previous, self.current = self.current, stats
+        start = time.time()
+        try:
+            yield
+        finally:
+            stats['wall_time'] += time.time() - start
+            self.current = previous
+            
+    def count(self, operation, n=1):
+        """
+        Counts operations in the current stage.
+        
+        :operation: Operation name, e.g. 'mkdir'.
+        :n: Number of operations.
+        """
+        
+        if not self.enabled or self.current is None:
+            return
+        with self.lock:
+            operations = self.current['operations']
+            operations[operation] = operations.get(operation, 0) + n
+            
+    def add_event(self, event, **counts):
+        """
+        Adds to the per-event totals.
+        
+        :event: Event name.
+        :counts: Counts to add, e.g. files=3, bytes=1024.
+        """
+        
+        if not self.enabled:
+            return
+        with self.lock:
+            totals = self.events.setdefault(event, {})
+            for key, value in counts.items():
+                totals[key] = totals.get(key, 0) + value
+                
+    def add_summary(self, summary):
+        """
+        Adds a copy engine pass to the current stage and to the events.
+        
+        :summary: CopySummary.
+        """
+        
+        if not self.enabled:
+            return
+        if self.current is not None:
+            self.current['files'] += summary.files
+            self.current['bytes'] += summary.bytes
+        self.count('copy', summary.files - summary.links)
+        self.count('link', summary.links)
+        self.count('skip', summary.skipped)
+        for event, counts in summary.events.items():
+            self.add_event(event, **counts)
+        for event, errors in summary.failures.items():
+            self.add_event(event, failures=len(errors))
+            
+    def write(self, path, **info):
+        """
+        Writes the report as json. Returns nothing if the profiler is
+        disabled.
+        
+        :path: Report file.
+        :info: Extra top level entries, e.g. the iteration name.
+        """
+        
+        if not self.enabled:
+            return
+        report = collections.OrderedDict(info)
+        report['started']   = self.started.isoformat()
+        report['wall_time'] = sum(stats['wall_time'] for stats in 
+            self.stages.values())
+        report['stages']    = self.stages
+        report['events']    = self.events
+        mkdir_p(os.path.dirname(path))
+        with open(path, 'w') as file:
+            json.dump(report, file, indent=2)
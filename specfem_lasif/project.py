@@ -0,0 +1,1407 @@
+"""
+The objects the stages run on. A Project holds the parameter file, the stage
+options and what the stages share (the state store, the profiler and the
+event lists); an Iteration runs the stages of one iteration. Nothing is read
+from or written to scratch until a stage needs it, so a long running process
+can keep a Project around and run stage after stage on it.
+"""
+
+import os, sys
+import collections
+import json
+import shlex
+import stat
+import subprocess
+import time
+
+from specfem_lasif.build import build_fingerprint, build_variants, \
+    parse_build_variant, write_run_par_file
+from specfem_lasif.clean import RETENTION_POLICIES, CLEAN_DIRECTORIES, \
+    remove_tree
+from specfem_lasif.errors import ParameterError, PathError, \
+    MesherNotRunError, StagingError
+from specfem_lasif.lasif import find_event_names, find_event_input_dirs
+from specfem_lasif.plan import Plan, execute_plan, print_plan
+from specfem_lasif.profiler import Profiler
+from specfem_lasif.sizing import estimate_event_cost, cost_ordered_chunks, \
+    chunk_time_limit, size_jobs, solver_runs_on_gpu, sbatch_options, \
+    render_sbatch_script
+from specfem_lasif.slurm import compact_ranges, chunk_indices, run_sbatch, \
+    submit_array_chunks, query_job_states, solver_finished, \
+    FAILED_JOB_STATES
+from specfem_lasif.staging import StagingManifest, ManifestGroup, \
+    DirCache, safe_copy
+from specfem_lasif.state import StateStore
+from specfem_lasif.util import read_parameter_file, read_par_file, \
+    par_file_flag, mkdir_p, format_elapsed, print_blu, print_ylw, \
+    thread_pool
+from specfem_lasif.workqueue import WorkQueue, queue_units, stage_unit, \
+    worker_name
+
+# The command line script, which the prepare_solve job of a pipeline runs.
+CLI_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'setup_specfem_lasif.py')
+
+# Stage options and their defaults. The command line flags of the same names
+# set them; see setup_specfem_lasif.py --help for what each one does.
+DEFAULT_OPTIONS = collections.OrderedDict([
+    # Staging.
+    ('jobs', 8),
+    ('bin_mode', 'copy'),
+    ('topo_mode', 'copy'),
+    ('bundle', 'none'),
+    ('link_mode', 'files'),
+    ('force', False),
+    ('checksum', False),
+    ('dry_run', False),
+    ('profile', False),
+    # Builds. The variants default to the compiler suite in the parameter
+    # file, adjoint.
+    ('variant', None),
+    ('variants', None),
+    ('make_jobs', 4),
+    ('rebuild', False),
+    # Submission.
+    ('sbatch', 'sbatch'),
+    ('sacct', 'sacct'),
+    ('max_array_size', 1000),
+    ('submit_workers', 4),
+    ('sbatch_retries', 3),
+    ('status_ttl', 60),
+    ('prepare_time', '00:30:00'),
+    ('cost_order', False),
+    ('seconds_per_cost', None),
+    ('auto_size', False),
+    ('cores_per_node', 12),
+    ('gpus_per_node', 1),
+    ('node_memory', 64),
+    # Distributed staging.
+    ('distribute', 0),
+    ('local_workers', False),
+    ('queue_chunk', 50),
+    ('queue_lease', 3600),
+    ('worker_time', '01:00:00'),
+])
+
+class Options(object):
+    """
+    Stage options: DEFAULT_OPTIONS, with some of them replaced. Unknown
+    options are an error, rather than silently falling back to a default.
+    """
+
+    def __init__(self, **options):
+        unknown = sorted(set(options) - set(DEFAULT_OPTIONS))
+        if unknown:
+            raise ParameterError('Unknown options: ' + ', '.join(unknown))
+        self.__dict__.update(DEFAULT_OPTIONS)
+        self.__dict__.update(options)
+
+# Job-side helper for bundled runs, written to the project directory. The
+# event's bundle is unpacked before the shared one, so that the compiled
+# Par_file wins over the LASIF one, as it does when staging files.
+UNPACK_BUNDLE_SCRIPT = """#!/bin/bash
+# Unpacks the input bundles of an event at the start of a job, and prints the
+# directory to run the solver in. In a job script:
+#
+#   cd $(%(script_path)s <iteration directory> <event>)
+#
+# With BUNDLE_LOCAL_DIR set to node-local storage (e.g. /tmp), the inputs are
+# unpacked there on every node of the job, with the event's DATABASES_MPI,
+# OUTPUT_FILES and SEM linked from scratch. Otherwise they are unpacked into
+# the event directory.
+set -e
+
+iteration_dir=$1
+event=$2
+event_dir=$iteration_dir/$event
+run_dir=${BUNDLE_LOCAL_DIR:+$BUNDLE_LOCAL_DIR/$event}
+run_dir=${run_dir:-$event_dir}
+
+unpack="mkdir -p $run_dir"
+if [ -f $iteration_dir/bundles/$event.tar ]; then
+    unpack="$unpack && tar -xf $iteration_dir/bundles/$event.tar -C $run_dir"
+fi
+unpack="$unpack && tar -xf $iteration_dir/bundles/shared.tar -C $run_dir"
+if [ "$run_dir" != "$event_dir" ]; then
+    for dir in DATABASES_MPI OUTPUT_FILES SEM; do
+        unpack="$unpack && ln -sfn $event_dir/$dir $run_dir/$dir"
+    done
+fi
+
+if [ "$run_dir" != "$event_dir" ] && [ "${SLURM_JOB_NUM_NODES:-1}" -gt 1 ]; then
+    srun --nodes=$SLURM_JOB_NUM_NODES --ntasks-per-node=1 \\
+        bash -c "$unpack" >&2
+else
+    bash -c "$unpack" >&2
+fi
+echo $run_dir
+"""
+
+# What a distributed setup_run stages itself, rather than queue for the
+# staging workers: the mesh directory and the shared bundle.
+QUEUE_LOCAL_LABELS = ['mesh', 'topography', 'bundles']
+
+def write_job_script(path, job_name, command, time_limit, log_path,
+    options=()):
+    """
+    Writes a single task batch script that runs one command.
+
+    :path: Script file.
+    :job_name: Job name.
+    :command: Command, as a list.
+    :time_limit: Time limit, HH:MM:SS.
+    :log_path: Job output file.
+    :options: More #SBATCH options, e.g. '--array=0-3'.
+    """
+
+    lines = ['#!/bin/bash -l',
+        '#SBATCH --job-name=%s' % (job_name),
+        '#SBATCH --ntasks=1',
+        '#SBATCH --time=%s' % (time_limit),
+        '#SBATCH --output=%s' % (log_path)] + \
+        ['#SBATCH %s' % (option) for option in options] + \
+        ['',
+        ' '.join(command),
+        '']
+    mkdir_p(os.path.dirname(path))
+    with open(path, 'w') as file:
+        file.write('\n'.join(lines))
+    os.chmod(path, 0755)
+
+def write_unpack_helper(path):
+    """
+    Writes the unpack_bundle.sh job helper for bundled runs, unless it's
+    already there.
+
+    :path: Script file.
+    """
+
+    content = UNPACK_BUNDLE_SCRIPT % {'script_path': path}
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            if file.read() == content:
+                return
+    with open(path, 'w') as file:
+        file.write(content)
+    os.chmod(path, 0755)
+
+class Project(object):
+    """
+    A LASIF project and its specfem runs on scratch, as described by a
+    parameter file. Stages that work on several iterations at once
+    (setup_run, build) are methods of the project; the others are methods of
+    its Iteration objects.
+    """
+
+    def __init__(self, parameter_file, iterations=None, profiler=None,
+        **options):
+        """
+        :parameter_file: Simulation driver parameter file.
+        :iterations: Iteration names, overriding iteration_name in the
+            parameter file. The first is the current one.
+        :profiler: Optional Profiler for the stages (default: one of the
+            project's own, enabled by the profile option).
+        :options: Stage options, see DEFAULT_OPTIONS.
+        """
+
+        self.parameter_file = os.path.abspath(parameter_file)
+        self.p = read_parameter_file(parameter_file)
+        if iterations:
+            self.p['iterations']     = list(iterations)
+            self.p['iteration_name'] = self.p['iterations'][0]
+
+        self.options = Options(**options)
+        default_variant = '%s.adjoint' % (self.p['compiler_suite'])
+        self.options.variant  = self.options.variant or default_variant
+        self.options.variants = self.options.variants or [default_variant]
+
+        self.root_path   = os.path.join(self.p['scratch_path'],
+            self.p['project_name'])
+        self.state_path  = os.path.join(self.root_path, 'state.db')
+        self.profiler    = profiler or Profiler(self.options.profile)
+        self._state      = None
+        self._iterations = {}
+        self._events     = {}
+
+    @property
+    def state(self):
+        """
+        The project's StateStore, opened on first use.
+        """
+
+        if self._state is None:
+            self._state = StateStore(self.state_path)
+        return self._state
+
+    @property
+    def iterations(self):
+        """
+        Names of the iterations the project works on.
+        """
+
+        return self.p['iterations']
+
+    def iteration(self, name=None):
+        """
+        The Iteration object of an iteration, made once.
+
+        :name: Iteration name (default: the current one).
+        """
+
+        name = name or self.p['iteration_name']
+        if name not in self._iterations:
+            self._iterations[name] = Iteration(self, name)
+        return self._iterations[name]
+
+    def iteration_path(self, iteration):
+        """
+        Scratch directory of an iteration.
+
+        :iteration: Iteration name.
+        """
+
+        return os.path.join(self.root_path, iteration)
+
+    def event_names(self, iteration):
+        """
+        Names of the events in an iteration, from its xml file. Kept in
+        memory for as long as the xml file doesn't change, and on disk
+        between runs.
+
+        :iteration: Iteration name.
+        """
+
+        iteration_xml_path = os.path.join(self.p['lasif_path'],
+            'ITERATIONS/ITERATION_%s.xml' % (iteration))
+        if not os.path.exists(iteration_xml_path):
+            raise PathError('Your iteration xml file does not exist in the \
+                location you specified.')
+        info   = os.stat(iteration_xml_path)
+        key    = (info.st_mtime, info.st_size)
+        cached = self._events.get(iteration)
+        if cached is None or cached[0] != key:
+            event_cache_path = os.path.join(self.root_path, 'cache',
+                'ITERATION_%s.json' % (iteration))
+            cached = (key, find_event_names(iteration_xml_path,
+                event_cache_path, not self.options.dry_run))
+            self._events[iteration] = cached
+        return list(cached[1])
+
+    def sbatch_command(self, command=None):
+        """
+        A job command from the options as a list, e.g. the sbatch command.
+
+        :command: Command as a string or a list (default: the sbatch
+            option).
+        """
+
+        command = command or self.options.sbatch
+        if isinstance(command, basestring):
+            return shlex.split(command)
+        return list(command)
+
+    def plan_setup_run(self, iterations):
+        """
+        Works out everything setup_run does for one or more iterations, as a
+        single Plan. The iterations share the build, the canonical binaries
+        and the job array script.
+
+        :iterations: Iteration names.
+        """
+
+        p, options, profiler = self.p, self.options, self.profiler
+        with profiler.stage('read_events'):
+            event_lists, input_dirs = {}, {}
+            for iteration in iterations:
+                event_lists[iteration] = self.event_names(iteration)
+                input_dirs[iteration]  = find_event_input_dirs(
+                    p['lasif_path'], iteration, event_lists[iteration])
+            profiler.count('listdir')
+
+        plan = Plan('setup_run', iterations, 'staged')
+
+        # Compile, or pick up an identical earlier build. The fingerprint is
+        # taken from the Par_file that will be compiled, before it is copied
+        # over. All iterations of the project compile the same SUBMISSION
+        # Par_file.
+        submission_par_file = os.path.join(p['lasif_path'], 'SUBMISSION',
+            'Par_file')
+        compiler_suite, mode = parse_build_variant(options.variant)
+        fingerprint, _ = build_fingerprint(p['specfem_root'], compiler_suite,
+            mode, submission_par_file)
+        artifact_path = os.path.join(p['specfem_root'], 'build_cache',
+            fingerprint)
+        plan.add('build', 'shared', p['specfem_root'], artifact_path,
+            options.variant)
+        plan.add('mkdir', 'shared', dest=os.path.join(self.root_path, 'logs'))
+
+        # In the shared modes the binaries are copied once per build and
+        # linked from there. Until the build exists, the last build of the
+        # variant stands in for it.
+        bin_path = os.path.join(artifact_path, 'bin')
+        par_file = self.run_par_file()
+        hint = os.path.join(p['specfem_root'], 'artifacts', options.variant,
+            'bin')
+        if options.bin_mode != 'copy':
+            canonical_bin_path = os.path.join(self.root_path, 'bin',
+                fingerprint)
+            plan.add('canonical', 'shared', bin_path, canonical_bin_path)
+            plan.hints[bin_path] = hint
+            plan.hints[canonical_bin_path] = hint
+            bin_path = canonical_bin_path
+
+        # Jobarray script to base directory.
+        source = os.path.join(p['lasif_path'], 'SUBMISSION',
+            'jobArray_solver_daint.sbatch')
+        plan.add('copy', 'shared', source, self.root_path, 'copy')
+
+        for iteration in iterations:
+            plan.details[iteration] = '%s %s %s %s' % (fingerprint,
+                options.bin_mode, options.topo_mode, options.bundle)
+            base_path  = self.iteration_path(iteration)
+            event_list = event_lists[iteration]
+            label      = lambda event: plan.label(iteration, event)
+
+            # Forward modelling and master mesh directories.
+            for event in event_list + ['mesh']:
+                plan.add('mkdir', label(event), dest=os.path.join(base_path,
+                    event), method='tree')
+            mesh_topo_path = os.path.join(base_path, 'mesh', 'DATA',
+                'topo_bathy')
+            plan.add('mkdir', label('topography'), dest=mesh_topo_path)
+
+            # Input files. The first event's go to the mesh directory as well.
+            bundle_path = os.path.join(base_path, 'bundles')
+            for event, event_output_dir in input_dirs[iteration].items():
+                dest = os.path.join(base_path, event, 'DATA')
+                if options.bundle == 'events':
+                    plan.add_bundle(label(event), os.path.join(bundle_path,
+                        event + '.tar'), [(event_output_dir, 'DATA')])
+                else:
+                    plan.add_copy_dir(label(event), event_output_dir, dest)
+                if event == event_list[0]:
+                    dest = os.path.join(base_path, 'mesh', 'DATA')
+                    plan.add_copy_dir(label('mesh'), event_output_dir, dest)
+
+            # Binaries and compiled parameter file to all directories, or once
+            # to the shared bundle. The mesher always gets them as files.
+            if options.bundle != 'none':
+                plan.add('mkdir', label('bundles'), dest=bundle_path)
+                plan.add_bundle(label('bundles'), os.path.join(bundle_path,
+                    'shared.tar'), [(bin_path, 'bin'), (par_file,
+                    'DATA/Par_file')])
+            for event in (event_list if options.bundle == 'none' else []) + \
+                ['mesh']:
+                dest = os.path.join(base_path, event, 'bin')
+                plan.add_copy_dir(label(event), bin_path, dest,
+                    options.bin_mode, hint)
+                dest = os.path.join(base_path, event, 'DATA')
+                plan.add('copy', label(event), par_file, dest, 'copy')
+
+            # Topo_bathy to mesh directory. It's only read, so it can be
+            # linked from the specfem installation instead.
+            master_topo_path = os.path.join(p['specfem_root'], 'DATA',
+                'topo_bathy')
+            plan.add_copy_dir(label('topography'), master_topo_path,
+                mesh_topo_path, options.topo_mode)
+
+            # Submission script to mesh directory.
+            source = os.path.join(p['lasif_path'], 'SUBMISSION',
+                'job_mesher_daint.sbatch')
+            dest = os.path.join(base_path, 'mesh')
+            plan.add('copy', label('mesh'), source, dest, 'copy')
+
+        return plan
+
+    def resume_plan(self, plan):
+        """
+        For each iteration whose last run of the plan's stage didn't finish,
+        drops the events it did finish (with the same detail, e.g. the build)
+        from the plan, so the stage carries on where it stopped. After a run
+        that finished, or with the force option, everything is done again
+        (with unchanged files still skipped by the manifest).
+
+        :plan: Plan.
+        """
+
+        options = self.options
+        # A dry run doesn't make the state store: without one, nothing ran.
+        if options.dry_run and not os.path.exists(self.state_path):
+            return
+        state  = self.state
+        labels = collections.defaultdict(list)
+        for label in plan.events():
+            iteration, event = plan.unit(label)
+            if iteration is not None:
+                labels[iteration].append((label, event))
+
+        finished = []
+        for iteration in plan.iterations:
+            if options.force and not options.dry_run:
+                state.clear(iteration, plan.step)
+            if options.force or state.done(iteration, plan.name):
+                if not options.dry_run:
+                    state.clear(iteration, plan.name)
+                continue
+            done = state.done(iteration, plan.step, plan.details.get(
+                iteration))
+            finished.extend(label for label, event in labels[iteration]
+                if event in done)
+        if finished:
+            print_ylw('Resuming %s: %d of %d events were done by the last '
+                'run.' % (plan.name, len(finished), sum(len(events) for events
+                in labels.values())))
+            plan.drop_events(finished)
+
+    def setup_run(self, iterations=None):
+        """
+        Function does a whole bunch of things to set up a specfem run on
+        daint. With the distribute option, the events are staged by workers
+        instead, see queue_setup_run.
+
+        :iterations: Iteration names (default: all of the project's).
+        """
+
+        options = self.options
+        iterations = list(iterations or self.iterations)
+        plan = self.plan_setup_run(iterations)
+        self.resume_plan(plan)
+        if options.distribute:
+            return self.queue_setup_run(plan)
+        if options.dry_run:
+            print_plan(plan, os.path.join(self.root_path, 'profiles'))
+            return
+
+        self._stage_submission_par_file()
+        manifest = self.manifests(iterations, options.force)
+
+        print_ylw('Creating directories and staging input files, binaries '
+            'and topography for %s (%d jobs)...' % (', '.join(iterations),
+            options.jobs))
+        summary = execute_plan(plan, options.jobs, manifest, self.profiler,
+            options.make_jobs, options.rebuild, self.state)
+        summary.report()
+        if summary.failures:
+            raise StagingError('Failed to stage files for: ' +
+                ', '.join(summary.failures.keys()))
+        self._finish_setup_run(iterations, options.bundle)
+
+    def run_par_file(self):
+        """
+        The Par_file setup_run stages for the events and the mesher: the
+        SUBMISSION one, as the build variant's mode sets it.
+        """
+
+        return os.path.join(self.root_path, 'par_files', self.options.variant,
+            'Par_file')
+
+    def _stage_submission_par_file(self):
+        """
+        Copy one instance of forward files to specfem base directory, and
+        writes the Par_file the events run with.
+        """
+
+        source = os.path.join(self.p['lasif_path'], 'SUBMISSION', 'Par_file')
+        dest   = os.path.join(self.p['specfem_root'], 'DATA')
+        safe_copy(source, dest)
+        write_run_par_file(source, self.run_par_file(), parse_build_variant(
+            self.options.variant)[1])
+
+    def manifests(self, iterations, reset=False):
+        """
+        The staging manifests of some iterations, as a ManifestGroup, so that
+        only what changed since the last run is restaged.
+
+        :iterations: Iteration names.
+        :reset: Start over with empty manifests, so everything is restaged.
+        """
+
+        manifests = []
+        for iteration in iterations:
+            manifest_path = os.path.join(self.root_path, 'manifests',
+                iteration + '.json')
+            if reset and os.path.exists(manifest_path):
+                os.remove(manifest_path)
+            manifests.append((self.iteration_path(iteration),
+                StagingManifest(manifest_path,
+                checksum=self.options.checksum)))
+        return ManifestGroup(manifests)
+
+    def _finish_setup_run(self, iterations, bundle):
+        """
+        Records a finished setup_run, and writes the bundle helper.
+
+        :iterations: Iteration names.
+        :bundle: One of BUNDLE_MODES.
+        """
+
+        for iteration in iterations:
+            self.state.mark(iteration, ['*'], 'setup_run')
+        if bundle != 'none':
+            helper = os.path.join(self.root_path, 'unpack_bundle.sh')
+            write_unpack_helper(helper)
+            print_ylw('Inputs are bundled: the solver job script has to run '
+                '"cd $(%s <iteration directory> <event>)" first.' % (helper))
+
+        print_blu('Done.')
+
+    def queue_path(self, iterations):
+        """
+        Directory of the staging queue of some iterations.
+
+        :iterations: Iteration names.
+        """
+
+        return os.path.join(self.root_path, 'queues', 'setup_run_%s' % (
+            '+'.join(iterations)))
+
+    def cli_command(self, iterations, *arguments):
+        """
+        Command line that runs a stage of this project in a job.
+
+        :iterations: Iteration names.
+        :arguments: Stage flags, e.g. '--prepare_solve'.
+        """
+
+        return [sys.executable, CLI_SCRIPT, '-f', self.parameter_file,
+            '--iterations', ','.join(iterations)] + list(arguments) + \
+            ['--jobs', str(self.options.jobs)]
+
+    def queue_setup_run(self, plan):
+        """
+        Distributed setup_run: builds and stages what the events share and
+        the mesh directory here, so the mesher can be submitted right away,
+        and queues the staging of the events, in units of queue_chunk events,
+        for staging workers, which can run on any number of nodes. The workers
+        are submitted as a job array of distribute tasks, followed by a job
+        that merges and checks what they staged; with local_workers, they run
+        as processes here, and the merge as well. Returns the job ID of the
+        merge job, if one was submitted.
+
+        :plan: Resumed setup_run Plan.
+        """
+
+        options    = self.options
+        iterations = plan.iterations
+        queued     = [label for label in plan.events() if plan.unit(label)[0]
+            is not None and plan.unit(label)[1] not in QUEUE_LOCAL_LABELS]
+        units      = queue_units(plan, queued, options.queue_chunk)
+        if options.dry_run:
+            print_plan(plan, os.path.join(self.root_path, 'profiles'))
+            print '  queue      : %d units of up to %d events, for %d '\
+                'workers' % (len(units), options.queue_chunk,
+                options.distribute)
+            return None
+
+        self._stage_submission_par_file()
+        manifest = self.manifests(iterations, options.force)
+        plan.drop_events(queued)
+        print_ylw('Building and staging what the events share...')
+        summary = execute_plan(plan, options.jobs, manifest, self.profiler,
+            options.make_jobs, options.rebuild, self.state)
+        summary.report()
+        if summary.failures:
+            raise StagingError('Failed to stage files for: ' +
+                ', '.join(summary.failures.keys()))
+
+        entries = {}
+        for _, iteration_manifest in manifest.manifests:
+            entries.update(iteration_manifest.entries)
+        queue = WorkQueue(self.queue_path(iterations))
+        queue.create(units, entries, name=plan.name, iterations=iterations,
+            step=plan.step, details=plan.details, checksum=options.checksum,
+            lease=options.queue_lease, bundle=options.bundle)
+        print_ylw('Queued %d units for staging in %s.' % (len(units),
+            queue.path))
+        if not units:
+            self.merge_staging(iterations)
+        elif options.local_workers:
+            self.run_local_workers(iterations)
+            self.merge_staging(iterations)
+        else:
+            return self.submit_staging_workers(iterations)
+
+    def submit_staging_workers(self, iterations):
+        """
+        Submits distribute staging workers as a job array, and the merge as a
+        job that starts once they have all ended. Returns the merge job ID.
+
+        :iterations: Iteration names.
+        """
+
+        options = self.options
+        name    = '+'.join(iterations)
+        scripts = {}
+        for job, flag, array in [('stage_worker', '--stage_worker',
+            ['--array=0-%d' % (options.distribute - 1)]), ('merge_staging',
+            '--merge_staging', [])]:
+            scripts[job] = os.path.join(self.root_path, 'jobs',
+                '%s_%s.sbatch' % (job, name))
+            write_job_script(scripts[job], '%s_%s' % (job, name),
+                self.cli_command(iterations, flag), options.worker_time,
+                os.path.join(self.root_path, 'logs', '%s_%s_%s.log' % (job,
+                name, '%A_%a' if array else '%j')), array)
+        with self.profiler.stage('submit'):
+            worker_id = run_sbatch(self.sbatch_command(),
+                [scripts['stage_worker']], self.root_path,
+                options.sbatch_retries)
+            merge_id  = run_sbatch(self.sbatch_command(),
+                ['--dependency=afterany:' + worker_id,
+                scripts['merge_staging']], self.root_path,
+                options.sbatch_retries)
+            self.profiler.count('sbatch', 2)
+        for iteration in iterations:
+            self.state.record_job(iteration, 'stage_workers', worker_id)
+            self.state.record_job(iteration, 'merge_staging', merge_id)
+        print_blu('Submitted %d staging workers as job %s, and the merge as '
+            'job %s after them.' % (options.distribute, worker_id, merge_id))
+        return merge_id
+
+    def run_local_workers(self, iterations):
+        """
+        Runs distribute staging workers as processes here, and waits for
+        them. Their output goes to the logs directory.
+
+        :iterations: Iteration names.
+        """
+
+        name = '+'.join(iterations)
+        logs_path = os.path.join(self.root_path, 'logs')
+        mkdir_p(logs_path)
+        print_ylw('Running %d local staging workers...' % (
+            self.options.distribute))
+        workers = []
+        for i in range(self.options.distribute):
+            log = open(os.path.join(logs_path, 'stage_worker_%s_local_%d.log'
+                % (name, i)), 'w')
+            workers.append((subprocess.Popen(self.cli_command(iterations,
+                '--stage_worker'), stdout=log, stderr=subprocess.STDOUT),
+                log))
+        for process, log in workers:
+            process.wait()
+            log.close()
+        failed = sum(1 for process, _ in workers if process.returncode)
+        if failed:
+            print_ylw('%d local staging workers failed, see their logs in '
+                '%s.' % (failed, logs_path))
+
+    def stage_worker(self, worker=None):
+        """
+        Claims and stages units of the staging queue of the project's
+        iterations until there are none left. Any number of workers can run
+        at once, on any node that sees scratch. Returns the number of units
+        staged and failed.
+
+        :worker: Name of the worker (default: host, process ID and job array
+            task).
+        """
+
+        queue    = WorkQueue(self.queue_path(self.iterations))
+        settings = queue.settings()
+        worker   = worker or worker_name()
+        staged, failed = 0, 0
+        while True:
+            unit_id = queue.claim(worker)
+            if unit_id is None:
+                break
+            try:
+                result, error = stage_unit(queue, unit_id, settings,
+                    self.options.jobs, self.profiler)
+            except (StagingError, PathError, IOError, OSError) as exception:
+                result, error = None, str(exception)
+            if not queue.finish(unit_id, worker, result, error):
+                print_ylw('%s: %s was claimed again after the lease ran out, '
+                    'the result is discarded.' % (worker, unit_id))
+            elif error:
+                failed += 1
+                print_ylw('%s: %s failed: %s' % (worker, unit_id, error))
+            else:
+                staged += 1
+                print '%s: %s staged (%d files, %.1f MB, %d unchanged)' % (
+                    worker, unit_id, result['files'], result['bytes'] /
+                    1024.0 ** 2, result['skipped'])
+        print_blu('%s: staged %d units, %d failed.' % (worker, staged,
+            failed))
+        return staged, failed
+
+    def merge_staging(self, iterations=None):
+        """
+        Merges what the staging workers did into the iterations' manifests
+        and state, and checks that every unit of the queue was staged. Units
+        that failed, or whose worker gave up (a claim older than the lease),
+        go back in the queue, so more workers can be started on them; the
+        events of the units that were staged won't be queued again by the
+        next setup_run either. Raises StagingError if anything is left to
+        stage.
+
+        :iterations: Iteration names (default: all of the project's).
+        """
+
+        iterations = list(iterations or self.iterations)
+        queue      = WorkQueue(self.queue_path(iterations))
+        settings   = queue.settings()
+        states     = queue.states()
+        manifest   = self.manifests(iterations)
+        now        = time.time()
+
+        merged, requeued, active = [], [], []
+        totals = dict.fromkeys(['files', 'links', 'bytes', 'skipped'], 0)
+        events = collections.defaultdict(list)
+        for unit_id, unit in states.items():
+            if unit['state'] == 'done':
+                with open(queue.manifest_path(unit_id), 'r') as file:
+                    manifest.update(json.load(file))
+                for iteration, event in queue.unit(unit_id)['labels'].values():
+                    events[iteration].append(event)
+                for key in totals:
+                    totals[key] += unit['result'][key]
+                merged.append(unit_id)
+            elif unit['state'] == 'claimed' and \
+                now - unit['claimed'] <= settings['lease']:
+                active.append(unit_id)
+            elif unit['state'] != 'merged':
+                requeued.append(unit_id)
+        manifest.save()
+        for iteration, done in events.items():
+            self.state.mark(iteration, done, settings['step'],
+                settings['details'].get(iteration))
+        queue.mark(merged, 'merged')
+        queue.mark(requeued, 'pending')
+
+        print_blu('Merged %d units: %d files (%d linked, %.1f MB copied), %d '
+            'unchanged files skipped.' % (len(merged), totals['files'],
+            totals['links'], totals['bytes'] / 1024.0 ** 2,
+            totals['skipped']))
+        for unit_id in requeued:
+            unit = states[unit_id]
+            print_ylw('%s: %s%s' % (unit_id, unit['state'], ' (%s): %s' % (
+                unit['worker'], unit['error']) if unit['error'] else ''))
+        if requeued or active:
+            raise StagingError('%d of %d staging units are staged, %d are '
+                'being staged and %d are back in the queue. Start more '
+                'workers with --stage_worker, then --merge_staging again.' % (
+                len(states) - len(requeued) - len(active), len(states),
+                len(active), len(requeued)))
+        self._finish_setup_run(iterations, settings['bundle'])
+
+    def build(self, variants=None):
+        """
+        Compiles build variants without setting up a run.
+
+        :variants: Variant names (default: the variants option).
+        """
+
+        p = self.p
+
+        # Copy one instance of forward files to specfem base directory.
+        source = os.path.join(p['lasif_path'], 'SUBMISSION', 'Par_file')
+        dest   = os.path.join(p['specfem_root'], 'DATA')
+        safe_copy(source, dest)
+
+        artifacts = build_variants(p['specfem_root'], variants or
+            self.options.variants, self.options.rebuild,
+            self.options.make_jobs)
+        for variant, artifact_path in artifacts.items():
+            print_blu('%s: %s' % (variant, artifact_path))
+        return artifacts
+
+    def write_profile(self, command):
+        """
+        Writes the profiler's report for a command to the profiles directory.
+        Returns its path, or None if the profiler is disabled or it's a dry
+        run (whose reports would also skew the projected times of plans).
+
+        :command: Command name, e.g. 'setup_run'.
+        """
+
+        if not self.profiler.enabled or self.options.dry_run:
+            return None
+        name = '+'.join(self.iterations)
+        path = os.path.join(self.root_path, 'profiles', '%s_%s_%s.json' % (
+            name, command, self.profiler.started.strftime('%Y%m%dT%H%M%S')))
+        self.profiler.write(path, iteration=name, command=command,
+            jobs=self.options.jobs)
+        return path
+
+class Iteration(object):
+    """
+    One iteration of a Project, and the stages that work on it.
+    """
+
+    def __init__(self, project, name):
+        """
+        :project: Project.
+        :name: Iteration name.
+        """
+
+        self.project = project
+        self.name    = name
+        self.path    = project.iteration_path(name)
+
+    @property
+    def p(self):
+        return self.project.p
+
+    @property
+    def options(self):
+        return self.project.options
+
+    @property
+    def state(self):
+        return self.project.state
+
+    @property
+    def profiler(self):
+        return self.project.profiler
+
+    def event_names(self):
+        """
+        Names of the events in the iteration, from its xml file.
+        """
+
+        return self.project.event_names(self.name)
+
+    def solver_index_events(self):
+        """
+        The event each solver job array index runs: index i is the i-th event
+        of the iteration in sorted order, i.e. the order the event
+        directories are listed in.
+        """
+
+        return sorted(self.event_names())
+
+    def setup_run(self):
+        """
+        Sets up the iteration on its own, see Project.setup_run.
+        """
+
+        return self.project.setup_run([self.name])
+
+    def plan_prepare_solve(self):
+        """
+        Works out the links and copies prepare_solve makes, as a Plan.
+        """
+
+        options, profiler = self.options, self.profiler
+        plan = Plan('prepare_solve', [self.name], 'linked')
+
+        # The mesh is the same for every event, so list it once.
+        databases_mpi = os.path.join(self.path, 'mesh', 'DATABASES_MPI')
+        output_files = os.path.join(self.path, 'mesh', 'OUTPUT_FILES')
+        plan.details[self.name] = '%s %r' % (options.link_mode,
+            os.stat(databases_mpi).st_mtime)
+        with profiler.stage('list_mesh'):
+            mesh_files = plan.listing(databases_mpi)
+            plan.listing(output_files)
+            profiler.count('listdir', 2)
+        if not mesh_files:
+            raise MesherNotRunError("It doesn't look like the mesher has been \
+            run. There are no mesh files in the expected mesh directory.")
+
+        # With one shared directory, whatever the solver writes to
+        # DATABASES_MPI lands in the mesh directory, so only allow it for
+        # plain forward runs.
+        if options.link_mode == 'directory':
+            par_file = read_par_file(os.path.join(self.path, 'mesh', 'DATA',
+                'Par_file'))
+            if par_file.get('SIMULATION_TYPE', '1') != '1' or \
+                par_file_flag(par_file.get('SAVE_FORWARD', '.false.')):
+                raise ParameterError('--link_mode directory shares the mesh '
+                    'DATABASES_MPI between events, so it can only be used '
+                    'when SIMULATION_TYPE = 1 and SAVE_FORWARD = .false.')
+
+        for event in os.listdir(self.path):
+            if event in ('mesh', 'bundles'):
+                continue
+            event_path = os.path.join(self.path, event)
+            kind = 'link_dir' if options.link_mode == 'directory' else \
+                'link_files'
+            plan.add(kind, plan.label(self.name, event), databases_mpi,
+                os.path.join(event_path, 'DATABASES_MPI'))
+            plan.add_copy_dir(plan.label(self.name, event), output_files,
+                os.path.join(event_path, 'OUTPUT_FILES'))
+        return plan
+
+    def prepare_solve(self):
+        """
+        Sets up symbolic link to generated mesh files.
+        """
+
+        print 'Preparing solver directories.'
+        plan = self.plan_prepare_solve()
+        self.project.resume_plan(plan)
+        if self.options.dry_run:
+            print_plan(plan, os.path.join(self.project.root_path, 'profiles'))
+            return
+
+        print_ylw('Linking mesh (%s) and copying mesher output files...' % (
+            self.options.link_mode))
+        summary = execute_plan(plan, self.options.jobs,
+            profiler=self.profiler, store=self.state)
+        summary.report()
+        if summary.failures:
+            raise StagingError('Failed to prepare: ' +
+                ', '.join(summary.failures.keys()))
+        self.state.mark(self.name, ['*'], 'prepare_solve')
+
+        print_blu('Done.')
+
+    def submit_mesher(self, sbatch_arguments=()):
+        """
+        Submits the mesher from the meshing directory, and records its job
+        ID. Returns the job ID.
+
+        :sbatch_arguments: Extra sbatch options, e.g. a dependency.
+        """
+
+        mesh_dir = os.path.join(self.path, 'mesh')
+        script   = 'job_mesher_daint.sbatch'
+        if self.options.auto_size:
+            script = self.sized_script(mesh_dir, script, 'mesher')
+        with self.profiler.stage('submit'):
+            job_id = run_sbatch(self.project.sbatch_command(),
+                list(sbatch_arguments) + [script], mesh_dir,
+                self.options.sbatch_retries)
+            self.profiler.count('sbatch')
+        self.state.record_job(self.name, 'mesher', job_id)
+        print_blu('Submitted mesher as job %s.' % (job_id))
+        return job_id
+
+    def submit_solver(self, first_job, last_job, sbatch_arguments=()):
+        """
+        Submits the job array script in the project directory. Submits job
+        array indices first_job to last_job, in array jobs of at most
+        max_array_size indices each.
+
+        :first_job: The job array index of the first job to submit (i.e. 0)
+        :last_job: The job array index of the last job to submit (i.e.
+            n_events-1)
+        :sbatch_arguments: Extra sbatch options, e.g. a dependency.
+        """
+
+        return self.submit_solver_indices(range(int(first_job),
+            int(last_job) + 1), sbatch_arguments)
+
+    def submit_solver_indices(self, indices, sbatch_arguments=()):
+        """
+        Submits the job array script for any set of job array indices. With
+        the cost_order option, the indices are submitted most expensive
+        first, in chunks of similar cost, each with its own time limit if
+        seconds_per_cost is set. Returns the indices that failed to submit.
+
+        :indices: Job array indices.
+        :sbatch_arguments: Extra sbatch options, e.g. a dependency.
+        """
+
+        options = self.options
+        events  = self.solver_index_events()
+        record  = lambda chunk, job_id, offset: self.state.record_solver(
+            self.name, chunk, job_id, events, offset)
+        workers, chunk_arguments, times = options.submit_workers, None, {}
+        if options.cost_order:
+            costs   = dict((entry['index'], entry['cost']) for entry in
+                self.schedule_events(events))
+            chunks  = [part for chunk in cost_ordered_chunks(indices, costs,
+                options.max_array_size) for part in chunk_indices(chunk,
+                options.max_array_size)]
+            workers = 1
+            if options.seconds_per_cost:
+                for chunk in chunks:
+                    times[tuple(chunk)] = chunk_time_limit(chunk, costs,
+                        options.seconds_per_cost)
+                chunk_arguments = lambda chunk: ['--time=' +
+                    times[tuple(chunk)]]
+        else:
+            chunks = chunk_indices(indices, options.max_array_size)
+        script = 'jobArray_solver_daint.sbatch'
+        if options.auto_size:
+            script = self.sized_script(self.project.root_path, script,
+                'solver')
+        with self.profiler.stage('submit'):
+            results = submit_array_chunks(self.project.sbatch_command(),
+                script, [self.name], chunks, self.project.root_path, record,
+                workers, options.sbatch_retries, sbatch_arguments,
+                chunk_arguments, options.max_array_size)
+            self.profiler.count('sbatch', len(results))
+
+        failed = []
+        for chunk, job_id, exception in results:
+            if exception is None:
+                print_blu('Submitted indices %s as job %s%s.' % (
+                    compact_ranges(chunk), job_id, ', time limit ' +
+                    times[tuple(chunk)] if times else ''))
+            else:
+                failed.extend(chunk)
+                print_ylw('Failed to submit indices %s: %s' % (
+                    compact_ranges(chunk), exception))
+        if failed:
+            print_ylw('Resubmit the failed indices with -fj/-lj: %s' % (
+                compact_ranges(failed)))
+        return failed
+
+    def schedule_events(self, events=None):
+        """
+        Estimates the cost of every event of the iteration, reading the
+        events concurrently. Returns a list of dictionaries (index, event,
+        cost and its inputs) by job array index.
+
+        :events: Events by job array index (default:
+            solver_index_events()).
+        """
+
+        events = events or self.solver_index_events()
+
+        def worker(index):
+            entry = estimate_event_cost(os.path.join(self.path,
+                events[index]))
+            entry.update(index=index, event=events[index])
+            return entry
+
+        pool = thread_pool(self.options.jobs)
+        try:
+            return pool.map(worker, range(len(events)))
+        finally:
+            pool.close()
+            pool.join()
+
+    def schedule(self):
+        """
+        Estimates the relative cost of every event of the iteration from its
+        staged inputs, and writes the job array indices ordered most
+        expensive first (schedules/<iteration>.txt, with the details in a
+        json file next to it). Prints the chunks cost_order would submit.
+        """
+
+        options = self.options
+        with self.profiler.stage('schedule'):
+            entries = self.schedule_events()
+            self.profiler.count('read', 2 * len(entries))
+        order = sorted(entries, key=lambda entry: (-entry['cost'],
+            entry['index']))
+
+        path = os.path.join(self.project.root_path, 'schedules', self.name)
+        mkdir_p(os.path.dirname(path))
+        with open(path + '.txt', 'w') as file:
+            for entry in order:
+                file.write('%d %s %.2f\n' % (entry['index'], entry['event'],
+                    entry['cost']))
+        with open(path + '.json', 'w') as file:
+            json.dump(order, file, indent=2)
+
+        costs = dict((entry['index'], entry['cost']) for entry in entries)
+        total = sum(costs.values())
+        print_ylw('Estimated cost of %d events: total %.1f, largest %.1f, '
+            'smallest %.1f.' % (len(entries), total, order[0]['cost'] if
+            order else 0, order[-1]['cost'] if order else 0))
+        for chunk in cost_ordered_chunks(costs.keys(), costs,
+            options.max_array_size):
+            time_limit = chunk_time_limit(chunk, costs,
+                options.seconds_per_cost) if options.seconds_per_cost else \
+                'default'
+            print '  %5d events, cost %.1f-%.1f, time limit %s' % (
+                len(chunk), costs[chunk[-1]], costs[chunk[0]], time_limit)
+        print_blu('Index order written to %s.txt.' % (path))
+        return order
+
+    def job_sizes(self):
+        """
+        Sizes the mesher and solver jobs of the iteration from its staged
+        Par_file, or from the project's before it's staged.
+        """
+
+        options = self.options
+        path = os.path.join(self.path, 'mesh', 'DATA', 'Par_file')
+        if not os.path.exists(path):
+            path = os.path.join(self.p['lasif_path'], 'SUBMISSION',
+                'Par_file')
+        par_file = read_par_file(path)
+        return size_jobs(par_file, solver_runs_on_gpu(par_file,
+            options.variant), options.cores_per_node, options.gpus_per_node,
+            options.node_memory)
+
+    def sized_script(self, directory, script, job):
+        """
+        Renders a job script in directory with the mesher or solver options
+        from job_sizes, next to the original, so it's submitted from the same
+        place. Returns the rendered script's name.
+
+        :directory: Directory of the script.
+        :script: Script name.
+        :job: mesher or solver.
+        """
+
+        name = '%s.%s.sized.sbatch' % (os.path.splitext(script)[0], self.name)
+        render_sbatch_script(os.path.join(directory, script), os.path.join(
+            directory, name), self.job_sizes()[job]['options'])
+        return name
+
+    def sizing(self):
+        """
+        Prints the ranks, nodes, memory and time limits the mesher and solver
+        of the iteration need according to its Par_file, the #SBATCH headers
+        auto_size would submit them with, and where the project's job scripts
+        disagree.
+        """
+
+        sizes = self.job_sizes()
+        print_ylw('%d MPI ranks, about %d elements and %d time steps.' % (
+            sizes['ranks'], sizes['elements'], sizes['steps']))
+        scripts = {
+            'mesher': os.path.join(self.p['lasif_path'], 'SUBMISSION',
+                'job_mesher_daint.sbatch'),
+            'solver': os.path.join(self.p['lasif_path'], 'SUBMISSION',
+                'jobArray_solver_daint.sbatch'),
+        }
+        mismatches = 0
+        for job in ['mesher', 'solver']:
+            size = sizes[job]
+            print_blu('%s: about %.2f GB per rank and %s per run.' % (job,
+                size['memory'], format_elapsed(size['seconds'])))
+            for name, value in size['options'].items():
+                print '  #SBATCH --%s=%s' % (name, value)
+            current = sbatch_options(scripts[job]) if os.path.exists(
+                scripts[job]) else {}
+            for name in ['nodes', 'ntasks', 'ntasks-per-node']:
+                if name in current and current[name] != str(
+                    size['options'][name]):
+                    mismatches += 1
+                    print_ylw('  %s has --%s=%s.' % (os.path.basename(
+                        scripts[job]), name, current[name]))
+        if mismatches:
+            print_ylw('Submit with --auto_size to use the numbers above.')
+        return sizes
+
+    def status(self, resubmit_failed=False):
+        """
+        Reports where every event of the iteration is: done (the solver wrote
+        its completion marker), active (pending or running), failed (the job
+        ended without the marker) or not submitted. Events the state store
+        already has as completed aren't looked at again. Returns the job
+        array indices in each of those groups.
+
+        :resubmit_failed: Submit the failed events again as one compact job
+            array.
+        """
+
+        state, profiler = self.state, self.profiler
+        jobs      = state.jobs(self.name)
+        events    = self.solver_index_events()
+        completed = state.done(self.name, 'completed')
+
+        # Only the jobs of events that aren't known to be done are of
+        # interest.
+        job_ids = set(entry['array_job_id'] for index, entry in
+            jobs['solver'].items() if index >= len(events) or
+            events[index] not in completed)
+        for name in ['mesher', 'prepare_solve']:
+            if jobs[name]:
+                job_ids.add(jobs[name]['job_id'])
+        with profiler.stage('status'):
+            cache_path = os.path.join(self.project.root_path, 'cache',
+                'status_%s.json' % (self.name))
+            states, cached = query_job_states(self.project.sbatch_command(
+                self.options.sacct), job_ids, cache_path,
+                self.options.status_ttl)
+            if not cached and job_ids:
+                profiler.count('sacct')
+
+            groups = collections.OrderedDict((group, []) for group in
+                ['done', 'active', 'failed', 'not submitted'])
+            finished = []
+            for index, event in enumerate(events):
+                entry = jobs['solver'].get(index)
+                if event in completed:
+                    groups['done'].append(index)
+                    continue
+                profiler.count('stat')
+                if solver_finished(os.path.join(self.path, event)):
+                    groups['done'].append(index)
+                    finished.append(event)
+                elif entry is None:
+                    groups['not submitted'].append(index)
+                elif states.get(entry['job_id'], 'PENDING') in \
+                    FAILED_JOB_STATES:
+                    groups['failed'].append(index)
+                else:
+                    groups['active'].append(index)
+            state.mark(self.name, finished, 'completed')
+
+        for name in ['mesher', 'prepare_solve']:
+            if jobs[name]:
+                job_id = jobs[name]['job_id']
+                print '%-14s: job %s, %s' % (name, job_id,
+                    states.get(job_id, 'UNKNOWN'))
+        print '%-14s: %s' % ('events', ', '.join('%d %s' % (n, step) for
+            step, n in state.progress(self.name, events).items()))
+        print_ylw('Solver, %d events%s:' % (len(events),
+            ' (job states cached)' if cached else ''))
+        for group, indices in groups.items():
+            print '  %-14s: %5d  %s' % (group, len(indices),
+                compact_ranges(indices))
+        for index in groups['failed']:
+            entry = jobs['solver'][index]
+            print '    %5d %-30s job %s, %s' % (index, events[index],
+                entry['job_id'], states.get(entry['job_id'], 'UNKNOWN'))
+
+        if resubmit_failed and groups['failed']:
+            print_ylw('Resubmitting %d failed events...' % (
+                len(groups['failed'])))
+            self.submit_solver_indices(groups['failed'])
+        return groups
+
+    def clean(self, retention='products', remove_iteration=False):
+        """
+        Deletes the bulky output of the iteration: by default, each event's
+        OUTPUT_FILES and DATABASES_MPI minus what the retention policy keeps
+        (the directories are made again, empty, so prepare_solve can be
+        rerun); with remove_iteration, the whole iteration, including the
+        mesh. The canonical binaries are kept, since they're shared with
+        other iterations of the same build. Directories are deleted
+        concurrently, and the reclaimed bytes are reported.
+
+        :retention: One of RETENTION_POLICIES.
+        :remove_iteration: Delete the whole iteration directory.
+        """
+
+        dry_run = self.options.dry_run
+        keep    = RETENTION_POLICIES[retention]
+        cache   = DirCache()
+        if not os.path.isdir(self.path):
+            raise PathError('There is nothing to clean: %s does not exist.' % (
+                self.path))
+        if remove_iteration:
+            paths = [os.path.join(self.path, name) for name in
+                cache.listdir(self.path)]
+            keep  = []
+        else:
+            paths = [os.path.join(self.path, event, name) for event in
+                cache.listdir(self.path) if event != 'mesh' and
+                cache.isdir(os.path.join(self.path, event))
+                for name in CLEAN_DIRECTORIES]
+        paths = [path for path in paths if cache.lexists(path)]
+
+        def worker(path):
+            try:
+                info = cache.lstat(path)
+                if stat.S_ISDIR(info.st_mode):
+                    return path, remove_tree(path, cache, keep, dry_run), None
+                if not dry_run:
+                    os.remove(path)
+                    cache.remove(path)
+                return path, {'files': 0, 'links': 1, 'dirs': 0, 'bytes': 0,
+                    'kept': False} if stat.S_ISLNK(info.st_mode) else {
+                    'files': 1, 'links': 0, 'dirs': 0, 'bytes': info.st_size,
+                    'kept': False}, None
+            except (IOError, OSError) as exception:
+                return path, None, exception
+
+        print_ylw('%s %s (%d directories, keeping %s)...' % ('Sizing up' if
+            dry_run else 'Cleaning', self.name, len(paths),
+            'nothing' if remove_iteration else retention))
+        start    = time.time()
+        totals   = {'files': 0, 'links': 0, 'dirs': 0, 'bytes': 0}
+        failures = []
+        with self.profiler.stage('clean'):
+            pool = thread_pool(self.options.jobs)
+            try:
+                for path, counts, exception in pool.imap_unordered(worker,
+                    paths):
+                    if exception is not None:
+                        failures.append((path, exception))
+                        continue
+                    for key in totals:
+                        totals[key] += counts[key]
+                    if not dry_run and not remove_iteration and \
+                        not counts['kept']:
+                        mkdir_p(path)
+            finally:
+                pool.close()
+                pool.join()
+            self.profiler.count('unlink', totals['files'] + totals['links'])
+            self.profiler.count('rmdir', totals['dirs'])
+            self.profiler.count('metadata_calls', cache.calls)
+            self.profiler.count('metadata_saved', cache.saved)
+
+        if not dry_run:
+            if remove_iteration:
+                if not failures:
+                    os.rmdir(self.path)
+                manifest_path = os.path.join(self.project.root_path,
+                    'manifests', self.name + '.json')
+                if os.path.exists(manifest_path):
+                    os.remove(manifest_path)
+                self.state.clear_iteration(self.name)
+            else:
+                self.state.clear(self.name, 'linked')
+                self.state.clear(self.name, 'prepare_solve')
+
+        print_blu('%s %d files, %d links and %d directories, %.1f MB %s, in '
+            '%s.' % ('Would delete' if dry_run else 'Deleted',
+            totals['files'], totals['links'], totals['dirs'],
+            totals['bytes'] / 1024.0 ** 2, 'to reclaim' if dry_run else
+            'reclaimed', format_elapsed(time.time() - start)))
+        for path, exception in failures:
+            print_ylw('Failed to delete %s: %s' % (path, exception))
+        if failures:
+            raise PathError('Failed to delete %d directories.' % (
+                len(failures)))
+        return totals
+
+    def write_prepare_solve_script(self, path):
+        """
+        Writes a single task batch script that runs prepare_solve for the
+        iteration with the project's options.
+
+        :path: Script file.
+        """
+
+        options = self.options
+        command = self.project.cli_command([self.name], '--prepare_solve',
+            '--link_mode', options.link_mode)
+        if options.profile:
+            command.append('--profile')
+        write_job_script(path, 'prepare_solve_%s' % (self.name), command,
+            options.prepare_time, os.path.join(self.project.root_path, 'logs',
+            'prepare_solve_%s_%%j.log' % (self.name)))
+
+    def pipeline(self, first_job=None, last_job=None):
+        """
+        Runs the iteration through the queue: sets up the run here (with the
+        distribute option, queues it for staging workers, and the mesher
+        waits for their merge job), then submits the mesher, a prepare_solve
+        job that starts when the mesher succeeds, and the solver arrays,
+        which start when prepare_solve succeeds. If a job fails, the jobs
+        depending on it are cancelled by slurm rather than left pending.
+
+        :first_job: First job array index to submit (default: 0).
+        :last_job: Last job array index to submit (default: the last event).
+        """
+
+        staged_by = self.setup_run()
+
+        if first_job is None:
+            first_job, last_job = 0, len(self.event_names()) - 1
+        if self.options.dry_run:
+            print '  submit     : mesher, then prepare_solve, then solver '\
+                'indices %s-%s' % (first_job, last_job)
+            return
+
+        mesher_id = self.submit_mesher(['--dependency=afterok:' + staged_by,
+            '--kill-on-invalid-dep=yes'] if staged_by else [])
+
+        script = os.path.join(self.project.root_path, 'jobs',
+            'prepare_solve_%s.sbatch' % (self.name))
+        self.write_prepare_solve_script(script)
+        with self.profiler.stage('submit'):
+            prepare_id = run_sbatch(self.project.sbatch_command(),
+                ['--dependency=afterok:' + mesher_id,
+                '--kill-on-invalid-dep=yes', script], self.project.root_path,
+                self.options.sbatch_retries)
+            self.profiler.count('sbatch')
+        self.state.record_job(self.name, 'prepare_solve', prepare_id)
+        print_blu('Submitted prepare_solve as job %s, after mesher %s.' % (
+            prepare_id, mesher_id))
+
+        self.submit_solver(first_job, last_job, ['--dependency=afterok:' +
+            prepare_id, '--kill-on-invalid-dep=yes'])
+        print_blu('Pipeline for %s submitted.' % (self.name))
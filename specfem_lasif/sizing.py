@@ -0,0 +1,302 @@
+"""
+Estimates of what runs cost: relative event costs for ordering submissions,
+and job resources from the Par_file.
+"""
+
+import os
+import collections
+
+from specfem_lasif.build import parse_build_variant
+from specfem_lasif.errors import ParameterError
+from specfem_lasif.util import parse_par_file, par_file_flag, \
+    parse_fortran_float
+
+# Relative solver cost of an event: the record length (the number of time
+# steps) times a little extra per station for the seismograms, and more for
+# a run with adjoint sources (forward, backward and kernels).
+STATION_COST = 0.001
+
+ADJOINT_COST = 2.5
+
+# Time limits asked for per chunk: the estimate for its most expensive event
+# with some margin, rounded up to whole minutes, and never less than this.
+TIME_LIMIT_MARGIN  = 1.25
+
+TIME_LIMIT_MINIMUM = 10 * 60
+
+# The inputs in an event's DATA directory that its cost is estimated from.
+COST_INPUTS = ['Par_file', 'STATIONS', 'CMTSOLUTION']
+
+def _bundled_inputs(event_path):
+    """
+    Reads the COST_INPUTS of an event whose inputs are bundled, from its
+    bundle and the shared one, in the order unpack_bundle.sh unpacks them
+    (so the shared Par_file wins). Returns {name: contents}.
+    
+    :event_path: Event directory.
+    """
+    
+    import tarfile
+    bundle_path = os.path.join(os.path.dirname(event_path), 'bundles')
+    inputs = {}
+    for name in [os.path.basename(event_path) + '.tar', 'shared.tar']:
+        path = os.path.join(bundle_path, name)
+        if not os.path.exists(path):
+            continue
+        archive = tarfile.open(path, 'r')
+        try:
+            for member in archive.getmembers():
+                directory, name = os.path.split(member.name)
+                if member.isfile() and directory == 'DATA' and \
+                    name in COST_INPUTS:
+                    inputs[name] = archive.extractfile(member).read()
+        finally:
+            archive.close()
+    return inputs
+
+def estimate_event_cost(event_path):
+    """
+    Estimates the relative solver cost of a staged event from its DATA
+    directory, or from its bundles if its inputs are bundled:
+    RECORD_LENGTH_IN_MINUTES from the Par_file, the number of stations in
+    STATIONS and whether there are adjoint sources in SEM. Returns a
+    dictionary with the inputs and the cost, which is 0 for an event without
+    a CMTSOLUTION (nothing to run).
+    
+    :event_path: Event directory.
+    """
+    
+    data_path = os.path.join(event_path, 'DATA')
+    inputs = {}
+    for name in COST_INPUTS:
+        if os.path.exists(os.path.join(data_path, name)):
+            with open(os.path.join(data_path, name), 'r') as file:
+                inputs[name] = file.read()
+    if 'CMTSOLUTION' not in inputs:
+        inputs = _bundled_inputs(event_path) or inputs
+    par_file = parse_par_file(inputs.get('Par_file', '').splitlines())
+    entry = {
+        'record_length': parse_fortran_float(par_file.get(
+            'RECORD_LENGTH_IN_MINUTES', '0')),
+        'stations':      sum(1 for line in inputs.get('STATIONS', 
+            '').splitlines() if line.strip()),
+        'adjoint':       os.path.isdir(os.path.join(event_path, 'SEM')) and
+            len(os.listdir(os.path.join(event_path, 'SEM'))) > 0,
+    }
+    entry['cost'] = 0.0
+    if 'CMTSOLUTION' in inputs:
+        entry['cost'] = entry['record_length'] * (1 + STATION_COST * 
+            entry['stations']) * (ADJOINT_COST if entry['adjoint'] else 1)
+    return entry
+
+def cost_ordered_chunks(indices, costs, size):
+    """
+    Splits job array indices into chunks of at most size indices, most
+    expensive first, so each chunk holds events of similar cost.
+    
+    :indices: Job array indices.
+    :costs: Cost of each index.
+    :size: Maximum chunk size.
+    """
+    
+    indices = sorted(set(indices), key=lambda index: (-costs.get(index, 0), 
+        index))
+    return [indices[i:i+size] for i in range(0, len(indices), size)]
+
+def format_time_limit(seconds):
+    """
+    Time limit for an estimated run time, with the margin, as a slurm
+    [days-]hours:minutes:seconds string.
+    
+    :seconds: Estimated run time.
+    """
+    
+    seconds = seconds * TIME_LIMIT_MARGIN
+    minutes = int(max(seconds, TIME_LIMIT_MINIMUM) + 59) // 60
+    days, minutes  = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    if days:
+        return '%d-%02d:%02d:00' % (days, hours, minutes)
+    return '%02d:%02d:00' % (hours, minutes)
+
+def chunk_time_limit(chunk, costs, seconds_per_cost):
+    """
+    Time limit for a chunk: that of its most expensive event.
+    
+    :chunk: Job array indices.
+    :costs: Cost of each index.
+    :seconds_per_cost: Solver wall time per unit of cost.
+    """
+    
+    return format_time_limit(max(costs.get(index, 0) for index in chunk) * 
+        seconds_per_cost)
+
+# Rough model of a specfem3d_globe run, for sizing jobs from the Par_file.
+# A chunk has about NEX_XI * NEX_ETA elements per radial layer, with a number
+# of layers that grows with NEX (less than linearly, due to the doublings).
+# The time step shrinks as 1/NEX from about REFERENCE_DT at NEX = 256. The
+# per element numbers are for Piz Daint and are worth recalibrating against
+# the mesher's and solver's output_*.txt after a change of machine.
+MIN_RADIAL_LAYERS         = 4
+
+NEX_PER_RADIAL_LAYER      = 32
+
+REFERENCE_NEX             = 256
+
+REFERENCE_DT              = 0.15
+
+MESHER_BYTES_PER_ELEMENT  = 48 * 1024
+
+SOLVER_BYTES_PER_ELEMENT  = 16 * 1024
+
+MESHER_SECONDS_PER_ELEMENT = 2e-3
+
+SOLVER_SECONDS_PER_ELEMENT_STEP = {'cpu': 5e-6, 'gpu': 1e-7}
+
+# sbatch options set by the rendered scripts, with their short forms.
+SIZED_OPTIONS = collections.OrderedDict([('nodes', '-N'), ('ntasks', '-n'), 
+    ('ntasks-per-node', None), ('time', '-t')])
+
+def par_file_int(par_file, name):
+    """
+    Reads an integer parameter from a Par_file dictionary.
+    
+    :par_file: Par_file parameters, from read_par_file.
+    :name: Parameter name.
+    """
+    
+    try:
+        return int(par_file[name])
+    except (KeyError, ValueError):
+        raise ParameterError('The Par_file has no integer %s.' % (name))
+
+def size_jobs(par_file, gpu=False, cores_per_node=12, gpus_per_node=1, 
+    node_memory=64):
+    """
+    Works out the MPI ranks of a run from its Par_file, and estimates the
+    memory and time the mesher and the solver need, and the nodes to ask for.
+    The mesher always runs on the CPUs, the solver on a GPU per rank with
+    gpu. Returns a dictionary with an entry per job (mesher, solver) of the
+    sbatch options to set, as well as the estimates.
+    
+    :par_file: Par_file parameters, from read_par_file.
+    :gpu: Whether the solver runs on GPUs.
+    :cores_per_node: CPU cores per node.
+    :gpus_per_node: GPUs per node.
+    :node_memory: Memory per node, in GB.
+    """
+    
+    nex_xi, nex_eta = (par_file_int(par_file, name) for name in 
+        ('NEX_XI', 'NEX_ETA'))
+    ranks = par_file_int(par_file, 'NCHUNKS') * par_file_int(par_file, 
+        'NPROC_XI') * par_file_int(par_file, 'NPROC_ETA')
+    layers   = max(MIN_RADIAL_LAYERS, nex_xi // NEX_PER_RADIAL_LAYER)
+    elements = par_file_int(par_file, 'NCHUNKS') * nex_xi * nex_eta * layers
+    per_rank = elements / float(ranks)
+    record_length = parse_fortran_float(par_file.get(
+        'RECORD_LENGTH_IN_MINUTES', '0'))
+    steps = record_length * 60 / (REFERENCE_DT * REFERENCE_NEX / 
+        max(nex_xi, nex_eta))
+    
+    sizes = {'ranks': ranks, 'elements': elements, 'steps': int(steps)}
+    for job, bytes_per_element, seconds, on_gpu in [
+        ('mesher', MESHER_BYTES_PER_ELEMENT, per_rank * 
+            MESHER_SECONDS_PER_ELEMENT, False),
+        ('solver', SOLVER_BYTES_PER_ELEMENT, per_rank * steps * 
+            SOLVER_SECONDS_PER_ELEMENT_STEP['gpu' if gpu else 'cpu'], gpu)]:
+        memory = per_rank * bytes_per_element / 1024.0 ** 3
+        slots  = gpus_per_node if on_gpu else cores_per_node
+        per_node = min(slots, int(node_memory // memory) if memory else slots)
+        if per_node < 1:
+            raise ParameterError('A %s rank needs about %.1f GB, more than a '
+                'node has (%d GB). Use more ranks (NPROC_XI, NPROC_ETA).' % (
+                job, memory, node_memory))
+        nodes = (ranks + per_node - 1) // per_node
+        sizes[job] = {
+            'memory': memory,
+            'seconds': seconds,
+            'options': collections.OrderedDict([
+                ('nodes', nodes), 
+                ('ntasks', ranks), 
+                ('ntasks-per-node', min(per_node, ranks)), 
+                ('time', format_time_limit(seconds))]),
+        }
+    return sizes
+
+def solver_runs_on_gpu(par_file, variant):
+    """
+    Whether the solver runs on GPUs: GPU_MODE in the Par_file, or a cuda
+    build.
+    
+    :par_file: Par_file parameters, from read_par_file.
+    :variant: Build variant the solver runs.
+    """
+    
+    compiler_suite, _ = parse_build_variant(variant)
+    return par_file_flag(par_file.get('GPU_MODE', '.false.')) or \
+        'cuda' in compiler_suite
+
+def sbatch_options(script):
+    """
+    Reads the #SBATCH options in a job script's header, by long name.
+    
+    :script: Job script.
+    """
+    
+    short_names = dict((short, name) for name, short in 
+        SIZED_OPTIONS.items() if short)
+    options = {}
+    with open(script, 'r') as file:
+        for line in file:
+            if not line.startswith('#SBATCH'):
+                continue
+            option = line[len('#SBATCH'):].split('#')[0].strip()
+            if option.startswith('--'):
+                name, _, value = option[2:].replace('=', ' ', 1).partition(
+                    ' ')
+            else:
+                name, _, value = option.partition(' ')
+                name = short_names.get(name, name)
+            options[name] = value.strip()
+    return options
+
+def render_sbatch_script(source, dest, options):
+    """
+    Writes a copy of a job script with the given options in its #SBATCH
+    header, replacing the script's own settings of them. Returns dest.
+    
+    :source: Job script.
+    :dest: Rendered script.
+    :options: OrderedDict of sbatch option names and values.
+    """
+    
+    names = set()
+    for name in options:
+        names.add('--' + name)
+        if SIZED_OPTIONS.get(name):
+            names.add(SIZED_OPTIONS[name])
+    
+    with open(source, 'r') as file:
+        lines = file.read().splitlines()
+    
+    # The options go where the header starts, or after the shebang.
+    kept, position = [], None
+    for line in lines:
+        if line.startswith('#SBATCH'):
+            if position is None:
+                position = len(kept)
+            option = line[len('#SBATCH'):].split()
+            if option and option[0].split('=')[0] in names:
+                continue
+        kept.append(line)
+    if position is None:
+        position = int(bool(kept) and kept[0].startswith('#!'))
+    kept[position:position] = ['#SBATCH --%s=%s' % (name, value) for 
+        name, value in options.items()]
+    
+    temp_path = dest + '.tmp'
+    with open(temp_path, 'w') as file:
+        file.write('\n'.join(kept) + '\n')
+    os.chmod(temp_path, os.stat(source).st_mode & 07777)
+    os.rename(temp_path, dest)
+    return dest
@@ -0,0 +1,296 @@
+"""
+Submitting jobs with sbatch and querying their states with sacct.
+"""
+
+import os
+import subprocess
+import json
+import random
+import re
+import time
+
+from specfem_lasif.errors import SubmissionError
+from specfem_lasif.util import mkdir_p, print_ylw, thread_pool
+
+# sbatch prints 'Submitted batch job <id>', or '<id>[;<cluster>]' with
+# --parsable.
+SBATCH_JOB_ID_PATTERN = re.compile(
+    r'Submitted batch job (\d+)|^(\d+)(?:;\S+)?\s*$', re.MULTILINE)
+
+# sbatch errors that are worth retrying: the controller being busy or
+# unreachable. Submit limits (MaxSubmit...) aren't: they only clear as jobs
+# finish, which takes far longer than a few retries wait for, so those
+# chunks are reported as failed for resubmitting later.
+SBATCH_TRANSIENT_PATTERN = re.compile(r'timed out|temporarily|try again|'
+    r'unable to contact slurm controller|socket', re.IGNORECASE)
+
+def compact_ranges(indices):
+    """
+    Writes job array indices as a slurm --array specification, e.g.
+    [0, 1, 2, 3, 7] as '0-3,7'.
+    
+    :indices: Job array indices.
+    """
+    
+    ranges = []
+    for index in sorted(set(indices)):
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ','.join(str(first) if first == last else '%d-%d' % (first, last)
+        for first, last in ranges)
+
+def chunk_indices(indices, size):
+    """
+    Splits job array indices into chunks spanning fewer than size indices
+    each (so at most size indices), which can all be submitted below
+    slurm's MaxArraySize of size, see array_offset.
+    
+    :indices: Job array indices.
+    :size: MaxArraySize, the maximum chunk size.
+    """
+    
+    chunks = []
+    for index in sorted(set(indices)):
+        if chunks and index - chunks[-1][0] < size:
+            chunks[-1].append(index)
+        else:
+            chunks.append([index])
+    return chunks
+
+def array_offset(chunk, size):
+    """
+    What to subtract from the job array indices of a chunk to submit it.
+    slurm rejects array indices at or above MaxArraySize, so chunks that
+    reach that far are submitted from 0 instead, and the job script adds
+    the offset (exported as ARRAY_INDEX_OFFSET) back. Chunks below it keep
+    their indices.
+    
+    :chunk: Job array indices, spanning fewer than size indices.
+    :size: MaxArraySize.
+    """
+    
+    return 0 if size is None or max(chunk) < size else min(chunk)
+
+def script_reads_offset(script_path):
+    """
+    Whether a job array script adds ARRAY_INDEX_OFFSET back to its array
+    index, so chunks can be submitted with an offset, see array_offset.
+    
+    :script_path: Job array script.
+    """
+    
+    try:
+        with open(script_path, 'r') as file:
+            return 'ARRAY_INDEX_OFFSET' in file.read()
+    except IOError:
+        return False
+
+def run_sbatch(sbatch_command, arguments, cwd, retries=3, backoff=2.0):
+    """
+    Submits a job and returns its job ID. Transient sbatch failures are
+    retried with exponential backoff (plus some jitter, so that concurrent
+    submissions don't retry in lock step); anything else raises a
+    SubmissionError straight away.
+    
+    :sbatch_command: sbatch command as a list, e.g. ['sbatch'].
+    :arguments: Arguments to sbatch.
+    :cwd: Directory to submit from.
+    :retries: Number of retries after the first attempt.
+    :backoff: Wait before the first retry, in seconds. Doubles every retry.
+    """
+    
+    command = list(sbatch_command) + list(arguments)
+    for attempt in range(retries + 1):
+        try:
+            process = subprocess.Popen(command, cwd=cwd, 
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as exception:
+            raise SubmissionError('Could not run %s: %s' % (command[0], 
+                exception))
+        output, _ = process.communicate()
+        match = SBATCH_JOB_ID_PATTERN.search(output)
+        if process.returncode == 0 and match:
+            return match.group(1) or match.group(2)
+        if process.returncode == 0:
+            raise SubmissionError('No job ID in the output of %s:\n%s' % (
+                ' '.join(command), output.strip()))
+        if attempt == retries or not SBATCH_TRANSIENT_PATTERN.search(output):
+            raise SubmissionError('%s failed:\n%s' % (' '.join(command), 
+                output.strip()))
+        wait = backoff * 2 ** attempt + random.uniform(0, backoff)
+        print_ylw('sbatch failed (%s), retrying in %.0fs...' % (
+            output.strip().splitlines()[-1] if output.strip() else 
+            'exit code %d' % (process.returncode), wait))
+        time.sleep(wait)
+
+def submit_array_chunks(sbatch_command, script, script_arguments, chunks, 
+    cwd, record, workers=4, retries=3, sbatch_arguments=(), 
+    chunk_arguments=None, max_array_size=None):
+    """
+    Submits a job array script as one array job per chunk of indices, with a
+    bounded number of concurrent sbatch calls. Every chunk's job ID is
+    recorded as soon as it is known. Each chunk's array indices are shifted
+    by its array_offset, which the job gets as ARRAY_INDEX_OFFSET, so the
+    job array index of a task is $((SLURM_ARRAY_TASK_ID + ARRAY_INDEX_OFFSET)).
+    Chunks are only shifted if the script reads ARRAY_INDEX_OFFSET: for any
+    other script, a SubmissionError is raised before anything is submitted,
+    since it would run the wrong events.
+    
+    :sbatch_command: sbatch command as a list.
+    :script: Job array script.
+    :script_arguments: Arguments to the script.
+    :chunks: Lists of job array indices, e.g. from chunk_indices.
+    :cwd: Directory to submit from.
+    :record: Called with each chunk, its job ID and its array offset once
+        it's submitted.
+    :workers: Maximum number of concurrent sbatch calls. With 1, the chunks
+        are submitted in order.
+    :retries: Retries per chunk on transient failures.
+    :sbatch_arguments: Extra sbatch options for every chunk, e.g. a
+        dependency.
+    :chunk_arguments: Optional function giving extra sbatch options for a
+        chunk, e.g. its time limit.
+    :max_array_size: slurm's MaxArraySize, see array_offset (default: no
+        limit).
+    
+    Returns a list of (chunk, job_id, exception), in chunk order.
+    """
+    
+    shifted = [chunk for chunk in chunks if array_offset(chunk, 
+        max_array_size)]
+    if shifted and not script_reads_offset(os.path.join(cwd, script)):
+        raise SubmissionError('Indices %s reach MaxArraySize (%d), so they '
+            'can only be submitted from 0, with the offset in '
+            'ARRAY_INDEX_OFFSET, which %s does not read. Take the event index '
+            'as $((SLURM_ARRAY_TASK_ID + ARRAY_INDEX_OFFSET)) in the script, '
+            'or raise --max_array_size if slurm allows.' % (compact_ranges(
+            index for chunk in shifted for index in chunk), max_array_size,
+            script))
+    
+    def submit(chunk):
+        # The offset is only exported where there is one, since --export
+        # overrides the script's own.
+        offset = array_offset(chunk, max_array_size)
+        arguments = list(sbatch_arguments) + (chunk_arguments(chunk) if 
+            chunk_arguments else []) + (['--export=ALL,ARRAY_INDEX_OFFSET=%d'
+            % (offset)] if offset else []) + ['--array=' + compact_ranges(
+            index - offset for index in chunk), script] + list(
+            script_arguments)
+        try:
+            job_id = run_sbatch(sbatch_command, arguments, cwd, retries)
+        except SubmissionError as exception:
+            return chunk, None, exception
+        record(chunk, job_id, offset)
+        return chunk, job_id, None
+        
+    pool = thread_pool(min(workers, len(chunks)))
+    try:
+        return pool.map(submit, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+# How sacct job states count for an event that hasn't written its completion
+# marker. Anything else (PENDING, RUNNING, REQUEUED, ...) is still active.
+FAILED_JOB_STATES = ['FAILED', 'TIMEOUT', 'CANCELLED', 'NODE_FAIL', 
+    'OUT_OF_MEMORY', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE', 'COMPLETED']
+
+# specfem writes this to OUTPUT_FILES/output_solver.txt when it's done.
+SOLVER_DONE_MARKER = 'End of the simulation'
+
+def expand_array_job_id(job_id):
+    """
+    Expands a sacct job ID into (array job ID, index) pairs. Array elements
+    that haven't started are listed together, e.g. '1005_[4-6,9%2]'. Returns
+    [(job_id, None)] for jobs that aren't array elements.
+    
+    :job_id: Job ID as printed by sacct.
+    """
+    
+    array_job_id, _, indices = job_id.partition('_')
+    if not indices:
+        return [(job_id, None)]
+    indices = indices.strip('[]').split('%')[0]
+    expanded = []
+    for part in indices.split(','):
+        first, _, last = part.partition('-')
+        expanded.extend((array_job_id, index) for index in 
+            range(int(first), int(last or first) + 1))
+    return expanded
+
+def query_job_states(sacct_command, job_ids, cache_path, ttl=60):
+    """
+    Looks up the states of a set of jobs (and all their array elements) in a
+    single sacct call. The answer is cached for ttl seconds, so repeated
+    status checks don't load the slurm database.
+    
+    :sacct_command: sacct command as a list.
+    :job_ids: Job IDs; array job IDs cover all their elements.
+    :cache_path: Json cache file.
+    :ttl: Cache lifetime in seconds.
+    
+    Returns a dictionary with the state of every job ('<id>') and array
+    element ('<array id>_<index>'), and whether it came from the cache.
+    """
+    
+    job_ids = sorted(set(job_ids))
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as file:
+            cache = json.load(file)
+        if cache['job_ids'] == job_ids and time.time() - cache['time'] < ttl:
+            return cache['states'], True
+    if not job_ids:
+        return {}, False
+    
+    command = list(sacct_command) + ['--jobs=' + ','.join(job_ids), 
+        '--allocations', '--noheader', '--parsable2', 
+        '--format=JobID,State']
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, 
+            stderr=subprocess.PIPE)
+    except OSError as exception:
+        raise SubmissionError('Could not run %s: %s' % (command[0], 
+            exception))
+    output, errors = process.communicate()
+    if process.returncode != 0:
+        raise SubmissionError('%s failed:\n%s' % (' '.join(command), 
+            errors.strip()))
+        
+    states = {}
+    for line in output.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) < 2:
+            continue
+        # e.g. 'CANCELLED by 1234'.
+        state = fields[1].split()[0] if fields[1].strip() else 'UNKNOWN'
+        for array_job_id, index in expand_array_job_id(fields[0]):
+            key = array_job_id if index is None else '%s_%d' % (
+                array_job_id, index)
+            states[key] = state
+            
+    mkdir_p(os.path.dirname(cache_path))
+    temp_path = cache_path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump({'time': time.time(), 'job_ids': job_ids, 
+            'states': states}, file)
+    os.rename(temp_path, cache_path)
+    return states, False
+
+def solver_finished(event_path):
+    """
+    Checks for specfem's completion marker at the end of the solver output
+    of an event. Only reads the last few kB.
+    
+    :event_path: Event directory.
+    """
+    
+    path = os.path.join(event_path, 'OUTPUT_FILES', 'output_solver.txt')
+    try:
+        with open(path, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            file.seek(max(0, file.tell() - 4096))
+            return SOLVER_DONE_MARKER in file.read()
+    except IOError:
+        return False
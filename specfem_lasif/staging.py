@@ -0,0 +1,942 @@
+"""
+Placing files in the run directories: the directory metadata cache, the copy
+engine, links, staging manifests and bundles.
+"""
+
+import os, errno, shutil, stat
+import collections
+import hashlib
+import json
+import threading
+
+from specfem_lasif.errors import PathError
+from specfem_lasif.util import scandir, mkdir_p, print_blu, print_ylw, \
+    thread_pool
+
+# fcntl gives us reflinks (FICLONE) on filesystems that support them.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ctypes gives us the kernel side copy calls pythons before 3.8 don't have.
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+class DirCache(object):
+    """
+    Directory metadata for one stage. Each directory is listed (with scandir
+    where we have it, which also gives the file types) the first time
+    anything in it is looked up; after that, lookups in it cost nothing.
+    Stats are cached per path. The stage keeps the cache up to date as it
+    creates and removes entries. Counts the metadata calls it made and the
+    lookups it answered without one.
+    """
+    
+    def __init__(self):
+        self.listings = {}
+        self.stats    = {}
+        self.lstats   = {}
+        self.calls    = 0
+        self.saved    = 0
+        self.lock     = threading.Lock()
+        
+    def _count(self, calls=0, saved=0):
+        with self.lock:
+            self.calls += calls
+            self.saved += saved
+        
+    def entries(self, path):
+        """
+        Returns {name: is_dir} for a directory, listing it if needed. is_dir
+        is None until known when scandir isn't available.
+        
+        :path: Directory.
+        """
+        
+        listing = self.listings.get(path)
+        if listing is not None:
+            self._count(saved=1)
+            return listing
+        if scandir is None:
+            listing = dict.fromkeys(os.listdir(path))
+        else:
+            listing = dict((entry.name, entry.is_dir()) for entry in 
+                scandir(path))
+        self._count(calls=1)
+        with self.lock:
+            self.listings[path] = listing
+        return listing
+    
+    def listdir(self, path):
+        """
+        Names in a directory.
+        
+        :path: Directory.
+        """
+        
+        return list(self.entries(path))
+    
+    def _parent_listing(self, path):
+        parent, name = os.path.split(path)
+        try:
+            return self.entries(parent), name
+        except OSError as exception:
+            if exception.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return {}, name
+    
+    def lexists(self, path):
+        """
+        Whether an entry exists (a link counts, whether or not its target
+        does).
+        
+        :path: Path.
+        """
+        
+        listing, name = self._parent_listing(path)
+        return name in listing
+    
+    def isdir(self, path):
+        """
+        Whether path is a directory (following links).
+        
+        :path: Path.
+        """
+        
+        listing, name = self._parent_listing(path)
+        if name not in listing:
+            return False
+        if listing[name] is None:
+            listing[name] = os.path.isdir(path)
+            self._count(calls=1)
+        return listing[name]
+    
+    def stat(self, path):
+        """
+        os.stat of a path, once.
+        
+        :path: Path.
+        """
+        
+        info = self.stats.get(path)
+        if info is not None:
+            self._count(saved=1)
+            return info
+        info = os.stat(path)
+        self._count(calls=1)
+        with self.lock:
+            self.stats[path] = info
+        return info
+    
+    def lstat(self, path):
+        """
+        os.lstat of a path, once.
+        
+        :path: Path.
+        """
+        
+        info = self.lstats.get(path)
+        if info is not None:
+            self._count(saved=1)
+            return info
+        info = os.lstat(path)
+        self._count(calls=1)
+        with self.lock:
+            self.lstats[path] = info
+        return info
+    
+    def add(self, path, is_dir=False):
+        """
+        Records an entry the stage created.
+        
+        :path: Path.
+        :is_dir: Whether it's a directory.
+        """
+        
+        parent, name = os.path.split(path)
+        with self.lock:
+            self.stats.pop(path, None)
+            self.lstats.pop(path, None)
+            if parent in self.listings:
+                self.listings[parent][name] = is_dir
+                
+    def remove(self, path):
+        """
+        Records an entry the stage removed.
+        
+        :path: Path.
+        """
+        
+        parent, name = os.path.split(path)
+        with self.lock:
+            self.stats.pop(path, None)
+            self.lstats.pop(path, None)
+            self.listings.pop(path, None)
+            if parent in self.listings:
+                self.listings[parent].pop(name, None)
+                
+    def forget(self, path):
+        """
+        Drops everything cached about a directory the stage changed
+        wholesale, so it's listed again.
+        
+        :path: Directory.
+        """
+        
+        with self.lock:
+            self.listings.pop(path, None)
+            for stats in [self.stats, self.lstats]:
+                for name in [name for name in stats if 
+                    os.path.dirname(name) == path]:
+                    del stats[name]
+
+# ioctl that makes dest share source's blocks (a reflink), from linux/fs.h.
+FICLONE = 0x40049409
+
+# Errors meaning a copy method isn't supported for this pair of files, so the
+# next one should be tried.
+COPY_FALLBACK_ERRNOS = set([errno.EXDEV, errno.EINVAL, errno.ENOTTY, 
+    errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EPERM, errno.EBADF])
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Copy methods known not to work, per (source device, dest device), so that
+# each file doesn't have to find out again.
+_unsupported_copy_methods = {}
+
+def _copy_reflink(source_fd, dest_fd, size):
+    fcntl.ioctl(dest_fd, FICLONE, source_fd)
+
+def _libc_function(name, *argtypes):
+    """
+    A function from the C library through ctypes, for the kernel side copy
+    calls this python's os module doesn't have. Returns None where it isn't
+    available.
+    
+    :name: Function name.
+    :argtypes: Argument types.
+    """
+    
+    try:
+        function = getattr(ctypes.CDLL(None, use_errno=True), name)
+    except (OSError, AttributeError):
+        return None
+    function.argtypes = list(argtypes)
+    function.restype  = ctypes.c_ssize_t
+    
+    def call(*arguments):
+        result = function(*arguments)
+        if result < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return result
+    return call
+
+if hasattr(os, 'copy_file_range'):
+    _copy_file_range_call = os.copy_file_range
+elif ctypes is not None:
+    # ssize_t copy_file_range(int fd_in, loff_t *off_in, int fd_out, 
+    #     loff_t *off_out, size_t len, unsigned int flags), with the offsets
+    # left to the file positions.
+    _libc_copy_file_range = _libc_function('copy_file_range', ctypes.c_int, 
+        ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, 
+        ctypes.c_uint)
+    _copy_file_range_call = _libc_copy_file_range and (lambda source_fd, 
+        dest_fd, count: _libc_copy_file_range(source_fd, None, dest_fd, None,
+        count, 0))
+else:
+    _copy_file_range_call = None
+
+if hasattr(os, 'sendfile'):
+    _sendfile_call = lambda dest_fd, source_fd, count: os.sendfile(dest_fd, 
+        source_fd, None, count)
+elif ctypes is not None:
+    # ssize_t sendfile(int out_fd, int in_fd, off_t *offset, size_t count),
+    # from the source's file position.
+    _libc_sendfile = _libc_function('sendfile', ctypes.c_int, ctypes.c_int,
+        ctypes.c_void_p, ctypes.c_size_t)
+    _sendfile_call = _libc_sendfile and (lambda dest_fd, source_fd, count:
+        _libc_sendfile(dest_fd, source_fd, None, count))
+else:
+    _sendfile_call = None
+
+# The kernel side copies move both file positions along, so when one stops
+# short (some filesystems copy nothing and return 0), the rest is copied
+# through a buffer from where it stopped. copy_file_contents checks the size.
+def _copy_file_range(source_fd, dest_fd, size):
+    copied = 0
+    while copied < size:
+        n = _copy_file_range_call(source_fd, dest_fd, size - copied)
+        if n == 0:
+            _copy_chunked(source_fd, dest_fd, size - copied)
+            break
+        copied += n
+
+def _copy_sendfile(source_fd, dest_fd, size):
+    copied = 0
+    while copied < size:
+        n = _sendfile_call(dest_fd, source_fd, size - copied)
+        if n == 0:
+            _copy_chunked(source_fd, dest_fd, size - copied)
+            break
+        copied += n
+
+def _copy_chunked(source_fd, dest_fd, size):
+    while True:
+        chunk = os.read(source_fd, COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        while chunk:
+            chunk = chunk[os.write(dest_fd, chunk):]
+
+# Ways of copying file contents, fastest first: share the blocks, copy them
+# in the kernel, or stream them through a buffer. The kernel side calls come
+# from the os module in newer pythons, or from the C library through ctypes.
+COPY_METHODS = [('reflink', _copy_reflink)]
+if _copy_file_range_call:
+    COPY_METHODS.append(('copy_file_range', _copy_file_range))
+if _sendfile_call:
+    COPY_METHODS.append(('sendfile', _copy_sendfile))
+COPY_METHODS.append(('chunked', _copy_chunked))
+if fcntl is None:
+    COPY_METHODS.pop(0)
+
+def copy_file_contents(source, dest_file):
+    """
+    Copies a file's contents and permission bits, like shutil.copy, using the
+    fastest copy method the two filesystems support.
+    
+    :source: Source file.
+    :dest_file: Destination file.
+    
+    Returns the number of bytes copied.
+    """
+    
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        info    = os.fstat(source_fd)
+        dest_fd = os.open(dest_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 
+            stat.S_IMODE(info.st_mode) | stat.S_IWUSR)
+        try:
+            devices     = (info.st_dev, os.fstat(dest_fd).st_dev)
+            unsupported = _unsupported_copy_methods.setdefault(devices, set())
+            for name, method in COPY_METHODS:
+                if name in unsupported:
+                    continue
+                try:
+                    method(source_fd, dest_fd, info.st_size)
+                    break
+                except (IOError, OSError) as exception:
+                    if name == 'chunked' or exception.errno not in \
+                        COPY_FALLBACK_ERRNOS:
+                        raise
+                    unsupported.add(name)
+                    os.lseek(source_fd, 0, os.SEEK_SET)
+                    os.lseek(dest_fd, 0, os.SEEK_SET)
+                    os.ftruncate(dest_fd, 0)
+            # e.g. the source changed size while it was copied.
+            copied = os.fstat(dest_fd).st_size
+            if copied != info.st_size:
+                raise IOError(errno.EIO, 'Copied %d of %d bytes of %s' % (
+                    copied, info.st_size, source))
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(source_fd)
+    os.chmod(dest_file, stat.S_IMODE(info.st_mode))
+    return info.st_size
+
+def copy_file(source, dest_file):
+    """
+    Copies a file's contents, permission bits and times, like shutil.copy2.
+    
+    :source: Source file.
+    :dest_file: Destination file.
+    
+    Returns the number of bytes copied.
+    """
+    
+    size = copy_file_contents(source, dest_file)
+    shutil.copystat(source, dest_file)
+    return size
+
+def safe_copy(source, dest, cache=None):
+    """
+    Sets up a file copy that won't fail for a stupid reason.
+    
+    :source: Source file.
+    :dest: Destination directory.
+    :cache: Optional DirCache to look up and record entries in.
+    
+    Returns the number of bytes copied (0 if the copy was skipped).
+    """
+    source = os.path.join (source)
+    dest   = os.path.join (dest)
+    isdir  = cache.isdir if cache is not None else os.path.isdir
+
+    if (isdir(source)):
+        return 0
+    if not (isdir(dest)):
+        return 0
+    dest_file = os.path.join(dest, os.path.basename(source))
+    try: 
+        n_bytes = copy_file_contents(source, dest_file)
+    except OSError as exception:    
+        if exception.errno != errno.EEXIST:
+            raise
+        n_bytes = os.path.getsize(source)
+    if cache is not None:
+        cache.add(dest_file)
+    return n_bytes
+
+# Ways of placing a file in a staging directory.
+STAGING_METHODS = ['copy', 'hardlink', 'symlink']
+
+# A single staging operation: the event it belongs to (used to group errors),
+# the source file, the destination directory and how to place the file there.
+CopyTask = collections.namedtuple('CopyTask', ['event', 'source', 'dest', 
+    'method'])
+
+# What the copy engine did with one task. The signature describes the source
+# file as it was staged, and is what ends up in the manifest.
+CopyResult = collections.namedtuple('CopyResult', ['task', 'bytes', 'linked',
+    'skipped', 'signature', 'exception'])
+
+class CopySummary(object):
+    """
+    Totals for one pass of the copy engine. Failures are kept per event so one
+    bad event doesn't hide the others.
+    """
+    
+    def __init__(self):
+        self.files    = 0
+        self.links    = 0
+        self.skipped  = 0
+        self.bytes    = 0
+        self.bundles  = 0
+        self.failures = collections.OrderedDict()
+        self.events   = collections.OrderedDict()
+        
+    def add_failure(self, task, exception):
+        self.failures.setdefault(task.event, []).append((task.source, 
+            exception))
+        
+    def add(self, result):
+        """
+        Adds a successful or skipped CopyResult to the totals.
+        
+        :result: CopyResult.
+        """
+        
+        counts = self.events.setdefault(result.task.event, 
+            {'files': 0, 'links': 0, 'bytes': 0, 'skipped': 0})
+        if result.skipped:
+            self.skipped      += 1
+            counts['skipped'] += 1
+            return
+        self.files      += 1
+        self.links      += result.linked
+        self.bytes      += result.bytes
+        counts['files'] += 1
+        counts['links'] += result.linked
+        counts['bytes'] += result.bytes
+        
+    def report(self):
+        n_failed = sum(len(errors) for errors in self.failures.values())
+        print_blu('Staged %d files (%d linked, %.1f MB copied), %d unchanged '
+            'files skipped, %d failures.' % (self.files, self.links, 
+            self.bytes / 1024.0 ** 2, self.skipped, n_failed))
+        if self.bundles:
+            print_blu('Wrote %d bundles.' % (self.bundles))
+        for event, errors in self.failures.items():
+            for source, exception in errors:
+                print_ylw('  %s: %s (%s)' % (event, source, exception))
+
+def file_md5(filename):
+    """
+    Returns the md5 hex digest of a file, read in chunks.
+    
+    :filename: File to hash.
+    """
+    
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+class StagingManifest(object):
+    """
+    Record of every file staged for an iteration: where it came from, how it
+    was placed, the size, mtime (and optionally md5) of the source at the
+    time and the size and mtime of what it was staged as (the link itself,
+    for links). A rerun only stages sources that are new or changed since
+    then, and destinations that were changed or replaced.
+    """
+    
+    def __init__(self, path, checksum=False):
+        """
+        :path: Manifest file (json). Doesn't need to exist yet.
+        :checksum: Also compare md5 sums of the sources, not just size and
+            mtime.
+        """
+        
+        self.path     = path
+        self.checksum = checksum
+        self.entries  = {}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                self.entries = json.load(file)
+                
+    def signature(self, source, cache=None):
+        """
+        Describes a source file as it is now.
+        
+        :source: Source file.
+        :cache: Optional DirCache, so that a source staged to many
+            directories is only stat'ed once.
+        """
+        
+        info = cache.stat(source) if cache is not None else os.stat(source)
+        return {'size': info.st_size, 'mtime': info.st_mtime,
+            'md5': file_md5(source) if self.checksum else None}
+                
+    def is_current(self, task, signature, cache=None):
+        """
+        Checks whether the destination of a task already holds the staged
+        version of its source.
+        
+        :task: CopyTask.
+        :signature: Current signature of the task's source.
+        :cache: Optional DirCache to look the destination up in.
+        """
+        
+        dest_file = os.path.join(task.dest, os.path.basename(task.source))
+        entry     = self.entries.get(dest_file)
+        if entry is None or entry['source'] != task.source or \
+            entry['method'] != task.method:
+            return False
+        if entry['size'] != signature['size'] or \
+            entry['mtime'] != signature['mtime']:
+            return False
+        if self.checksum and entry['md5'] != signature['md5']:
+            return False
+        if not (cache.lexists(dest_file) if cache is not None else
+            os.path.lexists(dest_file)):
+            return False
+        info = cache.lstat(dest_file) if cache is not None else os.lstat(
+            dest_file)
+        return entry.get('dest_size') == info.st_size and \
+            entry.get('dest_mtime') == info.st_mtime
+        
+    def record(self, task, signature, cache=None):
+        """
+        Marks a task as staged, unless it didn't make its destination (e.g.
+        the destination directory is missing).
+        
+        :task: CopyTask.
+        :signature: Signature of the task's source when it was staged.
+        :cache: Optional DirCache to look the destination up in.
+        """
+        
+        dest_file = os.path.join(task.dest, os.path.basename(task.source))
+        try:
+            info = cache.lstat(dest_file) if cache is not None else os.lstat(
+                dest_file)
+        except OSError as exception:
+            if exception.errno != errno.ENOENT:
+                raise
+            return
+        entry = dict(signature, source=task.source, method=task.method,
+            dest_size=info.st_size, dest_mtime=info.st_mtime)
+        self.entries[dest_file] = entry
+        
+    def bundle_is_current(self, bundle, members):
+        """
+        Checks whether a bundle was written from these members, as they are
+        now.
+        
+        :bundle: Bundle file.
+        :members: Signature of the members, from bundle_members.
+        """
+        
+        entry = self.entries.get(bundle)
+        return entry is not None and entry.get('members') == members and \
+            os.path.exists(bundle)
+        
+    def record_bundle(self, bundle, members):
+        """
+        Marks a bundle as written.
+        
+        :bundle: Bundle file.
+        :members: Signature of the members, from bundle_members.
+        """
+        
+        self.entries[bundle] = {'method': 'bundle', 'members': members}
+        
+    def update(self, entries):
+        """
+        Takes over the entries of another manifest, e.g. one written by a
+        staging worker.
+        
+        :entries: Manifest entries, keyed by destination file.
+        """
+        
+        self.entries.update(entries)
+        
+    def save(self):
+        """
+        Writes the manifest, replacing the old one in a single rename.
+        """
+        
+        mkdir_p(os.path.dirname(self.path))
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.entries, file)
+        os.rename(temp_path, self.path)
+
+class ManifestGroup(object):
+    """
+    Several StagingManifests behind the StagingManifest interface, each for
+    the destinations under one directory (e.g. one per iteration). Anything
+    outside all of them goes to the first.
+    """
+    
+    def __init__(self, manifests):
+        """
+        :manifests: List of (directory, StagingManifest).
+        """
+        
+        self.manifests = [(os.path.join(path, ''), manifest) for path, 
+            manifest in manifests]
+        
+    def _manifest(self, dest):
+        for path, manifest in self.manifests:
+            if dest.startswith(path):
+                return manifest
+        return self.manifests[0][1]
+    
+    def signature(self, source, cache=None):
+        return self.manifests[0][1].signature(source, cache)
+    
+    def is_current(self, task, signature, cache=None):
+        return self._manifest(task.dest).is_current(task, signature, cache)
+    
+    def record(self, task, signature, cache=None):
+        self._manifest(task.dest).record(task, signature, cache)
+        
+    def bundle_is_current(self, bundle, members):
+        return self._manifest(bundle).bundle_is_current(bundle, members)
+    
+    def record_bundle(self, bundle, members):
+        self._manifest(bundle).record_bundle(bundle, members)
+        
+    def update(self, entries):
+        for dest, entry in entries.items():
+            self._manifest(dest).entries[dest] = entry
+        
+    def save(self):
+        for _, manifest in self.manifests:
+            manifest.save()
+
+def add_copy_task(tasks, event, source, dest, method='copy'):
+    """
+    Queues a copy for the copy engine. Tasks are keyed by the destination
+    file, so a later task for the same destination replaces an earlier one,
+    just like the later copy used to overwrite the earlier one.
+    
+    :tasks: OrderedDict of queued tasks.
+    :event: Event (or 'mesh', 'shared') the copy belongs to.
+    :source: Source file.
+    :dest: Destination directory.
+    :method: One of STAGING_METHODS.
+    """
+    
+    key = os.path.join(dest, os.path.basename(source))
+    tasks.pop(key, None)
+    tasks[key] = CopyTask(event, source, dest, method)
+
+def _unlink_shared(dest_file, cache=None):
+    """
+    Removes a destination file if it is a link shared with other directories,
+    so that writing to it can't clobber the canonical copy.
+    
+    :dest_file: Destination file.
+    :cache: Optional DirCache to look up and record entries in.
+    """
+    
+    if cache is not None and not cache.lexists(dest_file):
+        return
+    try:
+        info = os.lstat(dest_file)
+    except OSError as exception:
+        if exception.errno != errno.ENOENT:
+            raise
+        return
+    if stat.S_ISLNK(info.st_mode) or info.st_nlink > 1:
+        os.remove(dest_file)
+        if cache is not None:
+            cache.remove(dest_file)
+
+def safe_link(source, dest, method, cache=None):
+    """
+    Hard or symbolically links a file into a directory, replacing a stale
+    entry. Falls back to copying when the filesystem refuses the link (e.g.
+    across devices).
+    
+    :source: Source file.
+    :dest: Destination directory.
+    :method: 'hardlink' or 'symlink'.
+    :cache: Optional DirCache to look up and record entries in.
+    
+    Returns the number of bytes copied, which is 0 if the file was linked.
+    """
+    
+    isdir   = cache.isdir if cache is not None else os.path.isdir
+    lexists = cache.lexists if cache is not None else os.path.lexists
+    if (isdir(source)):
+        return 0
+    if not (isdir(dest)):
+        return 0
+    
+    source    = os.path.abspath(source)
+    dest_file = os.path.join(dest, os.path.basename(source))
+    
+    # Nothing to do if the link is already in place.
+    if lexists(dest_file):
+        if method == 'symlink' and os.path.islink(dest_file) and \
+            os.readlink(dest_file) == source:
+            return 0
+        if method == 'hardlink' and os.path.exists(dest_file) and \
+            os.path.samefile(source, dest_file):
+            return 0
+        os.remove(dest_file)
+        
+    try:
+        if method == 'hardlink':
+            os.link(source, dest_file)
+        else:
+            os.symlink(source, dest_file)
+    except OSError as exception:
+        if exception.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, 
+            errno.ENOTSUP, errno.EOPNOTSUPP, errno.EACCES):
+            raise
+        if cache is not None:
+            cache.remove(dest_file)
+        return safe_copy(source, dest, cache)
+    if cache is not None:
+        cache.add(dest_file)
+    return 0
+
+def stage_canonical_binaries(bin_path, canonical_path):
+    """
+    Copies the compiled binaries to the single canonical location that the
+    event directories link to. Each binary is written to a temporary name and
+    renamed over the old one, so existing hard links keep the old inode
+    instead of being rewritten in place.
+    
+    :bin_path: Directory with freshly compiled binaries.
+    :canonical_path: Canonical binary directory for the iteration.
+    """
+    
+    mkdir_p(canonical_path)
+    for binary in os.listdir(bin_path):
+        source = os.path.join(bin_path, binary)
+        if os.path.isdir(source):
+            continue
+        
+        # Leave the canonical copy alone if it's the same build.
+        dest_file = os.path.join(canonical_path, binary)
+        if os.path.exists(dest_file):
+            source_info, dest_info = os.stat(source), os.stat(dest_file)
+            if source_info.st_size == dest_info.st_size and \
+                source_info.st_mtime == dest_info.st_mtime:
+                continue
+            
+        temp_file = dest_file + '.tmp'
+        copy_file(source, temp_file)
+        os.rename(temp_file, dest_file)
+
+def _run_copy_task(task, manifest=None, cache=None):
+    """
+    Copy engine worker. Skips the task if the manifest says the destination
+    is already up to date.
+    
+    :task: CopyTask.
+    :manifest: Optional StagingManifest.
+    :cache: Optional DirCache.
+    
+    Returns a CopyResult.
+    """
+    
+    signature = None
+    isdir     = cache.isdir if cache is not None else os.path.isdir
+    try:
+        if isdir(task.source):
+            return CopyResult(task, 0, False, True, None, None)
+        if manifest is not None:
+            signature = manifest.signature(task.source, cache)
+            if manifest.is_current(task, signature, cache):
+                return CopyResult(task, 0, False, True, None, None)
+        if task.method == 'copy':
+            _unlink_shared(os.path.join(task.dest, 
+                os.path.basename(task.source)), cache)
+            n_bytes = safe_copy(task.source, task.dest, cache)
+            return CopyResult(task, n_bytes, False, False, signature, None)
+        n_bytes = safe_link(task.source, task.dest, task.method, cache)
+        return CopyResult(task, n_bytes, n_bytes == 0, False, signature, None)
+    except (IOError, OSError) as exception:
+        return CopyResult(task, 0, False, False, None, exception)
+
+def copy_files(tasks, jobs=1, manifest=None, cache=None):
+    """
+    Runs a list of copies on a bounded thread pool. The copies are almost all
+    waiting on metadata and I/O latency, so threads are enough. Errors are
+    collected per event instead of stopping the pass.
+    
+    :tasks: Iterable of CopyTask.
+    :jobs: Maximum number of concurrent copies.
+    :manifest: Optional StagingManifest. Unchanged files are skipped and the
+        manifest is updated and saved at the end of the pass.
+    :cache: Optional DirCache shared by the copies.
+    
+    Returns a CopySummary.
+    """
+    
+    summary = CopySummary()
+    pool    = thread_pool(jobs)
+    worker  = lambda task: _run_copy_task(task, manifest, cache)
+    try:
+        for result in pool.imap_unordered(worker, tasks, chunksize=16):
+            if result.exception is not None:
+                summary.add_failure(result.task, result.exception)
+                continue
+            summary.add(result)
+            if result.skipped:
+                continue
+            if manifest is not None and result.signature is not None:
+                manifest.record(result.task, result.signature, cache)
+    finally:
+        pool.close()
+        pool.join()
+        if manifest is not None:
+            manifest.save()
+        
+    return summary
+
+def safe_sym_link(source, dest, cache=None):
+    """
+    Sets up symbolic links that won't fail for a stupid reason.
+    
+    :source: Source file.
+    :dest: Destination file.
+    :cache: Optional DirCache to look up and record entries in.
+    """
+    
+    source = os.path.join (source)
+    dest   = os.path.join (dest)
+    isdir  = cache.isdir if cache is not None else os.path.isdir
+
+    if (isdir(source)):
+      return
+    if cache is not None and cache.lexists(dest):
+      return
+  
+    try: 
+      os.symlink(source, dest)
+    except OSError as exception:
+      if exception.errno != errno.EEXIST:
+        raise
+    if cache is not None:
+      cache.add(dest)
+
+def setup_dir_tree(event_path):
+    """
+    Sets up the simulation directory strucutre for one event. 
+    
+    :event_path: Path the forward simulation directory for a specific event.
+    """
+
+    mkdir_p(event_path)
+    mkdir_p(event_path + '/bin')
+    mkdir_p(event_path + '/DATA')
+    mkdir_p(event_path + '/OUTPUT_FILES')
+    mkdir_p(event_path + '/DATABASES_MPI')
+    mkdir_p(event_path + '/DATA/cemRequest')
+
+# Ways of giving each event the mesh: one link per mesh file, or one link to
+# the whole mesh DATABASES_MPI directory.
+LINK_MODES = ['files', 'directory']
+
+def link_mesh_directory(databases_mpi, event_databases_mpi):
+    """
+    Replaces an event's DATABASES_MPI directory by a link to the mesh one.
+    Links left by an earlier file by file prepare_solve are cleared out first,
+    but anything else in the directory means the event has been run, and is
+    left alone.
+    
+    :databases_mpi: Mesh DATABASES_MPI directory.
+    :event_databases_mpi: The event's DATABASES_MPI directory.
+    
+    Returns the number of links made.
+    """
+    
+    if os.path.islink(event_databases_mpi):
+        if os.readlink(event_databases_mpi) == databases_mpi:
+            return 0
+        os.remove(event_databases_mpi)
+    elif os.path.isdir(event_databases_mpi):
+        for file in os.listdir(event_databases_mpi):
+            path = os.path.join(event_databases_mpi, file)
+            if not os.path.islink(path):
+                raise PathError(event_databases_mpi + ' holds files that are '
+                    'not mesh links, not replacing it.')
+            os.remove(path)
+        os.rmdir(event_databases_mpi)
+    os.symlink(databases_mpi, event_databases_mpi)
+    return 1
+
+def bundle_members(members, cache):
+    """
+    Lists the files that go into a bundle, with the signature the manifest
+    keeps of them. Returns a list of [name in the bundle, file, size, mtime].
+    
+    :members: List of (file or directory, name in the bundle).
+    :cache: DirCache.
+    """
+    
+    files = []
+    for source, name in members:
+        if cache.isdir(source):
+            files.extend((os.path.join(source, file), name + '/' + file) for 
+                file in sorted(cache.listdir(source)))
+        else:
+            files.append((source, name))
+    signature = []
+    for source, name in files:
+        info = cache.stat(source)
+        signature.append([name, source, info.st_size, info.st_mtime])
+    return signature
+
+def write_bundle(bundle, members):
+    """
+    Writes an uncompressed tar of the members, replacing the old bundle in a
+    single rename. Returns its size in bytes.
+    
+    :bundle: Bundle file.
+    :members: Signature of the members, from bundle_members.
+    """
+    
+    import tarfile
+    temp_path = bundle + '.tmp'
+    archive = tarfile.open(temp_path, 'w', dereference=True)
+    try:
+        for name, source, _, _ in members:
+            archive.add(source, name)
+    finally:
+        archive.close()
+    os.rename(temp_path, bundle)
+    return os.path.getsize(bundle)
@@ -0,0 +1,209 @@
+"""
+The sqlite journal of each event's progress and of the submitted jobs.
+"""
+
+import os
+import collections
+import datetime
+import threading
+
+from specfem_lasif.util import mkdir_p
+
+# The steps an event goes through, in order. 'staged' and 'linked' are
+# setup_run and prepare_solve; the iteration as a whole also records
+# 'built', 'setup_run' and 'prepare_solve' under the event name '*'.
+STATE_STEPS = ['staged', 'linked', 'submitted', 'completed']
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS steps (
+    iteration TEXT NOT NULL,
+    event     TEXT NOT NULL,
+    step      TEXT NOT NULL,
+    detail    TEXT,
+    updated   TEXT NOT NULL,
+    PRIMARY KEY (iteration, event, step)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    iteration    TEXT NOT NULL,
+    name         TEXT NOT NULL,
+    array_index  INTEGER NOT NULL,
+    job_id       TEXT NOT NULL,
+    array_job_id TEXT,
+    event        TEXT,
+    submitted    TEXT NOT NULL,
+    PRIMARY KEY (iteration, name, array_index)
+);
+"""
+
+class StateStore(object):
+    """
+    Journal of the progress of each event of each iteration through
+    STATE_STEPS, and of the slurm jobs submitted for it, in a sqlite
+    database under the project scratch directory. Every change is committed
+    straight away, so a run that is killed leaves an accurate record of how
+    far it got, and the next run can carry on from there.
+    
+    Uses sqlite's default rollback journal rather than WAL, which needs
+    shared memory and doesn't work on network filesystems.
+    """
+    
+    def __init__(self, path):
+        """
+        :path: Database file. Doesn't need to exist yet.
+        """
+        
+        # sqlite3 is only imported by the stages that use the store.
+        import sqlite3
+        mkdir_p(os.path.dirname(path))
+        self.path       = path
+        self.lock       = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, 
+            check_same_thread=False)
+        with self.lock:
+            self.connection.executescript(STATE_SCHEMA)
+            self.connection.commit()
+            
+    def _execute(self, statement, rows=None):
+        import sqlite3
+        with self.lock:
+            try:
+                if rows is None:
+                    cursor = self.connection.execute(statement)
+                else:
+                    cursor = self.connection.executemany(statement, rows)
+                self.connection.commit()
+            except sqlite3.Error:
+                self.connection.rollback()
+                raise
+            return cursor.fetchall()
+        
+    def _query(self, statement, parameters=()):
+        with self.lock:
+            return self.connection.execute(statement, parameters).fetchall()
+            
+    def mark(self, iteration, events, step, detail=None):
+        """
+        Records that events finished a step.
+        
+        :iteration: Iteration name.
+        :events: Event names.
+        :step: Step name.
+        :detail: What the step was done with, e.g. a build fingerprint. A
+            step done with a different detail doesn't count as done.
+        """
+        
+        now = datetime.datetime.now().isoformat()
+        self._execute('INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?)', 
+            [(iteration, event, step, detail, now) for event in events])
+        
+    def clear(self, iteration, step, events=None):
+        """
+        Forgets that a step was done, for some or all events.
+        
+        :iteration: Iteration name.
+        :step: Step name.
+        :events: Event names, or None for all.
+        """
+        
+        if events is None:
+            self._execute('DELETE FROM steps WHERE iteration = ? AND '
+                'step = ?', [(iteration, step)])
+            return
+        self._execute('DELETE FROM steps WHERE iteration = ? AND step = ? '
+            'AND event = ?', [(iteration, step, event) for event in events])
+        
+    def done(self, iteration, step, detail=None):
+        """
+        Returns the events that finished a step (with detail, if given), as a
+        dictionary of event name to the time it finished.
+        
+        :iteration: Iteration name.
+        :step: Step name.
+        :detail: Only count steps done with this detail.
+        """
+        
+        rows = self._query('SELECT event, detail, updated FROM steps WHERE '
+            'iteration = ? AND step = ?', (iteration, step))
+        return dict((event, updated) for event, event_detail, updated in rows
+            if detail is None or event_detail == detail)
+    
+    def progress(self, iteration, events):
+        """
+        Number of events that finished each step of STATE_STEPS. Other
+        labels with steps of their own (the mesh, the topography) aren't
+        counted.
+        
+        :iteration: Iteration name.
+        :events: Event names of the iteration.
+        """
+        
+        events = set(events)
+        counts = collections.Counter(step for event, step in self._query(
+            'SELECT event, step FROM steps WHERE iteration = ?', 
+            (iteration,)) if event in events)
+        return collections.OrderedDict((step, counts[step]) for step in 
+            STATE_STEPS)
+    
+    def clear_iteration(self, iteration):
+        """
+        Forgets all steps of an iteration, e.g. once it's deleted. Its jobs
+        are kept.
+        
+        :iteration: Iteration name.
+        """
+        
+        self._execute('DELETE FROM steps WHERE iteration = ?', [(iteration,)])
+        
+    def record_job(self, iteration, name, job_id):
+        """
+        Records a single job, e.g. the mesher.
+        
+        :iteration: Iteration name.
+        :name: 'mesher' or 'prepare_solve'.
+        :job_id: Job ID.
+        """
+        
+        self._execute('INSERT OR REPLACE INTO jobs VALUES '
+            '(?, ?, ?, ?, ?, ?, ?)', [(iteration, name, -1, job_id, None, 
+            None, datetime.datetime.now().isoformat())])
+        
+    def record_solver(self, iteration, indices, job_id, events, offset=0):
+        """
+        Records a solver array job, and marks its events as submitted.
+        
+        :iteration: Iteration name.
+        :indices: Job array indices submitted in it.
+        :job_id: Job ID of the array job.
+        :events: Event of each job array index (a list indexed by it).
+        :offset: What the indices were shifted by when submitting, so that
+            slurm knows index i as <job_id>_<i - offset>.
+        """
+        
+        now = datetime.datetime.now().isoformat()
+        self._execute('INSERT OR REPLACE INTO jobs VALUES '
+            '(?, ?, ?, ?, ?, ?, ?)', [(iteration, 'solver', index, 
+            '%s_%d' % (job_id, index - offset), job_id, events[index] if index < 
+            len(events) else None, now) for index in indices])
+        self.mark(iteration, [events[index] for index in indices if index < 
+            len(events)], 'submitted', job_id)
+        
+    def jobs(self, iteration):
+        """
+        The jobs of an iteration: {'mesher': entry, 'prepare_solve': entry, 
+        'solver': {index: entry}}, where each entry has the job ID, the array
+        job ID (for solver jobs) and the submission time.
+        
+        :iteration: Iteration name.
+        """
+        
+        jobs = {'mesher': None, 'prepare_solve': None, 'solver': {}}
+        for name, index, job_id, array_job_id, submitted in self._query(
+            'SELECT name, array_index, job_id, array_job_id, submitted FROM '
+            'jobs WHERE iteration = ?', (iteration,)):
+            entry = {'job_id': job_id, 'array_job_id': array_job_id, 
+                'submitted': submitted}
+            if name == 'solver':
+                jobs['solver'][index] = entry
+            else:
+                jobs[name] = entry
+        return jobs
@@ -0,0 +1,180 @@
+"""
+Small helpers shared by the stages: printing, parameter files and
+directories.
+"""
+
+import os, errno
+import collections
+
+from specfem_lasif.errors import ParameterError
+
+# scandir gives us file types without a stat per entry. It's in os from python
+# 3.5, and in the scandir package before that.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+class colours:
+    ylw = '\033[93m'
+    blu = '\033[94m'
+    rst = '\033[0m'
+
+def print_blu(message):
+    print colours.blu + message + colours.rst
+
+def print_ylw(message):
+    print colours.ylw + message + colours.rst
+
+def read_parameter_file(filename):
+    """
+    Little function to read the specfem setup parameter file, and returns a
+    dictionary of parameters.
+    
+    :filename: path to parameter file.
+    """
+    
+    # List of required parameters.
+    required = ['compiler_suite', 'project_name', 'scratch_path', 
+        'specfem_root', 'lasif_path', 'iteration_name']
+    
+    # Read file, skip lines with #.
+    parameters = {}
+    file = open(filename, 'r')
+    for line in file:        
+        if line.startswith('#'):
+            continue            
+        fields = line.split()
+        parameters.update({fields[0]:fields[1]})
+        
+    # Make sure all required parameters are present.
+    for param in required:
+        if param not in parameters.keys():
+            raise ParameterError('Parameter ' + param + \
+                ' not in parameter file.')
+        
+    # Several iterations can be given, separated by commas. The first is the
+    # current one for the stages that work on a single iteration.
+    parameters['iterations']     = parameters['iteration_name'].split(',')
+    parameters['iteration_name'] = parameters['iterations'][0]
+        
+    # Fix paths.
+    parameters['scratch_path'] = os.path.abspath(parameters['scratch_path'])
+    parameters['specfem_root'] = os.path.abspath(parameters['specfem_root'])
+    parameters['lasif_path']   = os.path.abspath(parameters['lasif_path'])
+    
+    return parameters
+
+def mkdir_p(path):
+    """
+    Makes a directory and doesn't fail if the directory already exists.
+    
+    :path: New directory path.
+    """        
+    
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST:
+            pass
+        else:
+            raise
+
+def read_par_file(filename):
+    """
+    Reads a specfem Par_file and returns an OrderedDict of its parameters, as
+    strings. Comments and blank lines are skipped.
+    
+    :filename: Path to Par_file.
+    """
+    
+    with open(filename, 'r') as file:
+        return parse_par_file(file)
+
+def parse_par_file(lines):
+    """
+    Parses the lines of a specfem Par_file, see read_par_file.
+    
+    :lines: Lines of the Par_file.
+    """
+    
+    parameters = collections.OrderedDict()
+    for line in lines:
+        line = line.split('#')[0].strip()
+        if '=' not in line:
+            continue
+        key, value = line.split('=', 1)
+        parameters[key.strip()] = value.strip()
+    return parameters
+
+def par_file_flag(value):
+    """
+    Interprets a Fortran logical from a Par_file.
+    
+    :value: Parameter value, e.g. '.true.'.
+    """
+    
+    return value.strip().strip('.').lower() in ('true', 't')
+
+def parse_fortran_float(value):
+    """
+    Reads a Fortran real from a Par_file, e.g. '30.d0'.
+    
+    :value: Parameter value.
+    """
+    
+    return float(value.lower().replace('d', 'e'))
+
+def count_lines(path):
+    """
+    Counts the non-empty lines of a text file, or returns 0 if it's missing.
+    
+    :path: File.
+    """
+    
+    try:
+        with open(path, 'r') as file:
+            return sum(1 for line in file if line.strip())
+    except IOError:
+        return 0
+
+def format_elapsed(seconds):
+    """
+    Formats a number of seconds as [h:]mm:ss.
+    
+    :seconds: Elapsed time in seconds.
+    """
+    
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes   = divmod(minutes, 60)
+    if hours:
+        return '%d:%02d:%02d' % (hours, minutes, seconds)
+    return '%02d:%02d' % (minutes, seconds)
+
+def list_subdirectories(path):
+    """
+    Returns the names of the directories in path, using scandir where we have
+    it to avoid a stat per entry.
+    
+    :path: Directory to list.
+    """
+    
+    if scandir is None:
+        return [name for name in os.listdir(path) 
+            if os.path.isdir(os.path.join(path, name))]
+    return [entry.name for entry in scandir(path) if entry.is_dir()]
+
+def thread_pool(processes):
+    """
+    Returns a multiprocessing ThreadPool of at least one thread. The import
+    is left until a pool is needed, since it pulls in most of
+    multiprocessing.
+    
+    :processes: Number of threads.
+    """
+    
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(max(1, processes))
@@ -0,0 +1,311 @@
+"""
+Staging on many nodes at once: the events of a setup_run plan split into
+units of work, in a queue on scratch that any number of workers claim units
+from.
+"""
+
+import os, shutil
+import collections
+import contextlib
+import json
+import time
+
+from specfem_lasif.errors import PathError
+from specfem_lasif.plan import Plan, PlanOperation, execute_plan
+from specfem_lasif.staging import StagingManifest
+from specfem_lasif.util import mkdir_p
+
+# States of a unit: waiting for a worker, being staged by one, staged (and
+# verified by the worker), failed, or staged and merged into the iteration's
+# manifest and state.
+UNIT_STATES = ['pending', 'claimed', 'done', 'failed', 'merged']
+
+# Number of missing destinations a worker reports per unit.
+MISSING_REPORTED = 10
+
+class WorkQueue(object):
+    """
+    A queue of staging units in a directory on scratch:
+
+    queue.json:          the queue's settings, and the state of every unit:
+                         who claimed it and when, and what staging it did.
+                         Only read and written under the lock on queue.lock.
+    units/<id>.json:     the plan operations of a unit, written once.
+    manifests/<id>.json: the staging manifest of a unit: what the iteration
+                         manifests had for its destinations when the queue
+                         was made, and what its workers staged since.
+
+    Claims are fcntl locks, so the workers need a filesystem whose locks work
+    across nodes (e.g. Lustre mounted with flock). A claim that isn't
+    finished within the queue's lease is given to the next worker that asks.
+    Staging a unit twice does no harm: the second time, its manifest skips
+    what the first one staged.
+    """
+
+    def __init__(self, path):
+        """
+        :path: Queue directory.
+        """
+
+        self.path = path
+
+    def _file(self, *names):
+        return os.path.join(self.path, *names)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Holds the queue lock, and yields the queue state. Changes to the
+        state are written back when the block ends.
+        """
+
+        import fcntl
+        if not os.path.exists(self._file('queue.json')):
+            raise PathError('There is no staging queue in %s.' % (self.path))
+        with open(self._file('queue.lock'), 'a') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                with open(self._file('queue.json'), 'r') as file:
+                    queue = json.load(file)
+                before = json.dumps(queue, sort_keys=True)
+                yield queue
+                if json.dumps(queue, sort_keys=True) != before:
+                    self._write('queue.json', queue)
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+
+    def _write(self, name, data):
+        temp_path = self._file(name + '.tmp')
+        with open(temp_path, 'w') as file:
+            json.dump(data, file)
+        os.rename(temp_path, self._file(name))
+
+    def create(self, units, entries, **settings):
+        """
+        Makes the queue, replacing an earlier one in the same directory.
+
+        :units: List of units, each a dictionary with its labels (label:
+            [iteration, event]) and its operations (lists of PlanOperation
+            fields).
+        :entries: Manifest entries of the iterations, keyed by destination
+            file. Each unit's manifest starts out with those of its
+            destinations.
+        :settings: Queue settings: the plan name, iterations, step and
+            details, checksum (for the unit manifests) and lease.
+        """
+
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        mkdir_p(self._file('units'))
+        mkdir_p(self._file('manifests'))
+
+        # Manifest entries are per destination file, or per bundle.
+        owners, states = {}, collections.OrderedDict()
+        for i, unit in enumerate(units):
+            unit_id = 'u%05d' % (i)
+            for kind, _, _, dest, _ in unit['operations']:
+                if kind in ('copy', 'copy_dir', 'bundle'):
+                    owners[dest] = unit_id
+            self._write(os.path.join('units', unit_id + '.json'), unit)
+            states[unit_id] = {'state': 'pending', 'events': len(
+                unit['labels']), 'worker': None, 'claimed': None,
+                'attempts': 0, 'result': None, 'error': None}
+        seeds = collections.defaultdict(dict)
+        for dest, entry in entries.items():
+            unit_id = owners.get(dest) or owners.get(os.path.dirname(dest))
+            if unit_id is not None:
+                seeds[unit_id][dest] = entry
+        for unit_id in states:
+            self._write(os.path.join('manifests', unit_id + '.json'),
+                seeds[unit_id])
+        self._write('queue.json', {'settings': settings, 'units': states})
+
+    def settings(self):
+        """
+        The queue's settings, see create.
+        """
+
+        with self._locked() as queue:
+            return queue['settings']
+
+    def states(self):
+        """
+        The state of every unit, by unit ID.
+        """
+
+        with self._locked() as queue:
+            return collections.OrderedDict(sorted(queue['units'].items()))
+
+    def claim(self, worker):
+        """
+        Claims the next pending unit, or one whose claim has outlived the
+        lease. Returns its ID, or None if there is nothing left to claim.
+
+        :worker: Name of the worker.
+        """
+
+        with self._locked() as queue:
+            now     = time.time()
+            lease   = queue['settings']['lease']
+            pending = sorted(unit_id for unit_id, unit in
+                queue['units'].items() if unit['state'] == 'pending')
+            expired = sorted(unit_id for unit_id, unit in
+                queue['units'].items() if unit['state'] == 'claimed' and
+                now - unit['claimed'] > lease)
+            if not pending and not expired:
+                return None
+            unit_id = (pending or expired)[0]
+            queue['units'][unit_id].update(state='claimed', worker=worker,
+                claimed=now, error=None)
+            queue['units'][unit_id]['attempts'] += 1
+            return unit_id
+
+    def finish(self, unit_id, worker, result, error=None):
+        """
+        Records what a worker did with a unit it claimed. Returns False, and
+        records nothing, if the worker no longer holds the claim, e.g. its
+        lease ran out and another worker claimed the unit.
+
+        :unit_id: Unit ID.
+        :worker: Name of the worker.
+        :result: What it staged, from stage_unit.
+        :error: Why the unit failed, or None if it was staged.
+        """
+
+        with self._locked() as queue:
+            unit = queue['units'][unit_id]
+            if unit['state'] != 'claimed' or unit['worker'] != worker:
+                return False
+            unit.update(state='failed' if error else 'done', result=result,
+                error=error)
+            return True
+
+    def mark(self, unit_ids, state):
+        """
+        Moves units to another state, e.g. failed ones back to pending.
+
+        :unit_ids: Unit IDs.
+        :state: One of UNIT_STATES.
+        """
+
+        with self._locked() as queue:
+            for unit_id in unit_ids:
+                queue['units'][unit_id]['state'] = state
+                if state == 'pending':
+                    queue['units'][unit_id].update(worker=None, claimed=None)
+
+    def unit(self, unit_id):
+        """
+        The labels and operations of a unit.
+
+        :unit_id: Unit ID.
+        """
+
+        with open(self._file('units', unit_id + '.json'), 'r') as file:
+            return json.load(file)
+
+    def manifest_path(self, unit_id):
+        """
+        Staging manifest file of a unit.
+
+        :unit_id: Unit ID.
+        """
+
+        return self._file('manifests', unit_id + '.json')
+
+def worker_name():
+    """
+    Name of this staging worker: host, process ID and, in a job array, the
+    array task.
+    """
+
+    import socket
+    name = '%s:%d' % (socket.gethostname(), os.getpid())
+    task = os.environ.get('SLURM_ARRAY_TASK_ID')
+    return name + ('/' + task if task else '')
+
+def queue_units(plan, labels, chunk):
+    """
+    Splits the operations of some events of a plan into queue units of at
+    most chunk events each. Returns a list of units, as WorkQueue.create
+    takes them.
+
+    :plan: Plan.
+    :labels: Labels of the events to queue, in plan order.
+    :chunk: Maximum number of events per unit.
+    """
+
+    operations = collections.defaultdict(list)
+    for phase_operations in plan.operations.values():
+        for operation in phase_operations:
+            operations[operation.event].append(list(operation))
+    return [{'labels': dict((label, plan.unit(label)) for label in group),
+        'operations': [operation for label in group for operation in
+        operations[label]]} for group in [labels[i:i+chunk] for i in
+        range(0, len(labels), chunk)]]
+
+def unit_plan(unit, settings):
+    """
+    Makes the Plan of a queued unit again.
+
+    :unit: Unit, from WorkQueue.unit.
+    :settings: Queue settings.
+    """
+
+    plan = Plan(settings['name'], settings['iterations'], settings['step'])
+    plan.units.update((label, tuple(unit_of)) for label, unit_of in
+        unit['labels'].items())
+    for operation in unit['operations']:
+        operation = PlanOperation(*operation)
+        if operation.kind == 'bundle':
+            operation = operation._replace(source=[tuple(member) for member in
+                operation.source])
+        plan.add(*operation)
+    return plan
+
+def verify_plan(plan):
+    """
+    Checks that everything a staging plan makes is there. Returns the
+    missing directories, files and bundles.
+
+    :plan: Executed Plan.
+    """
+
+    missing = [operation.dest for operation in plan.operations['mkdir'] if
+        not os.path.isdir(operation.dest)]
+    missing.extend(operation.dest for operation in plan.operations['bundle']
+        if not os.path.exists(operation.dest))
+    for task in plan.copy_tasks().values():
+        dest_file = os.path.join(task.dest, os.path.basename(task.source))
+        if not os.path.lexists(dest_file):
+            missing.append(dest_file)
+    return missing
+
+def stage_unit(queue, unit_id, settings, jobs=1, profiler=None):
+    """
+    Stages a claimed unit with its own manifest, and checks that everything
+    it makes is there. Returns what was staged (files, links, bytes,
+    skipped, missing destinations) and why the unit failed, or None.
+
+    :queue: WorkQueue.
+    :unit_id: Unit ID.
+    :settings: Queue settings.
+    :jobs: Maximum number of concurrent operations.
+    :profiler: Optional Profiler.
+    """
+
+    plan     = unit_plan(queue.unit(unit_id), settings)
+    manifest = StagingManifest(queue.manifest_path(unit_id),
+        settings['checksum'])
+    summary  = execute_plan(plan, jobs, manifest, profiler)
+    manifest.save()
+    missing  = verify_plan(plan)
+    result   = {'files': summary.files, 'links': summary.links,
+        'bytes': summary.bytes, 'skipped': summary.skipped,
+        'missing': missing[:MISSING_REPORTED], 'n_missing': len(missing)}
+    errors = ['%s: %s' % (event, exception) for event, failures in
+        summary.failures.items() for _, exception in failures]
+    if missing:
+        errors.append('%d destinations missing, e.g. %s' % (len(missing),
+            missing[0]))
+    return result, '; '.join(errors[:MISSING_REPORTED]) or None